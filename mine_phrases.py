@@ -0,0 +1,297 @@
+"""
+Mine candidate phrases and per-chat stopwords from the bot's stored history.
+
+    python mine_phrases.py teoembot.db                        # -> trending_phrases.mined.json
+    python mine_phrases.py teoembot.db --source words         # from trending_topics rows (filtered words)
+    python mine_phrases.py teoembot.db --half-life 3 -o trending_phrases.json
+
+Rows are streamed from SQLite in chunks. Each n-gram is packed into one uint64
+key (three 21-bit token ids) and counted with NumPy, so memory grows with the
+number of distinct n-grams kept (--max-keys per chat), not with the number of
+rows. A phrase's lift in a chat is its recency-weighted frequency there over
+its plain frequency across every chat and all time; phrases are ranked by
+lift * log(1 + count).
+
+The output is the base phrase file plus 'mined' (top phrases per chat id and
+'all') and 'chat_stopwords' (words found in so many of a chat's messages that
+they are never news). load_trending_phrases reads it as is, and the bot's
+PhraseBank skips a chat's stopwords when tracking trending words.
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from teoembot import PHRASES_FILE, load_trending_phrases, validate_trending_phrases
+
+ID_BITS = 21  # Three token ids per uint64 key; id 0 means "no token"
+ID_MASK = (1 << ID_BITS) - 1
+MAX_N = 3
+WORD_RE = re.compile(r'\w+')
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(PHRASES_FILE), 'trending_phrases.mined.json')
+
+# One row per message. trending_topics stores one row per word, all with the
+# message's timestamp, so grouping on (chat_id, timestamp) puts them back together;
+# the subquery orders each group by id, i.e. the order update_trending wrote them.
+# Those rows hold only the words update_trending kept (no short words or stopwords),
+# so n-grams mined from them are runs of kept words, not verbatim phrases.
+QUERIES = {
+    'messages': "SELECT chat_id, timestamp, text FROM chat_messages WHERE text IS NOT NULL",
+    'words': ("SELECT chat_id, timestamp, group_concat(word, ' ') FROM "
+              "(SELECT chat_id, timestamp, word FROM trending_topics ORDER BY chat_id, timestamp, id) "
+              "GROUP BY chat_id, timestamp"),
+}
+
+def sqlite_path(db):
+    """Filesystem path of a sqlite:/// URL (or of a plain path)"""
+    return db[len('sqlite:///'):] if db.startswith('sqlite:///') else db
+
+def stream_rows(db, source='messages', chunk_size=50000):
+    """Yield lists of at most chunk_size (chat_id, timestamp, text) rows"""
+    conn = sqlite3.connect(f"file:{sqlite_path(db)}?mode=ro", uri=True)
+    try:
+        cursor = conn.execute(QUERIES[source])
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+def key_fields(keys):
+    """(len(keys), MAX_N) array of the token ids packed in each key"""
+    return np.stack([(keys >> np.uint64(ID_BITS * k)) & np.uint64(ID_MASK) for k in range(MAX_N)], axis=1)
+
+def key_orders(keys):
+    """n of each n-gram key"""
+    return (key_fields(keys) != 0).sum(axis=1)
+
+class NgramCounter:
+    """Counts and recency weights per key, as sorted NumPy arrays.
+
+    Added keys are buffered and merged with np.unique once the buffer reaches
+    max_keys; after a merge only the max_keys most frequent keys are kept.
+    """
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.weights = np.empty(0, dtype=np.float64)
+        self.pruned = 0
+        self._pending = []
+        self._pending_size = 0
+
+    def add(self, keys, weights):
+        self._pending.append((keys, weights))
+        self._pending_size += len(keys)
+        if self._pending_size >= self.max_keys:
+            self.compact()
+
+    def compact(self):
+        if not self._pending:
+            return
+        keys = np.concatenate([self.keys] + [k for k, _ in self._pending])
+        counts = np.concatenate([self.counts] + [np.ones(len(k), dtype=np.int64) for k, _ in self._pending])
+        weights = np.concatenate([self.weights] + [w for _, w in self._pending])
+        self._pending = []
+        self._pending_size = 0
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(self.keys)).astype(np.int64)
+        self.weights = np.bincount(inverse, weights=weights, minlength=len(self.keys))
+        if len(self.keys) > self.max_keys:
+            keep = np.sort(np.argpartition(-self.counts, self.max_keys)[:self.max_keys])
+            self.pruned += len(self.keys) - len(keep)
+            self.keys, self.counts, self.weights = self.keys[keep], self.counts[keep], self.weights[keep]
+
+class PhraseMiner:
+    """Streams (chat_id, timestamp, text) chunks into per-chat n-gram and document counts"""
+
+    def __init__(self, now=None, half_life_days=7.0, max_n=MAX_N, max_keys=500000):
+        self.now = time.time() if now is None else now
+        self.half_life = half_life_days * 86400
+        self.max_n = min(max_n, MAX_N)
+        self.vocab = {}
+        self.words = [None]  # token id -> word
+        self.ngrams = defaultdict(lambda: NgramCounter(max_keys))  # chat -> n-gram counts
+        self.doc_freq = defaultdict(lambda: NgramCounter(max_keys))  # chat -> messages containing each word
+        self.messages = defaultdict(int)
+        self.totals = defaultdict(lambda: np.zeros((MAX_N + 1, 2)))  # chat -> [n] -> (count, weight)
+        self.rows = 0
+
+    def token_id(self, word):
+        token = self.vocab.get(word)
+        if token is None:
+            if len(self.words) > ID_MASK:
+                return 0  # Vocabulary full: n-grams through this word are skipped
+            token = self.vocab[word] = len(self.words)
+            self.words.append(word)
+        return token
+
+    def add_chunk(self, rows):
+        chats, stamps, lengths, ids = [], [], [], []
+        for chat_id, timestamp, text in rows:
+            tokens = [self.token_id(w) for w in WORD_RE.findall((text or '').lower())]
+            if not tokens:
+                continue
+            chats.append(chat_id)
+            stamps.append(timestamp or 0.0)
+            lengths.append(len(tokens))
+            ids.extend(tokens)
+        self.rows += len(rows)
+        if not ids:
+            return
+        ids = np.array(ids, dtype=np.uint64)
+        chats = np.array(chats, dtype=np.int64)
+        msg = np.repeat(np.arange(len(lengths)), lengths)
+        ages = np.maximum(self.now - np.array(stamps, dtype=np.float64), 0.0)
+        msg_weight = 0.5 ** (ages / self.half_life)
+
+        keys, key_msgs = [], []
+        missing = ids == 0
+        for n in range(1, self.max_n + 1):
+            count = len(ids) - n + 1
+            if count <= 0:
+                break
+            key = ids[:count].copy()
+            valid = (msg[:count] == msg[n - 1:]) & ~missing[:count]
+            for k in range(1, n):
+                key |= ids[k:k + count] << np.uint64(ID_BITS * k)
+                valid &= ~missing[k:k + count]
+            keys.append(key[valid])
+            key_msgs.append(msg[:count][valid])
+        keys = np.concatenate(keys)
+        key_msgs = np.concatenate(key_msgs)
+        orders = key_orders(keys)
+
+        # Each word once per message, for document frequency
+        words = np.unique(ids[~missing] | (msg[~missing].astype(np.uint64) << np.uint64(ID_BITS)))
+        word_msgs = (words >> np.uint64(ID_BITS)).astype(np.int64)
+        words &= np.uint64(ID_MASK)
+
+        for chat in np.unique(chats):
+            chat = int(chat)
+            in_chat = chats[key_msgs] == chat
+            weights = msg_weight[key_msgs[in_chat]]
+            self.ngrams[chat].add(keys[in_chat], weights)
+            totals = self.totals[chat]
+            np.add.at(totals, (orders[in_chat], 0), 1)
+            np.add.at(totals, (orders[in_chat], 1), weights)
+            docs = chats[word_msgs] == chat
+            self.doc_freq[chat].add(words[docs], np.ones(int(docs.sum())))
+            self.messages[chat] += int((chats == chat).sum())
+
+    def decode(self, key):
+        return ' '.join(self.words[int(t)] for t in key_fields(np.array([key], dtype=np.uint64))[0] if t)
+
+    def chat_stopwords(self, min_df=0.05, min_messages=50):
+        """chat -> words in at least min_df of its messages, most common first"""
+        result = {}
+        for chat, counter in self.doc_freq.items():
+            total = self.messages[chat]
+            if total < min_messages:
+                continue
+            counter.compact()
+            common = counter.counts >= min_df * total
+            order = np.argsort(-counter.counts[common], kind='stable')
+            result[chat] = [self.words[int(k)] for k in counter.keys[common][order]]
+        return result
+
+    def _background(self):
+        """Plain counts of every n-gram over all chats, and per-n totals"""
+        for counter in self.ngrams.values():
+            counter.compact()
+        keys = np.concatenate([c.keys for c in self.ngrams.values()] or [np.empty(0, dtype=np.uint64)])
+        counts = np.concatenate([c.counts for c in self.ngrams.values()] or [np.empty(0, dtype=np.int64)])
+        weights = np.concatenate([c.weights for c in self.ngrams.values()] or [np.empty(0)])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        totals = sum(self.totals.values(), np.zeros((MAX_N + 1, 2)))
+        return (keys, np.bincount(inverse, weights=counts, minlength=len(keys)),
+                np.bincount(inverse, weights=weights, minlength=len(keys)), totals)
+
+    def phrases(self, top=20, min_count=5, min_n=2, min_lift=1.0):
+        """chat -> up to `top` phrases by lift * log(1 + count), plus 'all' for the whole corpus"""
+        base_keys, base_counts, base_weights, base_totals = self._background()
+        base_rate = base_counts / np.maximum(base_totals[key_orders(base_keys), 0], 1)
+        candidates = {chat: (c.keys, c.counts, c.weights, self.totals[chat]) for chat, c in self.ngrams.items()}
+        candidates['all'] = (base_keys, base_counts, base_weights, base_totals)
+
+        result = {}
+        for chat, (keys, counts, weights, totals) in candidates.items():
+            orders = key_orders(keys)
+            rate = weights / np.maximum(totals[orders, 1], 1e-12)
+            lift = rate / np.maximum(base_rate[np.searchsorted(base_keys, keys)], 1e-12)
+            keep = (orders >= min_n) & (counts >= min_count) & (lift >= min_lift)
+            scores = lift[keep] * np.log1p(counts[keep])
+            best = np.argsort(-scores, kind='stable')[:top]
+            result[chat] = [self.decode(k) for k in keys[keep][best]]
+        return result
+
+    def stats(self):
+        return {'rows': self.rows, 'chats': len(self.ngrams), 'vocabulary': len(self.vocab),
+                'ngrams': sum(len(c.keys) + c._pending_size for c in self.ngrams.values()),
+                'pruned': sum(c.pruned for c in self.ngrams.values())}
+
+def build_bank(base, phrases, stopwords):
+    """The base phrase data plus 'mined' and 'chat_stopwords', keyed by chat id string"""
+    data = dict(base)
+    data['mined'] = {str(chat): found for chat, found in phrases.items() if found}
+    data['chat_stopwords'] = {str(chat): words for chat, words in stopwords.items() if words}
+    validate_trending_phrases(data)
+    return data
+
+def write_bank(data, path):
+    """Write atomically, so a PhraseBank watching the file never reads half of it"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def mine(db, source='messages', chunk_size=50000, half_life_days=7.0, max_keys=500000, now=None):
+    miner = PhraseMiner(now=now, half_life_days=half_life_days, max_keys=max_keys)
+    for rows in stream_rows(db, source, chunk_size):
+        miner.add_chunk(rows)
+    return miner
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('db', nargs='?', default='teoembot.db', help='SQLite file or sqlite:/// URL')
+    parser.add_argument('--source', choices=sorted(QUERIES), default='messages',
+                        help='chat_messages texts, or trending_topics words (n-grams over the filtered words)')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT, help='phrase file to write')
+    parser.add_argument('--base', default=PHRASES_FILE, help='phrase file the output extends')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='rows fetched per chunk')
+    parser.add_argument('--half-life', type=float, default=7.0, help='recency half-life in days')
+    parser.add_argument('--top', type=int, default=20, help='phrases kept per chat')
+    parser.add_argument('--min-count', type=int, default=5, help='occurrences needed in a chat')
+    parser.add_argument('--stopword-df', type=float, default=0.05,
+                        help='share of a chat\'s messages that makes a word a stopword')
+    parser.add_argument('--max-keys', type=int, default=500000, help='distinct n-grams kept per chat')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(sqlite_path(args.db)):
+        print(f"No database at {args.db}")
+        return 1
+    started = time.time()
+    miner = mine(args.db, args.source, args.chunk_size, args.half_life, args.max_keys)
+    stopwords = miner.chat_stopwords(args.stopword_df)
+    phrases = miner.phrases(args.top, args.min_count)
+    write_bank(build_bank(load_trending_phrases(args.base), phrases, stopwords), args.output)
+    elapsed = time.time() - started
+    stats = miner.stats()
+    print(f"{stats['rows']} rows from {stats['chats']} chats in {elapsed:.1f}s "
+          f"({stats['rows'] / max(elapsed, 1e-9):.0f} rows/s), {stats['pruned']} n-grams pruned")
+    for chat, found in phrases.items():
+        print(f"{chat}: {', '.join(found[:5])}")
+    print(f"Wrote {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,47 +1,152 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import os
 import random
 import asyncio
 import re
 import datetime
 import base64
-import time
 import hashlib
+import heapq
 import logging
+import logging.handlers
 import atexit
+import contextvars
+import copy
+import dataclasses
+import functools
+import gzip
 import json
-from collections import defaultdict, deque
-from telethon import TelegramClient, events, functions, types
-from openai import OpenAI
-from dotenv import load_dotenv
+import queue
+import sys
+import threading
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from aiolimiter import AsyncLimiter
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-from cachetools import TTLCache
-from cryptography.fernet import Fernet
-from sqlalchemy import create_engine, Column, Integer, String, Float, JSON
-from sqlalchemy.orm import declarative_base, sessionmaker
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_not_exception_type
+from cachetools import LRUCache, TTLCache
 
-# Load environment variables
-load_dotenv()
+# Heavy dependencies (telethon, openai, sqlalchemy via teoembot_db, cryptography,
+# dotenv) are imported on first use so that importing this module stays cheap.
+IMPORT_TIME_BUDGET = 0.3  # Seconds; checked by the tests and logged at startup
 
 # --- LOGGING SETUP ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('teoembot.log'),
-        logging.StreamHandler()
-    ]
-)
+# Per-task structured fields (chat_id, msg_id) attached to every record
+log_context = contextvars.ContextVar('log_context', default=None)
+
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+class LogContextFilter(logging.Filter):
+    """Copy the current task's log_context fields onto each record"""
+
+    def filter(self, record):
+        fields = log_context.get()
+        if fields:
+            for key, value in fields.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg plus any structured fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TimedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that times emit() and leaves output formatting to the listener thread.
+
+    The message itself is built here, on the caller's thread: its arguments may be
+    live state that the event loop changes before the listener gets to the record.
+    Debug records (already filtered by level) only get mutable arguments copied.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.records = 0
+        self.emit_ns = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.levelno > logging.DEBUG:
+            record.msg = record.getMessage()
+            record.args = None
+        elif isinstance(record.args, dict):  # A lone mapping argument, for %(name)s formats
+            record.args = dict(record.args)
+        elif record.args:
+            record.args = tuple(copy.copy(a) if isinstance(a, (dict, list, set, deque)) else a for a in record.args)
+        return record
+
+    def emit(self, record):
+        started = time.perf_counter_ns()
+        super().emit(record)
+        self.emit_ns += time.perf_counter_ns() - started
+        self.records += 1
+
+_log_queue_handler = None
+_log_listener = None
+
+def setup_logging(log_file='teoembot.log', level='INFO', max_bytes=10 * 1024 * 1024, backup_count=5):
+    """Route all logging through a queue; file/console I/O runs on a listener thread"""
+    global _log_queue_handler, _log_listener
+    if _log_listener is not None:
+        return _log_queue_handler
+    
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    _log_queue_handler = TimedQueueHandler(log_queue)
+    _log_queue_handler.addFilter(LogContextFilter())
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(_log_queue_handler)
+    return _log_queue_handler
+
+def logging_stats():
+    """Records emitted and average time spent on the caller's thread per record"""
+    if _log_queue_handler is None or not _log_queue_handler.records:
+        return {'records': 0, 'avg_emit_us': 0.0, 'total_emit_ms': 0.0}
+    handler = _log_queue_handler
+    return {
+        'records': handler.records,
+        'avg_emit_us': round(handler.emit_ns / handler.records / 1000, 2),
+        'total_emit_ms': round(handler.emit_ns / 1e6, 2),
+    }
+
 logger = logging.getLogger(__name__)
 
 # --- ENCRYPTION UTILITIES ---
-def get_encryption_key():
+def get_encryption_key(key_file='.encryption_key'):
     """Get or create encryption key for API keys"""
-    key_file = '.encryption_key'
     if os.path.exists(key_file):
         with open(key_file, 'rb') as f:
             return f.read()
     else:
+        from cryptography.fernet import Fernet
         key = Fernet.generate_key()
         with open(key_file, 'wb') as f:
             f.write(key)
@@ -54,17 +159,88 @@ def decrypt_env_value(encrypted_value, cipher):
             return cipher.decrypt(encrypted_value[4:].encode()).decode()
         return encrypted_value
     except Exception as e:
-        logger.warning(f"Failed to decrypt value, using as-is: {e}")
+        logger.warning("Failed to decrypt value, using as-is: %s", e)
         return encrypted_value
 
-# Initialize encryption
-cipher_suite = Fernet(get_encryption_key())
-
 # --- CẤU HÌNH TỪ .ENV ---
-API_ID = os.getenv('API_ID')
-API_HASH = os.getenv('API_HASH')
-OPENAI_API_KEY = decrypt_env_value(os.getenv('OPENAI_API_KEY'), cipher_suite)
-SESSION_NAME = os.getenv('SESSION_NAME', 'teocakhia')
+@dataclasses.dataclass
+class BotConfig:
+    """Process settings; from_env() reads them after .env has been loaded"""
+    api_id: str = None
+    api_hash: str = None
+    openai_api_key: str = None  # May be 'ENC:'-prefixed; decrypted on first use
+    session_name: str = 'teocakhia'
+    db_url: str = 'sqlite:///teoembot.db'
+    phrases_file: str = None
+    encryption_key_file: str = '.encryption_key'
+    log_file: str = 'teoembot.log'
+    log_level: str = 'INFO'
+    log_max_bytes: int = 10 * 1024 * 1024  # Rotate at 10MB
+    log_backup_count: int = 5
+    outbox_max_age: int = 120  # Pending deliveries older than this are dropped at startup
+    reply_candidates: int = 3  # Completions requested per AI reply; 1 disables reranking
+    local_random_replies: bool = False  # Also answer plain random triggers locally (quota fallback always does)
+    generation_backends: str = None  # JSON list of OpenAI-compatible endpoints, primary first
+    backend_api_keys: dict = dataclasses.field(default_factory=dict)  # api_key_env name -> key (may be 'ENC:'-prefixed)
+    routes_file: str = None  # JSON overrides of the per-message-class routing table
+    snapshot_file: str = 'teoembot_state.json.gz'  # Warm-restart state; empty disables snapshots
+    profile_seconds: float = 30  # Length of an on-demand profile (SIGUSR1)
+    profile_dir: str = 'profiles'
+    trace_file: str = None  # JSONL sink for per-message spans; tracing is off when unset
+    chat_weights: str = None  # JSON {chat_id: weight or {"weight": w, "min_share": s}} for fair queueing
+    backlog_stale_seconds: int = 90  # Older messages (e.g. delivered after a reconnect) only update state
+    archive_retention_days: float = 60  # Archived chat messages older than this are pruned; 0 keeps them all
+    # Runtime state limits (per-chat / per-thread memory)
+    state_chat_ttl: int = 6 * 3600
+    state_thread_ttl: int = 3600
+    state_max_entries: int = 20000
+    state_memory_limit_mb: float = 32
+
+    @classmethod
+    def from_env(cls, environ=None):
+        env = os.environ if environ is None else environ
+        defaults = cls()
+        return cls(
+            api_id=env.get('API_ID'),
+            api_hash=env.get('API_HASH'),
+            openai_api_key=env.get('OPENAI_API_KEY'),
+            session_name=env.get('SESSION_NAME', defaults.session_name),
+            db_url=env.get('DB_URL', defaults.db_url),
+            phrases_file=env.get('PHRASES_FILE'),
+            encryption_key_file=env.get('ENCRYPTION_KEY_FILE', defaults.encryption_key_file),
+            log_file=env.get('LOG_FILE', defaults.log_file),
+            log_level=env.get('LOG_LEVEL', defaults.log_level).upper(),
+            log_max_bytes=int(env.get('LOG_MAX_BYTES', defaults.log_max_bytes)),
+            log_backup_count=int(env.get('LOG_BACKUP_COUNT', defaults.log_backup_count)),
+            outbox_max_age=int(env.get('OUTBOX_MAX_AGE_SECONDS', defaults.outbox_max_age)),
+            reply_candidates=int(env.get('REPLY_CANDIDATES', defaults.reply_candidates)),
+            local_random_replies=env.get('LOCAL_RANDOM_REPLIES', '0').lower() in ('1', 'true', 'yes'),
+            generation_backends=env.get('GENERATION_BACKENDS'),
+            backend_api_keys=backend_api_keys_from_env(env, env.get('GENERATION_BACKENDS')),
+            routes_file=env.get('ROUTES_FILE'),
+            snapshot_file=env.get('SNAPSHOT_FILE', defaults.snapshot_file),
+            profile_seconds=float(env.get('PROFILE_SECONDS', defaults.profile_seconds)),
+            profile_dir=env.get('PROFILE_DIR', defaults.profile_dir),
+            trace_file=env.get('TRACE_FILE') or None,
+            chat_weights=env.get('CHAT_WEIGHTS'),
+            backlog_stale_seconds=int(env.get('BACKLOG_STALE_SECONDS', defaults.backlog_stale_seconds)),
+            archive_retention_days=float(env.get('ARCHIVE_RETENTION_DAYS', defaults.archive_retention_days)),
+            state_chat_ttl=int(env.get('STATE_CHAT_TTL_SECONDS', defaults.state_chat_ttl)),
+            state_thread_ttl=int(env.get('STATE_THREAD_TTL_SECONDS', defaults.state_thread_ttl)),
+            state_max_entries=int(env.get('STATE_MAX_ENTRIES', defaults.state_max_entries)),
+            state_memory_limit_mb=float(env.get('STATE_MEMORY_LIMIT_MB', defaults.state_memory_limit_mb)),
+        )
+
+def backend_api_keys_from_env(env, generation_backends):
+    """Values of the api_key_env variables named in GENERATION_BACKENDS"""
+    if not generation_backends:
+        return {}
+    try:
+        specs = json.loads(generation_backends)
+    except ValueError:
+        return {}  # build_backends reports the bad JSON
+    names = {spec.get('api_key_env') for spec in specs if isinstance(spec, dict)}
+    return {name: env[name] for name in names if name and env.get(name)}
 
 # --- WHITELIST CHAT IDs ---
 ALLOWED_CHAT_IDS = {-1001518116463, -1002336255712}
@@ -72,6 +248,8 @@ ALLOWED_CHAT_IDS = {-1001518116463, -1002336255712}
 # Cấu hình hành vi - ĐIỀU CHỈNH ĐỂ DEBUG
 RATE_LIMIT_SECONDS = 10  # Giảm xuống 10s để test
 TRIGGER_PROBABILITY = 0.5  # Tăng lên 50% để dễ test
+REACTION_PROBABILITY = 0.2  # Chance to react to a message that gets no reply
+OPENAI_HOURLY_QUOTA = 100  # API calls per clock hour
 SLEEP_START_HOUR = 25  # Tắt tính năng ngủ (>24h)
 SLEEP_END_HOUR = 26
 
@@ -82,206 +260,1579 @@ DEBUG = True  # Bật debug log
 MIN_MEANINGFUL_LENGTH = 3  # Minimum character length for meaningful responses
 MAX_HISTORY_TEXT_LENGTH = 50  # Maximum length for history text in context
 RECENT_TOPICS_COUNT = 3  # Number of recent topics to consider for relevance
+MAX_RELATED_TEXT_LENGTH = 150  # Maximum length of an archived message in the prompt
 
-# Rate limiters
-telegram_limiter = AsyncLimiter(max_rate=20, time_period=60)  # 20 messages per minute
-openai_limiter = AsyncLimiter(max_rate=10, time_period=60)  # 10 API calls per minute
+STATE_REPORT_INTERVAL = 600  # Seconds between state size log lines
 
 # Dữ liệu templates
 CLUBS = ["MU", "Man City", "Arsenal", "Liverpool", "Real", "Barca", "Chelsea", "Bayern", "PSG", "Việt Nam"]
 KEOS = ["tài 2.5", "xỉu 2.5", "tài 3 hòa", "chấp nửa trái", "đồng banh", "rung tài 0.5"]
 COMMENTS = ["sáng cửa", "thơm phức", "hơi bịp nhưng vẫn ngon", "tín vl", "nhồi mạnh", "xa bờ thì bám vào"]
 
+# --- PHRASE BANK ---
+PHRASES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trending_phrases.json')
+PHRASES_CHECK_INTERVAL = 5  # Seconds between mtime checks of the phrases file
+
+DEFAULT_TRENDING_PHRASES = {
+    "memes": ["cái gì vậy trời", "ngon nghẻ", "sợ anh em lắm"],
+    "reactions": {
+        "win": ["đỉnh của đỉnh"],
+        "loss": ["gg wp"],
+        "football": ["trận này căng"],
+        "betting": ["kèo ngon lắm"],
+        "casual": ["oke nha"]
+    },
+    "context_aware": {
+        "agree": ["ừ đúng rồi"],
+        "disagree": ["chưa chắc đâu"],
+        "surprise": ["trời ơi"],
+        "laugh": ["chết cười"]
+    }
+}
+
 # Load trending phrases from JSON
-def load_trending_phrases():
+def load_trending_phrases(path=None):
     """Load trending phrases from JSON config file"""
     try:
-        phrases_file = os.path.join(os.path.dirname(__file__), 'trending_phrases.json')
-        with open(phrases_file, 'r', encoding='utf-8') as f:
+        with open(path or PHRASES_FILE, 'r', encoding='utf-8') as f:
             return json.load(f)
     except Exception as e:
-        logger.warning(f"Failed to load trending phrases: {e}")
-        return {
-            "memes": ["cái gì vậy trời", "ngon nghẻ", "sợ anh em lắm"],
-            "reactions": {
-                "win": ["đỉnh của đỉnh"],
-                "loss": ["gg wp"],
-                "football": ["trận này căng"],
-                "betting": ["kèo ngon lắm"],
-                "casual": ["oke nha"]
-            },
-            "context_aware": {
-                "agree": ["ừ đúng rồi"],
-                "disagree": ["chưa chắc đâu"],
-                "surprise": ["trời ơi"],
-                "laugh": ["chết cười"]
-            }
-        }
+        logger.warning("Failed to load trending phrases: %s", e)
+        return copy.deepcopy(DEFAULT_TRENDING_PHRASES)
+
+def _is_phrase_list(value):
+    return isinstance(value, list) and all(isinstance(p, str) and p.strip() for p in value)
+
+def validate_trending_phrases(data):
+    """Raise ValueError if data doesn't have the trending_phrases.json shape"""
+    if not isinstance(data, dict):
+        raise ValueError("top level must be an object")
+    if not _is_phrase_list(data.get('memes')) or not data['memes']:
+        raise ValueError("'memes' must be a non-empty list of strings")
+    for category, value in data.items():
+        if isinstance(value, dict):
+            for sub, phrases in value.items():
+                if not _is_phrase_list(phrases):
+                    raise ValueError(f"'{category}.{sub}' must be a list of strings")
+        elif not _is_phrase_list(value):
+            raise ValueError(f"'{category}' must be a list of strings or an object of lists")
+
+PHRASE_METADATA_CATEGORIES = ('chat_stopwords',)  # Word lists written by mine_phrases.py, not phrases
+
+class PhraseSnapshot:
+    """Immutable lookup structures built from one version of the phrases file"""
+    __slots__ = ('data', 'flat', 'sample_pool', 'synonyms', 'synonym_re', 'stopwords')
+
+    def __init__(self, data):
+        self.data = data
+        # (category, subcategory) -> tuple; (category, None) holds every phrase in the category
+        flat = {}
+        for category, value in data.items():
+            if category in PHRASE_METADATA_CATEGORIES:
+                continue
+            if isinstance(value, dict):
+                everything = []
+                for sub, phrases in value.items():
+                    flat[(category, sub)] = tuple(phrases)
+                    everything.extend(phrases)
+                flat[(category, None)] = tuple(everything)
+            else:
+                flat[(category, None)] = tuple(value)
+        self.flat = flat
+        self.sample_pool = flat.get(('memes', None), ())[:10]
+        self.synonyms = {k.lower(): tuple(v) for k, v in data.get('synonyms', {}).items() if v}
+        # Longest keys first so 'oke r' style keys win over their prefixes
+        keys = sorted(self.synonyms, key=len, reverse=True)
+        self.synonym_re = re.compile('|'.join(map(re.escape, keys))) if keys else None
+        # chat id (as a string) -> words too common in that chat to trend, written by mine_phrases.py
+        self.stopwords = {chat: frozenset(words) for chat, words in data.get('chat_stopwords', {}).items()}
+
+class PhraseBank:
+    """Hot-reloadable view of trending_phrases.json.
+
+    The file's mtime is checked at most every check_interval seconds; a changed
+    file is validated and turned into a new PhraseSnapshot that replaces the
+    old one in a single assignment. Invalid updates are logged and ignored.
+    """
+
+    def __init__(self, path, check_interval=PHRASES_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._mtime = None
+        self._next_check = 0.0
+        self.reloads = 0
+        self.rejected = 0
 
-TRENDING_PHRASES = load_trending_phrases()
+    def current(self):
+        """Latest valid snapshot, reloading first if the file changed"""
+        now = time.monotonic()
+        if self._snapshot is None or now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self._maybe_reload()
+        return self._snapshot
+
+    def _swap(self, snapshot):
+        self._snapshot = snapshot
+
+    def _maybe_reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._snapshot is not None and mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            if mtime is None:
+                raise ValueError("file not found")
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            validate_trending_phrases(data)
+            snapshot = PhraseSnapshot(data)
+        except Exception as e:
+            self.rejected += 1
+            logger.warning("Rejected trending phrases from %s: %s", self.path, e)
+            if self._snapshot is None:
+                self._swap(PhraseSnapshot(copy.deepcopy(DEFAULT_TRENDING_PHRASES)))
+            return
+        if self._snapshot is not None:
+            logger.info("🔄 Reloaded trending phrases (%s groups)", len(snapshot.flat))
+        self.reloads += 1
+        self._swap(snapshot)
+
+    def reload(self):
+        """Check the file now instead of waiting for the next interval"""
+        self._next_check = 0.0
+        return self.current()
+
+    def phrases(self, category, subcategory=None):
+        return self.current().flat.get((category, subcategory), ())
+
+    def sample(self, count):
+        pool = self.current().sample_pool
+        return random.sample(pool, min(count, len(pool)))
+
+    def vary(self, text):
+        """Replace one known teencode word with a random synonym, or None"""
+        snapshot = self.current()
+        if snapshot.synonym_re is None:
+            return None
+        lowered = text.lower()
+        match = snapshot.synonym_re.search(lowered)
+        if not match:
+            return None
+        key = match.group(0)
+        return lowered.replace(key, random.choice(snapshot.synonyms[key]))
+
+    def stopwords(self, chat_id):
+        return self.current().stopwords.get(str(chat_id), frozenset())
 
 def get_random_trending_phrase(category=None, subcategory=None):
     """Get a random trending phrase based on category"""
     try:
-        if category and subcategory:
-            phrases = TRENDING_PHRASES.get(category, {}).get(subcategory, [])
-            if phrases:
-                return random.choice(phrases)
-        elif category:
-            phrases = TRENDING_PHRASES.get(category, [])
+        if category:
+            phrases = get_runtime().phrase_bank.phrases(category, subcategory)
             if phrases:
                 return random.choice(phrases)
         # Return random meme as fallback
-        memes = TRENDING_PHRASES.get('memes', [])
+        memes = get_runtime().phrase_bank.phrases('memes')
         if memes:
             return random.choice(memes)
         return 'oke'  # Final fallback
     except Exception as e:
-        logger.error(f"Error getting trending phrase: {e}")
+        logger.error("Error getting trending phrase: %s", e)
         return None
 
 # AI Client - lazy initialization
-ai_client = None
-client = None
-
 def get_ai_client():
     """Lazy initialization of OpenAI client"""
-    global ai_client
-    if ai_client is None:
-        if not OPENAI_API_KEY:
-            logger.warning("OpenAI API key not set, using mock client")
-            return None
-        ai_client = OpenAI(api_key=OPENAI_API_KEY)
-    return ai_client
+    return get_runtime().get_ai_client()
 
 def get_telegram_client():
     """Lazy initialization of Telegram client"""
-    global client
-    if client is None:
-        client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
-    return client
-
-# --- DATABASE SETUP ---
-Base = declarative_base()
-
-class TrendingTopic(Base):
-    __tablename__ = 'trending_topics'
-    id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer)
-    word = Column(String)
-    timestamp = Column(Float)
-
-class UserContext(Base):
-    __tablename__ = 'user_contexts'
-    id = Column(Integer, primary_key=True)
-    chat_id = Column(Integer)
-    user_id = Column(Integer)
-    last_topic = Column(String)
-    sentiment = Column(String)
-    last_interaction = Column(Float)
-    interaction_count = Column(Integer)
-    context_data = Column(JSON)
-
-# Initialize database
-engine = create_engine('sqlite:///teoembot.db', echo=False)
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-
-# Memory systems
-last_chat_time = {}
-user_context = defaultdict(lambda: {
-    'last_topic': None,
-    'sentiment': 'neutral',
-    'last_interaction': 0,
-    'interaction_count': 0
-})
-trending_topics = defaultdict(lambda: deque(maxlen=20))
-
-# Replace MD5 cache with TTLCache
-message_cache = TTLCache(maxsize=100, ttl=600)  # 100 items, 10 min TTL
+    return get_runtime().get_telegram_client()
+
+# --- DATABASE ---
+def percentile(values, pct):
+    """Nearest-rank percentile of a sequence, None when empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+class AsyncDatabase:
+    """Non-blocking SQLite access: reads on a thread pool, writes through a single writer task.
+
+    Writes are queued and committed in batches by one task running on a dedicated
+    thread, so SQLite only ever sees one writer. Sessions come from a pooled engine,
+    so connections are reused across operations.
+    """
+
+    def __init__(self, session_factory, read_workers=2, batch_size=50, slow_tx_ms=250):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.slow_tx_ms = slow_tx_ms
+        self._read_executor = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-read')
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+        self._queue = None
+        self._writer_task = None
+        self._loop = None
+        # Instrumentation (seconds)
+        self.queue_latency = deque(maxlen=1000)
+        self.tx_durations = deque(maxlen=1000)
+        self.read_durations = deque(maxlen=1000)
+        self.writes_total = 0
+        self.write_errors = 0
+
+    def _ensure_writer(self):
+        """Start the writer task on the running loop (restarted if the loop changed)"""
+        loop = asyncio.get_running_loop()
+        if self._writer_task is None or self._loop is not loop or self._writer_task.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._writer_task = loop.create_task(self._writer_loop())
+
+    def _run_read(self, fn, args):
+        started = time.perf_counter()
+        try:
+            with self.session_factory() as db_session:
+                return fn(db_session, *args)
+        finally:
+            self.read_durations.append(time.perf_counter() - started)
+
+    async def read(self, fn, *args):
+        """Run fn(session, *args) on the read pool and return its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, self._run_read, fn, args)
+
+    def _enqueue(self, fn, args):
+        self._ensure_writer()
+        future = self._loop.create_future()
+        self._queue.put_nowait((fn, args, future, time.perf_counter()))
+        return future
+
+    async def write(self, fn, *args):
+        """Queue fn(session, *args) for the writer and wait until it is committed"""
+        return await self._enqueue(fn, args)
+
+    def write_nowait(self, fn, *args):
+        """Queue a write without waiting; runs synchronously when no loop is running"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self._commit_one(fn, args)
+        future = self._enqueue(fn, args)
+        # Errors are logged by the writer; don't warn about unretrieved exceptions
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return None
+
+    def _commit_one(self, fn, args):
+        with self.session_factory() as db_session:
+            result = fn(db_session, *args)
+            db_session.commit()
+            return result
+
+    def _commit_batch(self, batch):
+        """Commit a batch in one transaction; on failure retry items one by one"""
+        started = time.perf_counter()
+        try:
+            with self.session_factory() as db_session:
+                results = [fn(db_session, *args) for fn, args, _, _ in batch]
+                db_session.commit()
+            return [(True, r) for r in results]
+        except Exception:
+            outcomes = []
+            for fn, args, _, _ in batch:
+                try:
+                    outcomes.append((True, self._commit_one(fn, args)))
+                except Exception as e:
+                    outcomes.append((False, e))
+            return outcomes
+        finally:
+            duration = time.perf_counter() - started
+            self.tx_durations.append(duration)
+            if duration * 1000 > self.slow_tx_ms:
+                logger.warning("Slow DB transaction: %d writes in %.0fms", len(batch), duration * 1000)
+
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            dequeued_at = time.perf_counter()
+            for _, _, _, enqueued_at in batch:
+                self.queue_latency.append(dequeued_at - enqueued_at)
+            try:
+                outcomes = await loop.run_in_executor(self._write_executor, self._commit_batch, batch)
+            except Exception as e:
+                outcomes = [(False, e)] * len(batch)
+            for (_, _, future, _), (ok, value) in zip(batch, outcomes):
+                if ok:
+                    self.writes_total += 1
+                    if not future.done():
+                        future.set_result(value)
+                else:
+                    self.write_errors += 1
+                    logger.error("DB write failed: %s", value)
+                    if not future.done():
+                        future.set_exception(value)
+                queue.task_done()
+
+    async def close(self):
+        """Drain pending writes and stop the writer task"""
+        if self._writer_task is not None and self._loop is asyncio.get_running_loop():
+            await self._queue.join()
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+        self._writer_task = None
+
+    def stats(self):
+        """Queue depth plus queue latency / transaction timing in milliseconds"""
+        def ms(values, pct):
+            value = percentile(values, pct)
+            return round(value * 1000, 2) if value is not None else None
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'writes_total': self.writes_total,
+            'write_errors': self.write_errors,
+            'queue_latency_p50_ms': ms(self.queue_latency, 50),
+            'queue_latency_p95_ms': ms(self.queue_latency, 95),
+            'tx_p50_ms': ms(self.tx_durations, 50),
+            'tx_p95_ms': ms(self.tx_durations, 95),
+            'read_p95_ms': ms(self.read_durations, 95),
+        }
+
+# --- RUNTIME STATE STORE ---
+TRENDING_WINDOW = 20  # Words kept per chat for trending detection
+
+class ChatState:
+    """Per-chat runtime state"""
+    __slots__ = ('trending', 'questions_asked', 'last_seen')
+    # Upper bound: record + full trending deque of {'word', 'time'} dicts
+    MAX_BYTES = 1200 + TRENDING_WINDOW * 300
+
+    def __init__(self):
+        self.trending = deque(maxlen=TRENDING_WINDOW)
+        self.questions_asked = 0
+        self.last_seen = 0.0
+
+    def sizeof(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.trending)
+        return size + sum(sys.getsizeof(t) + sys.getsizeof(t.get('word', '')) for t in self.trending)
+
+class ThreadState:
+    """Per-thread (chat + reply topic) runtime state"""
+    __slots__ = ('last_reply_time', 'last_seen')
+    MAX_BYTES = 200
+
+    def __init__(self):
+        self.last_reply_time = 0.0
+        self.last_seen = 0.0
+
+    def sizeof(self):
+        return sys.getsizeof(self)
+
+class StateStore:
+    """Bounded key -> record map with idle-TTL and LRU eviction.
+
+    Entries are kept in access order, so expired entries are always at the front
+    and eviction is amortized O(1). Capacity is the smaller of max_entries and
+    what fits in max_bytes at the record class's MAX_BYTES.
+    """
+
+    def __init__(self, record_cls, ttl, max_entries=20000, max_bytes=None):
+        self.record_cls = record_cls
+        self.ttl = ttl
+        self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_entries = max(1, min(max_entries, int(max_bytes // record_cls.MAX_BYTES)))
+        self._entries = OrderedDict()
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, key):
+        """Return the record for key, creating it if needed, and mark it as used"""
+        now = time.time()
+        record = self._entries.get(key)
+        if record is None or now - record.last_seen > self.ttl:
+            record = self.record_cls()
+            self._entries[key] = record
+        self._entries.move_to_end(key)
+        record.last_seen = now
+        self._evict(now)
+        return record
+
+    __getitem__ = get
+
+    def peek(self, key):
+        """Return a live record without creating or touching it"""
+        record = self._entries.get(key)
+        if record is None or time.time() - record.last_seen > self.ttl:
+            return None
+        return record
+
+    def __contains__(self, key):
+        return self.peek(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        return list(self._entries.items())
+
+    def clear(self):
+        self._entries.clear()
+
+    def _evict(self, now):
+        entries = self._entries
+        while entries:
+            key, record = next(iter(entries.items()))
+            if now - record.last_seen > self.ttl:
+                entries.popitem(last=False)
+                self.expired += 1
+            elif len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                self.evicted += 1
+            else:
+                break
+
+    def sweep(self):
+        """Drop expired entries without touching anything"""
+        self._evict(time.time())
+
+    def dump(self):
+        """Live records as [key, fields] rows, least recently used first"""
+        self.sweep()
+        rows = []
+        for key, record in self._entries.items():
+            fields = {}
+            for slot in record.__slots__:
+                value = getattr(record, slot)
+                fields[slot] = list(value) if isinstance(value, deque) else value
+            rows.append([list(key) if isinstance(key, tuple) else key, fields])
+        return rows
+
+    def load(self, rows):
+        """Re-insert dumped records, skipping those idle past the TTL; returns how many were kept"""
+        now = time.time()
+        kept = 0
+        for key, fields in rows:
+            if now - fields.get('last_seen', 0) > self.ttl:
+                self.expired += 1
+                continue
+            record = self.record_cls()
+            for slot, value in fields.items():
+                if slot not in record.__slots__:
+                    continue
+                current = getattr(record, slot)
+                if isinstance(current, deque):
+                    current.extend(value)
+                else:
+                    setattr(record, slot, value)
+            key = tuple(key) if isinstance(key, list) else key
+            self._entries[key] = record
+            self._entries.move_to_end(key)
+            kept += 1
+        self._evict(now)
+        return kept
+
+    def estimated_bytes(self):
+        return sum(sys.getsizeof(k) + r.sizeof() for k, r in self._entries.items()) + sys.getsizeof(self._entries)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'capacity': self.max_entries,
+            'estimated_bytes': self.estimated_bytes(),
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+class TrendingView:
+    """Mapping-style access to each chat's trending deque"""
+
+    def __init__(self, chat_state):
+        self.chat_state = chat_state
+
+    def __getitem__(self, chat_id):
+        return self.chat_state[chat_id].trending
+
+_last_state_report = 0.0
+
+def state_stats():
+    """Live entry counts and estimated memory of the runtime state"""
+    rt = get_runtime()
+    return {
+        'chats': rt.chat_state.stats(),
+        'threads': rt.thread_state.stats(),
+        'user_contexts': rt.user_contexts.stats(),
+        'message_cache': len(rt.message_cache),
+    }
+
+def maybe_report_state(now):
+    """Log state sizes at most every STATE_REPORT_INTERVAL seconds"""
+    global _last_state_report
+    if now - _last_state_report < STATE_REPORT_INTERVAL:
+        return
+    _last_state_report = now
+    rt = get_runtime()
+    rt.chat_state.sweep()
+    rt.thread_state.sweep()
+    logger.info("📦 State: %s", state_stats(), extra={'stage': 'report'})
+    logger.info("✍️  Typing plans: %s", rt.typing_planner.stats(), extra={'stage': 'report'})
+    logger.info("🧭 Generation by message class: %s", rt.router.stats(), extra={'stage': 'report'})
+    logger.info("🪣 Reply pool: %s", rt.reply_pool.stats(), extra={'stage': 'report'})
+    logger.info("🚦 Admission: %s", rt.admission.stats(), extra={'stage': 'report'})
+    logger.info("🧵 Pipeline: %s", rt.pipeline.stats(), extra={'stage': 'report'})
+    logger.info("⚖️  Fair queue waits: openai=%s telegram=%s", rt.openai_limiter.stats(), rt.telegram.fair_stats(),
+                extra={'stage': 'report'})
 
 # Moods system with emotional states
 MOODS = ['hype', 'chill', 'mệt', 'tỉnh', 'say nhẹ']
 EMOTIONAL_STATES = ['excited', 'skeptical', 'thoughtful', 'playful', 'confident', 'worried']
 current_mood = {'state': 'chill', 'changed_at': time.time(), 'emotion': 'playful'}
 
-# Track temporary files for cleanup
-temp_files = []
-
-# Topic memory for conversation continuity
-topic_memory = defaultdict(lambda: {'last_topic': None, 'timestamp': 0, 'questions_asked': 0})
-
 def cleanup_temp_files():
     """Clean up temporary files on exit"""
     logger.info("Cleaning up temporary files...")
-    for file_path in temp_files:
+    for file_path in get_runtime().temp_files:
         try:
             if os.path.exists(file_path):
                 os.remove(file_path)
-                logger.info(f"Removed temp file: {file_path}")
+                logger.info("Removed temp file: %s", file_path)
+        except Exception as e:
+            logger.error("Failed to remove %s: %s", file_path, e)
+
+# --- STATE SNAPSHOTS ---
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL = 300  # Seconds between periodic snapshots
+
+class StateSnapshotter:
+    """Saves warm runtime state to a gzipped, versioned JSON file and restores it at startup.
+
+    Covers the reply caches, recent responses, per-chat and per-thread state, the
+    mood, the hourly OpenAI quota, Telegram flood-wait pauses and the reply pools.
+    Anything that went stale while the bot was down is dropped on restore.
+    """
+
+    def __init__(self, path, interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.counters = defaultdict(int)
+        self.last_restore = {}
+        self._task = None
+
+    def capture(self, rt=None):
+        """Plain-data copy of the runtime state, safe to serialize off the event loop"""
+        rt = rt or get_runtime()
+        now = time.monotonic()
+        rt.message_cache.expire()
+        rt.reply_alternatives.expire()
+        return {
+            'version': SNAPSHOT_VERSION,
+            'saved_at': time.time(),
+            'message_cache': [[key, value] for key, value in rt.message_cache.items()],
+            'reply_alternatives': [[key, list(values)] for key, values in rt.reply_alternatives.items()],
+            'recent_responses': list(rt.recent_responses),
+            'chats': rt.chat_state.dump(),
+            'threads': rt.thread_state.dump(),
+            'mood': dict(current_mood),
+            'quota': dict(getattr(check_openai_quota, 'hourly_calls', {})),
+            'pauses': [[action, chat_id, until - now]
+                       for (action, chat_id), until in rt.telegram.paused_until.items() if until > now],
+            'reply_pool': [[list(bucket), [list(entry) for entry in entries]]
+                           for bucket, entries in rt.reply_pool.buckets.items()],
+        }
+
+    def apply(self, data, rt=None):
+        """Restore captured state into the runtime, expiring stale entries; returns restored counts"""
+        rt = rt or get_runtime()
+        now = time.time()
+        age = max(0.0, now - data.get('saved_at', 0))
+        restored = {}
+        # TTLCache can't take a per-entry expiry, so caches only survive a restart
+        # shorter than their TTL (and then start a fresh TTL)
+        if age < rt.message_cache.ttl:
+            for key, value in data.get('message_cache', []):
+                rt.message_cache[key] = value
+            for key, values in data.get('reply_alternatives', []):
+                rt.reply_alternatives[key] = values
+        restored['cached'] = len(rt.message_cache) + len(rt.reply_alternatives)
+        rt.recent_responses.extend(data.get('recent_responses', []))
+        restored['chats'] = rt.chat_state.load(data.get('chats', []))
+        restored['threads'] = rt.thread_state.load(data.get('threads', []))
+        if data.get('mood'):
+            current_mood.update(data['mood'])
+        quota = data.get('quota') or {}
+        if age < 3600 and f"quota_{datetime.datetime.now().hour}" in quota:
+            check_openai_quota.hourly_calls = dict(quota)
+            restored['quota_calls'] = sum(quota.values())
+        restored['pauses'] = 0
+        for action, chat_id, remaining in data.get('pauses', []):
+            if remaining > age and action in rt.telegram.limits:
+                rt.telegram.pause(action, chat_id, remaining - age)
+                restored['pauses'] += 1
+        restored['pooled'] = 0
+        for bucket, entries in data.get('reply_pool', []):
+            live = [tuple(entry) for entry in entries if entry[0] > now]
+            if live:
+                rt.reply_pool.buckets[tuple(bucket)] = live
+                restored['pooled'] += len(live)
+        return restored
+
+    def _write(self, data):
+        tmp_path = f"{self.path}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.path)  # Readers never see a half-written snapshot
+        return os.path.getsize(self.path)
+
+    def save(self, rt=None):
+        """Write a snapshot now (used at exit); returns its size in bytes, 0 if disabled or failed"""
+        if not self.path:
+            return 0
+        try:
+            size = self._write(self.capture(rt))
+        except Exception as e:
+            logger.error("Failed to save state snapshot: %s", e)
+            return 0
+        self.counters['saves'] += 1
+        self.counters['bytes'] = size
+        return size
+
+    def restore(self, rt=None):
+        """Load the snapshot file into the runtime and log how long it took"""
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        started = time.perf_counter()
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != SNAPSHOT_VERSION:
+                logger.warning("Ignoring state snapshot version %s (expected %s)",
+                               data.get('version'), SNAPSHOT_VERSION)
+                return {}
+            restored = self.apply(data, rt)
         except Exception as e:
-            logger.error(f"Failed to remove {file_path}: {e}")
+            logger.error("Failed to restore state snapshot: %s", e)
+            return {}
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        age = max(0.0, time.time() - data.get('saved_at', 0))
+        self.last_restore = {**restored, 'age_s': round(age), 'restore_ms': round(elapsed_ms, 1)}
+        logger.info("♻️ Restored state snapshot (%.0fs old) in %.1fms: %s", age, elapsed_ms, restored)
+        return restored
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Capture on the loop for a consistent view, serialize and write off it
+                size = await loop.run_in_executor(None, self._write, self.capture())
+                self.counters['saves'] += 1
+                self.counters['bytes'] = size
+            except Exception as e:
+                self.counters['failures'] += 1
+                logger.error("Periodic state snapshot failed: %s", e)
+
+    def start(self):
+        if self._task is None and self.path:
+            self._task = asyncio.ensure_future(self.run())
 
-# Register cleanup function
-atexit.register(cleanup_temp_files)
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {**self.counters, 'last_restore': self.last_restore}
 
 # Database persistence functions
 def save_trending_to_db(chat_id, word):
     """Save trending topic to database"""
     try:
-        db_session = Session()
-        topic = TrendingTopic(chat_id=chat_id, word=word, timestamp=time.time())
-        db_session.add(topic)
-        db_session.commit()
-        db_session.close()
+        import teoembot_db
+        with get_runtime().new_session() as db_session:
+            teoembot_db.add_trending_rows(db_session, chat_id, [word], time.time())
+            db_session.commit()
     except Exception as e:
-        logger.error(f"Failed to save trending topic: {e}")
+        logger.error("Failed to save trending topic: %s", e)
 
 def load_trending_from_db(chat_id, hours=1):
     """Load recent trending topics from database"""
     try:
-        db_session = Session()
-        cutoff = time.time() - (hours * 3600)
-        topics = db_session.query(TrendingTopic).filter(
-            TrendingTopic.chat_id == chat_id,
-            TrendingTopic.timestamp > cutoff
-        ).all()
-        db_session.close()
-        return [t.word for t in topics]
+        import teoembot_db
+        with get_runtime().new_session() as db_session:
+            return teoembot_db.query_trending_words(db_session, chat_id, time.time() - (hours * 3600))
     except Exception as e:
-        logger.error(f"Failed to load trending topics: {e}")
+        logger.error("Failed to load trending topics: %s", e)
         return []
 
 def save_user_context_to_db(chat_id, user_id, context):
     """Save user context to database"""
     try:
-        db_session = Session()
-        user_ctx = db_session.query(UserContext).filter_by(
-            chat_id=chat_id, user_id=user_id
-        ).first()
+        import teoembot_db
+        with get_runtime().new_session() as db_session:
+            teoembot_db.store_user_context(db_session, chat_id, user_id, context)
+            db_session.commit()
+    except Exception as e:
+        logger.error("Failed to save user context: %s", e)
+
+async def load_trending_from_db_async(chat_id, hours=1):
+    """Load recent trending topics without blocking the event loop"""
+    try:
+        import teoembot_db
+        return await get_runtime().db.read(teoembot_db.query_trending_words, chat_id, time.time() - (hours * 3600))
+    except Exception as e:
+        logger.error("Failed to load trending topics: %s", e)
+        return []
+
+def new_user_context():
+    return {
+        'last_topic': None,
+        'sentiment': 'neutral',
+        'last_interaction': 0,
+        'interaction_count': 0
+    }
+
+class _EvictingLRUCache(LRUCache):
+    """LRUCache that reports evicted entries"""
+
+    def __init__(self, maxsize, on_evict):
+        super().__init__(maxsize)
+        self._on_evict = on_evict
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._on_evict(key, value)
+        return key, value
+
+class UserContextStore:
+    """Write-back cache of per-user context.
+
+    Records are loaded from SQLite on first access and kept in a bounded LRU map.
+    Updates only mark the record dirty; a background task flushes dirty records
+    in batched upserts, so per-message tracking costs a dict lookup.
+    """
+
+    def __init__(self, database, maxsize=5000, flush_interval=30):
+        self.database = database
+        self.flush_interval = flush_interval
+        self._records = _EvictingLRUCache(maxsize, self._on_evict)
+        self._dirty = set()
+        self._evicted_dirty = {}  # dirty records pushed out of the LRU, flushed next round
+        self._loading = {}
+        self._flush_task = None
+        self._loop = None
+        self.loads = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+
+    def _on_evict(self, key, record):
+        if key in self._dirty:
+            self._dirty.discard(key)
+            self._evicted_dirty[key] = record
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._flush_task is None or self._loop is not loop or self._flush_task.done():
+            self._loop = loop
+            self._flush_task = loop.create_task(self._flush_loop())
+
+    async def get(self, chat_id, user_id):
+        """Return the live record, loading it from the database on first access"""
+        key = (chat_id, user_id)
+        record = self._records.get(key)
+        if record is not None:
+            return record
+        if key in self._evicted_dirty:
+            record = self._evicted_dirty.pop(key)
+            self._records[key] = record
+            self._dirty.add(key)
+            return record
+        
+        pending = self._loading.get(key)
+        if pending is None:
+            import teoembot_db
+            pending = asyncio.ensure_future(self.database.read(teoembot_db.load_user_context, chat_id, user_id))
+            self._loading[key] = pending
+        try:
+            loaded = await pending
+        except Exception as e:
+            logger.error("Failed to load user context: %s", e)
+            loaded = None
+        finally:
+            self._loading.pop(key, None)
         
-        if user_ctx:
-            user_ctx.last_topic = context.get('last_topic')
-            user_ctx.sentiment = context.get('sentiment')
-            user_ctx.last_interaction = context.get('last_interaction')
-            user_ctx.interaction_count = context.get('interaction_count')
-            user_ctx.context_data = context
+        record = self._records.get(key)
+        if record is None:
+            record = new_user_context()
+            if loaded:
+                record.update(loaded)
+            self._records[key] = record
+            self.loads += 1
+        return record
+
+    async def record_interaction(self, chat_id, user_id, sentiment, topic=None):
+        """Track one message from a user; persisted by the next flush"""
+        self._ensure_flusher()
+        record = await self.get(chat_id, user_id)
+        record['sentiment'] = sentiment
+        if topic:
+            record['last_topic'] = topic
+        record['last_interaction'] = time.time()
+        record['interaction_count'] = (record.get('interaction_count') or 0) + 1
+        self._dirty.add((chat_id, user_id))
+        return record
+
+    async def flush(self):
+        """Write all dirty records in one batched upsert"""
+        if not self._dirty and not self._evicted_dirty:
+            return 0
+        batch = dict(self._evicted_dirty)
+        self._evicted_dirty.clear()
+        for key in self._dirty:
+            if key in self._records:
+                batch[key] = self._records[key]
+        self._dirty.clear()
+        import teoembot_db
+        rows = [teoembot_db.user_context_row(chat_id, user_id, record) for (chat_id, user_id), record in batch.items()]
+        try:
+            await self.database.write(teoembot_db.upsert_user_contexts, rows)
+        except Exception as e:
+            logger.error("Failed to flush user contexts: %s", e)
+            # Keep them dirty for the next attempt
+            for key, record in batch.items():
+                if key in self._records:
+                    self._dirty.add(key)
+                else:
+                    self._evicted_dirty[key] = record
+            return 0
+        self.flushes += 1
+        self.rows_flushed += len(rows)
+        return len(rows)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        """Stop the periodic flush and persist what is left"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            'cached': len(self._records),
+            'dirty': len(self._dirty) + len(self._evicted_dirty),
+            'loads': self.loads,
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed,
+        }
+
+# --- FAIR SCHEDULING ---
+FAIR_SHARE_WINDOW = 50  # Recent grants used to check minimum shares
+
+# Chat whose message the current task is handling; background work has None
+current_chat = contextvars.ContextVar('current_chat', default=None)
+
+def parse_chat_weights(text):
+    """{chat_id: (weight, min_share)} from CHAT_WEIGHTS JSON; invalid input gives {}"""
+    if not text:
+        return {}
+    try:
+        raw = json.loads(text)
+        weights = {}
+        for chat_id, spec in raw.items():
+            if isinstance(spec, dict):
+                weights[int(chat_id)] = (float(spec.get('weight', 1)), float(spec.get('min_share', 0)))
+            else:
+                weights[int(chat_id)] = (float(spec), 0.0)
+        return weights
+    except Exception as e:
+        logger.error("Invalid CHAT_WEIGHTS, using equal weights: %s", e)
+        return {}
+
+class FairLimiter:
+    """Hands out an AsyncLimiter's tokens to chats by weighted fair queueing.
+
+    While tokens are free, acquire() is a plain limiter acquire. Once callers
+    have to wait, each gets a virtual finish tag (start + 1/weight, start
+    no earlier than its chat's previous tag) and tokens go to the smallest tag,
+    so a busy chat queues behind itself instead of in front of quieter ones.
+    Chats below their min_share of the last FAIR_SHARE_WINDOW grants go first.
+    """
+
+    def __init__(self, inner, weights=None, default_weight=1.0):
+        self.inner = inner
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.max_rate = inner.max_rate
+        self.time_period = inner.time_period
+        self._heap = []  # [finish, seq, start, chat_id, future, enqueued_at]
+        self._seq = 0
+        self._vtime = 0.0
+        self._last_finish = {}
+        self._recent = deque(maxlen=FAIR_SHARE_WINDOW)
+        self._waits = defaultdict(lambda: [0, 0.0, 0.0])  # chat -> [grants, total wait, max wait]
+        self._task = None
+
+    @property
+    def waiting(self):
+        return sum(1 for entry in self._heap if not entry[4].done())
+
+    def has_capacity(self, amount=1):
+        return not self.waiting and self.inner.has_capacity(amount)
+
+    def _record(self, chat_id, waited):
+        self._recent.append(chat_id)
+        stats = self._waits[chat_id]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    async def acquire(self, amount=1, chat_id=None):
+        if chat_id is None:
+            chat_id = current_chat.get()
+        if not self.waiting and self.inner.has_capacity(amount):
+            await self.inner.acquire(amount)
+            self._record(chat_id, 0.0)
+            return True
+        weight, _ = self.weights.get(chat_id, (self.default_weight, 0.0))
+        start = max(self._vtime, self._last_finish.get(chat_id, 0.0))
+        finish = self._last_finish[chat_id] = start + amount / max(weight, 1e-6)
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._heap, [finish, self._seq, start, chat_id, future, time.monotonic()])
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._dispatch())
+        await future
+        return True
+
+    def _below_min_share(self):
+        """Queued entry of the chat furthest below its guaranteed share, if any"""
+        if not self._recent:
+            return None
+        best, best_gap = None, 0.0
+        for entry in self._heap:
+            chat_id = entry[3]
+            min_share = self.weights.get(chat_id, (0, 0.0))[1]
+            if not min_share or entry[4].done():
+                continue
+            gap = min_share - self._recent.count(chat_id) / len(self._recent)
+            if gap > best_gap or (gap == best_gap and best is not None and entry < best):
+                best, best_gap = entry, gap
+        return best
+
+    def _pop_next(self):
+        while self._heap and self._heap[0][4].done():
+            heapq.heappop(self._heap)  # Cancelled waiters
+        if not self._heap:
+            return None
+        entry = self._below_min_share()
+        if entry is None:
+            return heapq.heappop(self._heap)
+        self._heap.remove(entry)
+        heapq.heapify(self._heap)
+        return entry
+
+    async def _dispatch(self):
+        try:
+            while self.waiting:
+                await self.inner.acquire()
+                entry = self._pop_next()
+                if entry is None:
+                    break  # Everyone left; the token is simply unused
+                finish, _, start, chat_id, future, enqueued_at = entry
+                self._vtime = start
+                future.set_result(None)
+                self._record(chat_id, time.monotonic() - enqueued_at)
+        finally:
+            self._task = None
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return None
+
+    def stats(self):
+        """Grants and queue wait per chat"""
+        queued = defaultdict(int)
+        for entry in self._heap:
+            if not entry[4].done():
+                queued[entry[3]] += 1
+        return {
+            chat_id: {'grants': grants, 'avg_wait_ms': round(total / grants * 1000, 1),
+                      'max_wait_ms': round(worst * 1000, 1), 'queued': queued.get(chat_id, 0)}
+            for chat_id, (grants, total, worst) in self._waits.items()
+        }
+
+# --- OUTBOUND SCHEDULER ---
+# Per-minute token budgets per action type: (all chats, single chat).
+# Each action type has its own buckets, so reactions and typing never use up reply capacity.
+TELEGRAM_ACTION_LIMITS = {
+    'send': (20, 8),
+    'edit': (10, 4),
+    'media': (6, 3),
+    'reaction': (10, 4),
+    'typing': (20, 6),
+}
+FLOOD_WAIT_MAX_SECONDS = 300  # Longer waits drop the action instead of retrying
+
+def flood_wait_seconds(exc):
+    """Seconds Telegram asked us to wait (FloodWait / slow mode), or None for other errors"""
+    from telethon import errors
+    if isinstance(exc, (errors.FloodWaitError, errors.FloodPremiumWaitError, errors.SlowModeWaitError)):
+        return exc.seconds
+    return None
+
+HEADROOM_STEPS = 8  # Bisection steps in limiter_headroom (resolution 1/256)
+
+def limiter_headroom(limiter):
+    """Free fraction (0..1) of an AsyncLimiter's burst capacity; 0 while a FairLimiter has a queue.
+
+    Found by bisecting the amount passed to the public has_capacity(), rather
+    than reading the limiter's private bucket level.
+    """
+    if isinstance(limiter, FairLimiter):
+        return 0.0 if limiter.waiting else limiter_headroom(limiter.inner)
+    low, high = 0.0, 1.0
+    if limiter.has_capacity(limiter.max_rate):
+        return 1.0
+    for _ in range(HEADROOM_STEPS):
+        middle = (low + high) / 2
+        if limiter.has_capacity(limiter.max_rate * middle):
+            low = middle
         else:
-            user_ctx = UserContext(
-                chat_id=chat_id,
-                user_id=user_id,
-                last_topic=context.get('last_topic'),
-                sentiment=context.get('sentiment'),
-                last_interaction=context.get('last_interaction'),
-                interaction_count=context.get('interaction_count'),
-                context_data=context
+            high = middle
+    return low
+
+class TelegramScheduler:
+    """Runs outbound Telegram calls through per-action, per-chat token buckets.
+
+    A flood wait pauses only its (action, chat) scope for the time Telegram asks
+    for, then the call is retried. Optional calls (wait=False) are skipped rather
+    than queued when their budget is used up or their scope is paused.
+    """
+
+    def __init__(self, limits=None, max_chats=2000, max_flood_wait=FLOOD_WAIT_MAX_SECONDS, max_retries=2,
+                 weights=None):
+        self.limits = dict(limits or TELEGRAM_ACTION_LIMITS)
+        # Global budgets are shared fairly between chats; per-chat budgets cap each one
+        self.global_limiters = {action: FairLimiter(AsyncLimiter(rates[0], 60), weights)
+                                for action, rates in self.limits.items()}
+        self.chat_limiters = LRUCache(maxsize=max_chats * len(self.limits))
+        self.paused_until = {}  # (action, chat_id) -> time.monotonic() deadline
+        self.max_flood_wait = max_flood_wait
+        self.max_retries = max_retries
+        self.pending = 0
+        self.counters = defaultdict(int)
+
+    def _chat_limiter(self, action, chat_id):
+        key = (action, chat_id)
+        limiter = self.chat_limiters.get(key)
+        if limiter is None:
+            limiter = self.chat_limiters[key] = AsyncLimiter(self.limits[action][1], 60)
+        return limiter
+
+    def pause(self, action, chat_id, seconds):
+        """Hold every call of `action` in `chat_id` for `seconds`"""
+        key = (action, chat_id)
+        self.paused_until[key] = max(self.paused_until.get(key, 0), time.monotonic() + seconds)
+
+    def pause_remaining(self, action, chat_id):
+        key = (action, chat_id)
+        until = self.paused_until.get(key)
+        if until is None:
+            return 0.0
+        remaining = until - time.monotonic()
+        if remaining <= 0:
+            del self.paused_until[key]
+            return 0.0
+        return remaining
+
+    def has_capacity(self, action, chat_id):
+        return (not self.pause_remaining(action, chat_id)
+                and self.global_limiters[action].has_capacity()
+                and self._chat_limiter(action, chat_id).has_capacity())
+
+    def headroom(self, action, chat_id=None):
+        """Free fraction of the tighter of the global and per-chat buckets; 0 while paused"""
+        room = limiter_headroom(self.global_limiters[action])
+        if chat_id is not None:
+            if self.pause_remaining(action, chat_id):
+                return 0.0
+            room = min(room, limiter_headroom(self._chat_limiter(action, chat_id)))
+        return room
+
+    async def run(self, action, chat_id, fn, *args, wait=True, **kwargs):
+        """Await fn(*args, **kwargs) within the budget of `action` in `chat_id`.
+
+        Returns fn's result, or None when wait=False and there is no capacity.
+        Flood waits longer than max_flood_wait, or past max_retries, are re-raised.
+        """
+        if not wait and not self.has_capacity(action, chat_id):
+            self.counters[f'{action}_skipped'] += 1
+            return None
+        
+        self.pending += 1
+        try:
+            attempt = 0
+            while True:
+                remaining = self.pause_remaining(action, chat_id)
+                if remaining:
+                    await asyncio.sleep(remaining)
+                # Own budget first, so a chat never holds a global token it can't use yet
+                await self._chat_limiter(action, chat_id).acquire()
+                await self.global_limiters[action].acquire(chat_id=chat_id)
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    seconds = flood_wait_seconds(e)
+                    if seconds is None:
+                        raise
+                    self.counters[f'{action}_flood_waits'] += 1
+                    self.pause(action, chat_id, seconds)
+                    logger.warning("⏳ Flood wait %ss for %s in chat %s", seconds, action, chat_id)
+                    if seconds > self.max_flood_wait or attempt >= self.max_retries:
+                        self.counters[f'{action}_dropped'] += 1
+                        raise
+                    attempt += 1
+                    continue
+                self.counters[f'{action}_calls'] += 1
+                return result
+        finally:
+            self.pending -= 1
+
+    def stats(self):
+        """Call/flood-wait/skip counters, queue depth and currently paused scopes"""
+        paused = [key for key in list(self.paused_until) if self.pause_remaining(*key)]
+        return {'pending': self.pending, 'paused_scopes': len(paused), **self.counters}
+
+    def fair_stats(self):
+        """Queue wait per chat for each action's global budget"""
+        return {action: limiter.stats() for action, limiter in self.global_limiters.items() if limiter.stats()}
+
+# --- OUTBOX ---
+class Outbox:
+    """Durable per-chat delivery queue for replies, stickers and reactions.
+
+    Items are written to the outbox table before delivery, then sent in order by
+    one worker task per chat with retries. The table's unique (chat, source
+    message, kind) index drops duplicates; recover() re-queues pending items
+    after a restart and expires those older than max_age.
+
+    An item is marked 'sending' before its first send. close() lets each chat's
+    current item finish; one still cut off (e.g. mid typo-and-correction) is
+    marked interrupted at the next start instead of being sent again from scratch.
+    """
+
+    def __init__(self, database, deliver, max_age=120, max_attempts=3, retry_delay=2.0, close_timeout=10.0):
+        self.database = database
+        self.deliver = deliver
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.close_timeout = close_timeout
+        self.closing = False
+        self.queues = {}   # chat_id -> deque of pending items
+        self.workers = {}  # chat_id -> delivery task
+        self.counters = defaultdict(int)
+
+    async def enqueue(self, chat_id, kind, payload, source_msg_id=None):
+        """Persist an item and schedule its delivery; returns its id, or None for a duplicate"""
+        import teoembot_db
+        created_at = time.time()
+        item_id = await self.database.write(
+            teoembot_db.add_outbox_item, chat_id, kind, payload, source_msg_id, created_at
+        )
+        if item_id is None:
+            self.counters['duplicates'] += 1
+            debug_log("Outbox duplicate: %s for msg %s", kind, source_msg_id, stage='deliver')
+            return None
+        self._push({'id': item_id, 'chat_id': chat_id, 'kind': kind, 'payload': payload,
+                    'source_msg_id': source_msg_id, 'created_at': created_at, 'attempts': 0})
+        return item_id
+
+    def _push(self, item):
+        chat_id = item['chat_id']
+        self.queues.setdefault(chat_id, deque()).append(item)
+        self.counters['queued'] += 1
+        if chat_id not in self.workers and not self.closing:
+            self.workers[chat_id] = asyncio.ensure_future(self._worker(chat_id))
+
+    async def _worker(self, chat_id):
+        import teoembot_db
+        queue = self.queues[chat_id]
+        try:
+            while queue and not self.closing:
+                item = queue[0]
+                try:
+                    await self.database.write(teoembot_db.set_outbox_status, item['id'],
+                                              teoembot_db.OUTBOX_SENDING, item['attempts'])
+                except Exception as e:
+                    logger.warning("Outbox could not mark item %s as sending: %s", item['id'], e)
+                status = await self._deliver_with_retry(item)
+                queue.popleft()
+                self.database.write_nowait(teoembot_db.set_outbox_status, item['id'], status, item['attempts'])
+        finally:
+            # No await between the last emptiness check and this cleanup, so a
+            # concurrent _push either lands in the queue above or starts a new worker
+            self.workers.pop(chat_id, None)
+            if not queue:
+                self.queues.pop(chat_id, None)
+
+    async def _deliver_with_retry(self, item):
+        import teoembot_db
+        while True:
+            item['attempts'] += 1
+            try:
+                await self.deliver(item)
+                self.counters['sent'] += 1
+                return teoembot_db.OUTBOX_SENT
+            except Exception as e:
+                logger.warning("Outbox %s to %s failed (attempt %s): %s",
+                               item['kind'], item['chat_id'], item['attempts'], e)
+                if item['attempts'] >= self.max_attempts:
+                    self.counters['failed'] += 1
+                    return teoembot_db.OUTBOX_FAILED
+                await asyncio.sleep(self.retry_delay * item['attempts'])
+
+    async def recover(self):
+        """Expire stale pending items and re-queue the rest; call once at startup"""
+        import teoembot_db
+        now = time.time()
+        interrupted = await self.database.write(teoembot_db.interrupt_outbox_items)
+        expired = await self.database.write(teoembot_db.expire_outbox_items, now - self.max_age)
+        await self.database.write(teoembot_db.prune_outbox_items, now - 86400)
+        items = await self.database.read(teoembot_db.load_pending_outbox_items)
+        for item in items:
+            self._push(item)
+        self.counters['expired'] += expired
+        self.counters['interrupted'] += interrupted
+        logger.info("📬 Outbox recovered %s pending item(s), expired %s, skipped %s interrupted",
+                    len(items), expired, interrupted)
+        return len(items)
+
+    async def close(self):
+        """Stop delivery once each chat's current item is done; items not started stay pending"""
+        self.closing = True
+        workers = list(self.workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=self.close_timeout)
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def stats(self):
+        return {'pending': sum(len(q) for q in self.queues.values()), 'chats': len(self.workers), **self.counters}
+
+# --- ADMISSION CONTROL ---
+ADMISSION_INTERVAL = 5.0  # Seconds between pressure checks
+MAX_INFLIGHT_HANDLERS = 20
+ADMISSION_HIGH = 0.8  # Pressure that halves the admission factor
+ADMISSION_LOW = 0.5  # Pressure below which the factor recovers
+ADMISSION_STEP = 0.1  # Additive recovery per check
+ADMISSION_MIN_FACTOR = 0.1
+LOOP_LAG_LIMIT = 0.5  # Seconds of event-loop lag counted as full pressure
+QUOTA_BURN_LIMIT = 1.5  # Quota burn (vs. an even spread over the hour) counted as full pressure
+
+class AdmissionController:
+    """Adapts how much optional work the bot accepts to how loaded it is.
+
+    Every ADMISSION_INTERVAL seconds the pressure signals (limiter headroom,
+    quota burn rate, in-flight handlers, event-loop lag) are combined into one
+    0..1+ value. High pressure halves `factor`, which scales the trigger and
+    reaction probabilities and stretches the per-thread rate limit; saturation
+    switches untargeted replies to reactions. Low pressure restores the factor
+    step by step. Handlers beyond max_inflight are shed outright.
+    """
+
+    def __init__(self, max_inflight=MAX_INFLIGHT_HANDLERS, interval=ADMISSION_INTERVAL):
+        self.max_inflight = max_inflight
+        self.interval = interval
+        self.factor = 1.0
+        self.reaction_only = False
+        self.inflight = 0
+        self.loop_lag = 0.0
+        self.last_signals = {}
+        self.counters = defaultdict(int)
+        self._task = None
+
+    def enter(self):
+        """Take a handler slot; False means the message should be dropped"""
+        if self.inflight >= self.max_inflight:
+            self.counters['shed'] += 1
+            return False
+        self.inflight += 1
+        return True
+
+    def leave(self):
+        self.inflight -= 1
+
+    def trigger_probability(self):
+        return TRIGGER_PROBABILITY * self.factor
+
+    def reaction_probability(self):
+        return REACTION_PROBABILITY * self.factor
+
+    def rate_limit_seconds(self):
+        return RATE_LIMIT_SECONDS / self.factor
+
+    def signals(self):
+        """Each pressure source scaled so 1.0 means 'at the limit'"""
+        rt = get_runtime()
+        now = datetime.datetime.now()
+        used = sum(getattr(check_openai_quota, 'hourly_calls', {}).values())
+        # Expected use so far if the quota were spread evenly over the hour (at least 10% of it)
+        expected = OPENAI_HOURLY_QUOTA * max((now.minute * 60 + now.second) / 3600, 0.1)
+        return {
+            'openai': round(1 - limiter_headroom(rt.openai_limiter), 3),
+            'telegram': round(1 - rt.telegram.headroom('send'), 3),
+            'quota': round(used / expected / QUOTA_BURN_LIMIT, 3),
+            'inflight': round(self.inflight / self.max_inflight, 3),
+            'loop_lag': round(self.loop_lag / LOOP_LAG_LIMIT, 3),
+        }
+
+    def adjust(self, signals=None):
+        """One feedback step: multiplicative decrease under pressure, additive recovery otherwise"""
+        signals = self.signals() if signals is None else signals
+        self.last_signals = signals
+        pressure = max(signals.values()) if signals else 0.0
+        factor, reaction_only = self.factor, self.reaction_only
+        if pressure >= ADMISSION_HIGH:
+            self.factor = max(ADMISSION_MIN_FACTOR, self.factor * 0.5)
+            if pressure >= 1.0 or self.factor <= ADMISSION_MIN_FACTOR:
+                self.reaction_only = True
+        elif pressure < ADMISSION_LOW:
+            self.factor = min(1.0, self.factor + ADMISSION_STEP)
+            if self.factor >= 0.5:
+                self.reaction_only = False
+        if (self.factor, self.reaction_only) != (factor, reaction_only):
+            decreased = self.factor < factor or (self.reaction_only and not reaction_only)
+            self.counters['decreases' if decreased else 'increases'] += 1
+            logger.info(
+                "🚦 Admission factor %.2f -> %.2f%s (pressure %.2f: %s)",
+                factor, self.factor, ', reaction-only' if self.reaction_only else '', pressure, signals,
+                extra={'stage': 'admission', 'factor': self.factor, 'reaction_only': self.reaction_only,
+                       'pressure': pressure, 'signals': signals},
             )
-            db_session.add(user_ctx)
+        return self.factor
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.loop_lag = max(0.0, loop.time() - expected)
+            try:
+                self.adjust()
+            except Exception as e:
+                logger.error("Admission control error: %s", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {
+            'factor': round(self.factor, 2),
+            'reaction_only': self.reaction_only,
+            'inflight': self.inflight,
+            'loop_lag_ms': round(self.loop_lag * 1000, 1),
+            'signals': self.last_signals,
+            **self.counters,
+        }
+
+# --- BOT RUNTIME ---
+class BotRuntime:
+    """Owns config, database, clients, caches and limiters for one bot process.
+
+    Construction is cheap: the database engine, API clients and the encryption
+    cipher are only created when first used. Outbound Telegram calls go through
+    `telegram` (a TelegramScheduler).
+    """
+
+    def __init__(self, config=None):
+        self.config = config or BotConfig.from_env()
+        cfg = self.config
+        self._session_factory = None
+        self._cipher = None
+        self._ai_client = None
+        self._tg_client = None
+        self._backends = None
+        self._archive_task = None
         
-        db_session.commit()
-        db_session.close()
-    except Exception as e:
-        logger.error(f"Failed to save user context: {e}")
+        self.db = AsyncDatabase(self.new_session)
+        self.user_contexts = UserContextStore(self.db)
+        # Split the memory budget between per-chat and per-thread state
+        budget = cfg.state_memory_limit_mb * 1024 * 1024
+        self.chat_state = StateStore(ChatState, cfg.state_chat_ttl, cfg.state_max_entries, max_bytes=budget * 0.25)
+        self.thread_state = StateStore(ThreadState, cfg.state_thread_ttl, cfg.state_max_entries, max_bytes=budget * 0.75)
+        self.trending_topics = TrendingView(self.chat_state)
+        self.phrase_bank = PhraseBank(cfg.phrases_file or PHRASES_FILE)
+        self.message_cache = TTLCache(maxsize=100, ttl=600)  # 100 items, 10 min TTL
+        self.reply_alternatives = TTLCache(maxsize=200, ttl=600)  # Unused reranked candidates per message
+        self.recent_responses = deque(maxlen=10)  # Track recent responses to avoid repetition
+        self.temp_files = []  # Track temporary files for cleanup
+        chat_weights = parse_chat_weights(cfg.chat_weights)
+        self.telegram = TelegramScheduler(weights=chat_weights)
+        self.typing_planner = TypingPlanner(self.telegram)
+        self.outbox = Outbox(self.db, deliver_outbox_item, max_age=cfg.outbox_max_age)
+        # 10 API calls per minute, shared fairly between chats
+        self.openai_limiter = FairLimiter(AsyncLimiter(max_rate=10, time_period=60), chat_weights)
+        self.openai_flights = SingleFlight()  # Collapses identical in-flight OpenAI requests
+        self.local_generator = MarkovGenerator()
+        self.router = Router(cfg.routes_file)
+        self.reply_pool = ReplyPool()
+        self.snapshots = StateSnapshotter(cfg.snapshot_file)
+        self.tracer = Tracer(cfg.trace_file)
+        self.admission = AdmissionController()
+        self.backlog = BacklogHandler(cfg.backlog_stale_seconds, handler)
+        self.albums = AlbumCollector()
+        self.pipeline = Pipeline(MESSAGE_STAGES)
+        self.me = None  # The bot's own Telegram user, cached by get_self()
+
+    @property
+    def session_factory(self):
+        if self._session_factory is None:
+            import teoembot_db
+            _, self._session_factory = teoembot_db.open_database(self.config.db_url)
+        return self._session_factory
+
+    def new_session(self):
+        return self.session_factory()
+
+    @property
+    def cipher(self):
+        if self._cipher is None:
+            from cryptography.fernet import Fernet
+            self._cipher = Fernet(get_encryption_key(self.config.encryption_key_file))
+        return self._cipher
+
+    def _secret(self, value):
+        if value and value.startswith('ENC:'):
+            return decrypt_env_value(value, self.cipher)
+        return value
+
+    @property
+    def openai_api_key(self):
+        return self._secret(self.config.openai_api_key)
+
+    def backend_api_key(self, env_name):
+        """Key of a GENERATION_BACKENDS entry, by the api_key_env name it gives"""
+        return self._secret(self.config.backend_api_keys.get(env_name))
+
+    def get_ai_client(self):
+        if self._ai_client is None:
+            api_key = self.openai_api_key
+            if not api_key:
+                logger.warning("OpenAI API key not set, using mock client")
+                return None
+            from openai import AsyncOpenAI
+            self._ai_client = AsyncOpenAI(api_key=api_key)
+        return self._ai_client
+
+    @property
+    def backends(self):
+        """BackendRegistry built from config on first use"""
+        if self._backends is None:
+            self._backends = build_backends(self)
+        return self._backends
+
+    def get_telegram_client(self):
+        if self._tg_client is None:
+            from telethon import TelegramClient
+            self._tg_client = TelegramClient(self.config.session_name, self.config.api_id, self.config.api_hash)
+        return self._tg_client
+
+    @property
+    def telegram_client(self):
+        """The Telegram client if it has been created, else None"""
+        return self._tg_client
+
+    async def start(self):
+        """Startup work that needs the event loop: outbox recovery and background loops"""
+        await self.outbox.recover()
+        self.reply_pool.start()
+        self.snapshots.start()
+        self.admission.start()
+        if self.config.archive_retention_days > 0 and self._archive_task is None:
+            self._archive_task = asyncio.ensure_future(archive_prune_loop(self.config.archive_retention_days))
+
+    async def close(self):
+        """Persist cached state and drain queued DB writes"""
+        if self._archive_task is not None:
+            self._archive_task.cancel()
+            await asyncio.gather(self._archive_task, return_exceptions=True)
+            self._archive_task = None
+        await self.admission.close()
+        await self.backlog.close()
+        await self.snapshots.close()
+        await self.reply_pool.close()
+        await self.outbox.close()
+        await self.user_contexts.close()
+        await self.db.close()
+        self.tracer.close()
+
+_runtime = None
+
+def get_runtime():
+    """Process-wide BotRuntime, created with default settings on first use"""
+    global _runtime
+    if _runtime is None:
+        _runtime = BotRuntime()
+    return _runtime
+
+def set_runtime(runtime):
+    """Install a runtime (e.g. one built with a custom BotConfig); returns the previous one"""
+    global _runtime
+    previous, _runtime = _runtime, runtime
+    return previous
+
+def create_runtime(config=None):
+    """App factory: load .env, set up logging and install a new BotRuntime"""
+    from dotenv import load_dotenv
+    load_dotenv()
+    config = config or BotConfig.from_env()
+    setup_logging(config.log_file, config.log_level, config.log_max_bytes, config.log_backup_count)
+    runtime = BotRuntime(config)
+    set_runtime(runtime)
+    runtime.snapshots.restore(runtime)
+    atexit.register(cleanup_temp_files)
+    atexit.register(runtime.snapshots.save, runtime)
+    return runtime
+
+# Module attributes that live on the runtime (PEP 562), kept for existing callers
+_RUNTIME_ATTRIBUTES = {
+    'db', 'user_contexts', 'chat_state', 'thread_state', 'trending_topics', 'phrase_bank',
+    'message_cache', 'recent_responses', 'temp_files', 'telegram', 'openai_limiter',
+}
+
+def __getattr__(name):
+    if name in _RUNTIME_ATTRIBUTES:
+        return getattr(get_runtime(), name)
+    if name == 'TRENDING_PHRASES':
+        return get_runtime().phrase_bank.current().data
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def validate_message_input(text):
     """Validate message input to prevent injection"""
@@ -300,7 +1851,7 @@ def validate_message_input(text):
     text_lower = text.lower()
     for pattern in suspicious_patterns:
         if re.search(pattern, text_lower):
-            logger.warning(f"Suspicious pattern detected: {pattern}")
+            logger.warning("Suspicious pattern detected: %s", pattern)
             return False
     
     # Check message length
@@ -310,10 +1861,291 @@ def validate_message_input(text):
     
     return True
 
-def debug_log(msg):
-    """Print debug messages"""
-    if DEBUG:
-        logger.debug(msg)
+def debug_log(msg, *args, **fields):
+    """Lazy debug logging: %-style args are only formatted if DEBUG records are emitted.
+
+    Keyword arguments become structured fields (e.g. stage='decision'); a stage
+    also labels the current task's samples while a profile is running.
+    """
+    if _profiler is not None and 'stage' in fields:
+        mark_stage(fields['stage'])
+    if DEBUG and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg, *args, extra=fields)
+
+# --- PROFILING ---
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+PROFILE_MAX_DEPTH = 64
+
+_profiler = None  # The running SamplingProfiler, if any
+_task_stages = {}  # asyncio task -> handler stage it last entered (only while profiling)
+
+def mark_stage(stage):
+    """Attribute the current task's samples to a handler stage while a profile is running"""
+    if _profiler is None:
+        return
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        return
+    if task is not None:
+        _task_stages[task] = stage
+
+class SamplingProfiler:
+    """Samples every thread's stack for a fixed time and writes collapsed stacks.
+
+    Sampling runs on its own thread and only while a profile is active, so the
+    bot pays nothing when it is off. Event-loop samples are rooted at the
+    running task's coroutine and its handler stage; the output is one
+    'frame;frame;... count' line per stack (flamegraph.pl / speedscope format).
+    """
+
+    def __init__(self, loop, seconds, path, interval=PROFILE_SAMPLE_INTERVAL):
+        self.loop = loop
+        self.seconds = seconds
+        self.path = path
+        self.interval = interval
+        self.loop_thread_id = threading.get_ident()  # Started from the loop thread
+        self.samples = defaultdict(int)
+        self.stage_samples = defaultdict(int)
+        self.thread = threading.Thread(target=self._run, name='teoembot-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        self.thread.join(timeout)
+
+    def _loop_root(self):
+        task = asyncio.current_task(self.loop)
+        if task is None:
+            return ['loop']  # Polling for I/O or running plain callbacks
+        coro = task.get_coro()
+        name = getattr(coro, '__qualname__', None) or task.get_name()
+        stage = _task_stages.get(task, '-')
+        self.stage_samples[stage] += 1
+        return [f'task:{name}', f'stage:{stage}']
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own_id = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.reverse()
+            if thread_id == self.loop_thread_id:
+                root = self._loop_root()
+            else:
+                root = [f'thread:{names.get(thread_id, thread_id)}']
+            self.samples[';'.join(root + stack)] += 1
+
+    def _run(self):
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                self.sample()
+                time.sleep(self.interval)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
+            logger.info("🔬 Profile written to %s: %s samples, by stage %s",
+                        self.path, sum(self.samples.values()), dict(self.stage_samples))
+        except Exception as e:
+            logger.error("Profiler failed: %s", e)
+        finally:
+            # The loop thread writes stage marks, so it also does the teardown
+            try:
+                self.loop.call_soon_threadsafe(self._finish)
+            except RuntimeError:
+                self._finish()  # Loop already closed: nothing left to race with
+
+    def _finish(self):
+        global _profiler
+        if _profiler is self:
+            _profiler = None
+            _task_stages.clear()
+
+# --- TRACING ---
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    """One timed stage of a message's trace; a context manager that becomes the current span"""
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'start', 'started',
+                 'attrs', 'duration', 'root', 'children', '_token')
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, root=None, attrs=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(4).hex()
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.attrs = attrs or {}
+        self.duration = None
+        self.root = root
+        self.children = [] if root is None else None
+        self._token = None
+        if root is not None:
+            root.children.append(self)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.started
+        if self.children:
+            # Spans left open by an early return end with their trace
+            for child in self.children:
+                child.end()
+            self.children = None
+        self.tracer.export(self)
+
+    def __enter__(self):
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.attrs['error'] = exc_type.__name__
+        current_span.reset(self._token)
+        self.end()
+        return False
+
+class _NoopSpan:
+    """Stands in for a span when tracing is off; detach=True hides any inherited span"""
+
+    def __init__(self, detach=False):
+        self.detach = detach
+        self._token = None
+
+    def set(self, **attrs):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        if self.detach:
+            self._token = current_span.set(None)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._token is not None:
+            current_span.reset(self._token)
+            self._token = None
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+class Tracer:
+    """Exports finished spans as JSON lines; file I/O runs on a writer thread"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = bool(path)
+        self.exported = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def start_trace(self, name, **attrs):
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, os.urandom(8).hex(), attrs=attrs)
+
+    def start_span(self, name, parent, **attrs):
+        return Span(self, name, parent.trace_id, parent.span_id, parent.root or parent, attrs)
+
+    def resume(self, trace, name, **attrs):
+        """Span continuing a trace from its (trace_id, span_id) context, e.g. in the outbox worker"""
+        if not self.enabled or not trace:
+            return _NoopSpan(detach=True)
+        trace_id, parent_id = trace
+        return Span(self, name, trace_id, parent_id, attrs=attrs)
+
+    def export(self, span):
+        self._queue.put({
+            'trace_id': span.trace_id, 'span_id': span.span_id, 'parent_id': span.parent_id,
+            'name': span.name, 'start': round(span.start, 6),
+            'duration_ms': round(span.duration * 1000, 3), 'attrs': span.attrs,
+        })
+        self.exported += 1
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_loop, name='teoembot-tracer', daemon=True)
+            self._thread.start()
+
+    def _write_loop(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    break
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self):
+        return {'enabled': self.enabled, 'exported': self.exported}
+
+def span(name, **attrs):
+    """Child of the current span; a no-op outside a trace"""
+    parent = current_span.get()
+    if parent is None:
+        return _NOOP_SPAN
+    return parent.tracer.start_span(name, parent, **attrs)
+
+def annotate(**attrs):
+    """Add attributes to the current span, if any"""
+    current = current_span.get()
+    if current is not None:
+        current.set(**attrs)
+
+def trace_context():
+    """(trace_id, span_id) of the current span, for work handed to another task"""
+    current = current_span.get()
+    return [current.trace_id, current.span_id] if current is not None else None
+
+def traced(name):
+    """Run an async function inside a child span called `name`"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def start_profiling(seconds=None, path=None):
+    """Profile the running bot for `seconds` (called from the event loop, e.g. on SIGUSR1).
+
+    Returns the SamplingProfiler, or None if a profile is already running.
+    """
+    global _profiler
+    if _profiler is not None:
+        logger.warning("Profiler already running")
+        return None
+    config = get_runtime().config
+    seconds = seconds or config.profile_seconds
+    if path is None:
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(config.profile_dir, f'profile-{stamp}.collapsed')
+    _profiler = SamplingProfiler(asyncio.get_running_loop(), seconds, path)
+    logger.info("🔬 Profiling for %.0fs -> %s", seconds, path)
+    return _profiler.start()
 
 # --- MOOD SYSTEM ---
 def calculate_mood():
@@ -369,53 +2201,66 @@ def get_emotional_context(text, history):
 def update_trending(chat_id, text):
     """Update trending topics with database persistence"""
     try:
+        rt = get_runtime()
+        stopwords = rt.phrase_bank.stopwords(chat_id)
         words = re.findall(r'\w+', text.lower())
-        important_words = [w for w in words if len(w) > 3 and w not in ['đang', 'này', 'thôi', 'nhỉ']]
+        important_words = [w for w in words if len(w) > 3 and w not in ['đang', 'này', 'thôi', 'nhỉ']
+                           and w not in stopwords]
+        if not important_words:
+            return
         
+        import teoembot_db
+        now = time.time()
+        trending = rt.trending_topics[chat_id]
         for word in important_words:
-            trending_topics[chat_id].append({
+            trending.append({
                 'word': word,
-                'time': time.time()
+                'time': now
             })
-            # Save to database
-            save_trending_to_db(chat_id, word)
+        # Save to database (queued for the writer task when the loop is running)
+        rt.db.write_nowait(teoembot_db.add_trending_rows, chat_id, important_words, now)
     except Exception as e:
-        logger.error(f"Error updating trending topics: {e}")
+        logger.error("Error updating trending topics: %s", e)
+
+def _pick_trending(chat_id, db_topics):
+    """Most frequent recent word, if it was seen at least 3 times"""
+    now = time.time()
+    recent = [t['word'] for t in get_runtime().trending_topics[chat_id] if now - t['time'] < 300]
+    recent.extend(db_topics)
+    
+    if not recent:
+        return None
+    
+    word_count = defaultdict(int)
+    for word in recent:
+        word_count[word] += 1
+    
+    top_word = max(word_count.items(), key=lambda x: x[1])
+    return top_word[0] if top_word[1] >= 3 else None
 
 def get_trending_topic(chat_id):
     """Get trending topic with database fallback"""
     try:
-        now = time.time()
-        recent = [t['word'] for t in trending_topics[chat_id] if now - t['time'] < 300]
-        
-        # Also load from database
-        db_topics = load_trending_from_db(chat_id, hours=1)
-        recent.extend(db_topics)
-        
-        if not recent:
-            return None
-        
-        word_count = defaultdict(int)
-        for word in recent:
-            word_count[word] += 1
-        
-        top_word = max(word_count.items(), key=lambda x: x[1])
-        return top_word[0] if top_word[1] >= 3 else None
+        return _pick_trending(chat_id, load_trending_from_db(chat_id, hours=1))
+    except Exception as e:
+        logger.error("Error getting trending topic: %s", e)
+        return None
+
+async def get_trending_topic_async(chat_id):
+    """Get trending topic, reading the database off the event loop"""
+    try:
+        db_topics = await load_trending_from_db_async(chat_id, hours=1)
+        return _pick_trending(chat_id, db_topics)
     except Exception as e:
-        logger.error(f"Error getting trending topic: {e}")
+        logger.error("Error getting trending topic: %s", e)
         return None
 
 def get_sample_trending_phrases(count=3):
     """Get sample trending phrases for prompt"""
-    memes = TRENDING_PHRASES.get('memes', [])
-    if not memes:
+    sample_memes = get_runtime().phrase_bank.sample(count)
+    if not sample_memes:
         fallback = get_random_trending_phrase()
         return fallback if fallback else "cái gì vậy trời, ngon nghẻ"
-    
-    # Ensure we don't sample more than available
-    available_memes = memes[:10]
-    sample_count = min(count, len(available_memes))
-    sample_memes = random.sample(available_memes, sample_count)
     return ", ".join(sample_memes)
 
 # --- PROMPT AI ---
@@ -443,7 +2288,7 @@ def get_system_prompt(emotion='playful'):
     memes_text = get_sample_trending_phrases(count=3)
     
     # Get emotional responses for this emotion
-    emotional_responses = TRENDING_PHRASES.get('emotional_responses', {}).get(emotion, [])
+    emotional_responses = get_runtime().phrase_bank.phrases('emotional_responses', emotion)
     emotion_examples = ', '.join(emotional_responses[:3]) if emotional_responses else ''
     
     return (
@@ -506,40 +2351,47 @@ def check_simple_response(text):
     return None
 
 # --- CACHE SYSTEM (TTLCache replaces MD5) ---
-# Track recent responses to avoid repetition
-recent_responses = deque(maxlen=10)
-
 def get_cached_response(text):
-    """Get cached response using TTLCache"""
+    """Get cached response using TTLCache; unused reply candidates are served first"""
     try:
         text_key = text.lower().strip()
-        return message_cache.get(text_key)
+        rt = get_runtime()
+        alternatives = rt.reply_alternatives.get(text_key)
+        if alternatives:
+            return alternatives.pop(0)
+        return rt.message_cache.get(text_key)
     except Exception as e:
-        logger.error(f"Cache retrieval error: {e}")
+        logger.error("Cache retrieval error: %s", e)
         return None
 
 def cache_response(text, response):
     """Cache response using TTLCache with automatic eviction"""
     try:
         text_key = text.lower().strip()
-        message_cache[text_key] = response
+        get_runtime().message_cache[text_key] = response
     except Exception as e:
-        logger.error(f"Cache storage error: {e}")
+        logger.error("Cache storage error: %s", e)
+
+def cache_alternatives(text, responses):
+    """Keep runner-up replies for reuse when the same message comes again"""
+    try:
+        if responses:
+            get_runtime().reply_alternatives[text.lower().strip()] = list(responses)
+    except Exception as e:
+        logger.error("Cache storage error: %s", e)
 
 def add_response_variation(response):
     """Add variation to response to avoid repetition with synonym replacement"""
     try:
+        rt = get_runtime()
+        recent_responses = rt.recent_responses
         # Check if this response was recently used
         if response in recent_responses:
-            # Get synonyms from trending phrases
-            synonyms = TRENDING_PHRASES.get('synonyms', {})
-            
-            # Try to replace common words with synonyms
-            for key, alts in synonyms.items():
-                if key in response.lower():
-                    variation = response.lower().replace(key, random.choice(alts))
-                    recent_responses.append(variation)
-                    return variation
+            # Try to replace a common word with a synonym
+            variation = rt.phrase_bank.vary(response)
+            if variation:
+                recent_responses.append(variation)
+                return variation
             
             # If no synonym found, return as is
             recent_responses.append(response)
@@ -549,7 +2401,7 @@ def add_response_variation(response):
         recent_responses.append(response)
         return response
     except Exception as e:
-        logger.error(f"Error adding variation: {e}")
+        logger.error("Error adding variation: %s", e)
         return response
 
 def should_ask_follow_up_question(history, context):
@@ -557,10 +2409,11 @@ def should_ask_follow_up_question(history, context):
     try:
         # Don't ask too many questions
         chat_id = context.get('chat_id', 0)
-        if topic_memory[chat_id]['questions_asked'] >= 2:
+        state = get_runtime().chat_state[chat_id]
+        if state.questions_asked >= 2:
             # Reset counter occasionally
             if random.random() < 0.3:
-                topic_memory[chat_id]['questions_asked'] = 0
+                state.questions_asked = 0
             return False
         
         # Ask questions when:
@@ -580,12 +2433,12 @@ def should_ask_follow_up_question(history, context):
         
         return False
     except Exception as e:
-        logger.error(f"Error in should_ask_follow_up_question: {e}")
+        logger.error("Error in should_ask_follow_up_question: %s", e)
         return False
 
 def get_follow_up_question():
     """Get a random follow-up question"""
-    questions = TRENDING_PHRASES.get('follow_up_questions', ['sao lại thế?', 'anh nghĩ sao?'])
+    questions = get_runtime().phrase_bank.phrases('follow_up_questions') or ('sao lại thế?', 'anh nghĩ sao?')
     return random.choice(questions)
 
 def add_thinking_depth(response, emotion, context):
@@ -595,7 +2448,7 @@ def add_thinking_depth(response, emotion, context):
         if random.random() > 0.3:
             return response
         
-        thinking_prefixes = TRENDING_PHRASES.get('thinking_prefixes', ['hmm', 'để tao nghĩ'])
+        thinking_prefixes = get_runtime().phrase_bank.phrases('thinking_prefixes') or ('hmm', 'để tao nghĩ')
         
         # For thoughtful or analytical contexts, add reasoning
         if emotion in ['thoughtful', 'skeptical']:
@@ -605,7 +2458,7 @@ def add_thinking_depth(response, emotion, context):
         
         return response
     except Exception as e:
-        logger.error(f"Error adding thinking depth: {e}")
+        logger.error("Error adding thinking depth: %s", e)
         return response
 
 # --- RANDOM MATCH ---
@@ -632,68 +2485,922 @@ def add_vietnamese_typos(text):
     rule = random.choice(typo_rules)
     return re.sub(rule[0], rule[1], text, count=1)
 
-# --- IMAGE HANDLING ---
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+# --- IMAGE HANDLING ---
+def encode_image(image_path):
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
+
+def clean_text(text):
+    if not text:
+        return ""
+    return re.sub(r'[^\w\sđĐ]', '', text.lower().strip())
+
+# --- CANDIDATE RERANKING ---
+NGRAM_SIZE = 3
+NGRAM_DIM = 2048  # Hashed character n-gram buckets
+RERANK_MIN_LENGTH = 2
+RERANK_MAX_LENGTH = 200
+REPETITION_WEIGHT = 0.8
+LENGTH_PENALTY = 1.0
+
+def hashed_ngram_matrix(texts, n=NGRAM_SIZE, dim=NGRAM_DIM):
+    """L2-normalised hashed character n-gram counts, one row per text"""
+    import numpy as np
+    rows, cols = [], []
+    for i, text in enumerate(texts):
+        padded = f" {(text or '').lower()} "
+        for j in range(len(padded) - n + 1):
+            rows.append(i)
+            cols.append(zlib.crc32(padded[j:j + n].encode('utf-8')) % dim)
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    np.add.at(matrix, (rows, cols), 1.0)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def score_candidates(candidates, history_texts, recent_responses=()):
+    """Score each candidate: relevance to history - repetition of recent replies - length penalty"""
+    import numpy as np
+    cand = hashed_ngram_matrix(candidates)
+    scores = np.zeros(len(candidates), dtype=np.float32)
+    if history_texts:
+        centroid = hashed_ngram_matrix(history_texts).mean(axis=0)
+        norm = np.linalg.norm(centroid)
+        if norm:
+            scores += cand @ (centroid / norm)
+    if recent_responses:
+        repetition = (cand @ hashed_ngram_matrix(list(recent_responses)).T).max(axis=1)
+        scores -= REPETITION_WEIGHT * repetition
+    lengths = np.array([len((c or '').strip()) for c in candidates])
+    scores -= LENGTH_PENALTY * ((lengths < RERANK_MIN_LENGTH) | (lengths > RERANK_MAX_LENGTH))
+    return scores
+
+def rank_candidates(candidates, history_texts, recent_responses=()):
+    """Candidates ordered best first (empty and duplicate ones dropped)"""
+    import numpy as np
+    unique = list(dict.fromkeys(c.strip() for c in candidates if c and c.strip()))
+    if len(unique) <= 1:
+        return unique
+    scores = score_candidates(unique, history_texts, recent_responses)
+    return [unique[i] for i in np.argsort(-scores, kind='stable')]
+
+# --- SINGLE-FLIGHT ---
+OPENAI_MODEL = "gpt-4o-mini"
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        return ' '.join(content.split())
+    if isinstance(content, list):
+        return [_normalize_content(part) for part in content]
+    if isinstance(content, dict):
+        return {k: _normalize_content(v) for k, v in content.items()}
+    return content
+
+def request_fingerprint(model, messages, purpose, **params):
+    """Stable hash of a chat request with whitespace-normalised message contents"""
+    payload = {
+        'model': model,
+        'purpose': purpose,
+        'messages': [(m['role'], _normalize_content(m['content'])) for m in messages],
+        **params,
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key await its result"""
+
+    def __init__(self):
+        self.inflight = {}  # key -> task
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, fn, *args):
+        task = self.inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn(*args))
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        else:
+            self.shared += 1
+        # Shielded so one cancelled caller doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every caller was cancelled
+
+    def stats(self):
+        return {'calls': self.calls, 'shared': self.shared, 'inflight': len(self.inflight)}
+
+# --- REQUEST ROUTING ---
+MESSAGE_CLASSES = ('random', 'trigger', 'targeted', 'reply_to_bot', 'photo', 'summary', 'pool')
+ROUTES_CHECK_INTERVAL = 5  # Seconds between mtime checks of the routes file
+# USD per 1M (prompt, completion) tokens, for the per-class cost report
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+}
+
+@dataclasses.dataclass(frozen=True)
+class Route:
+    model: str = OPENAI_MODEL
+    max_tokens: int = 80
+    temperature: float = 0.9
+    history_depth: int = 25  # History messages put in the prompt (summary: messages summarised)
+    include_summary: bool = True
+    retrieved: int = 3  # Older related messages pulled from the archive
+
+DEFAULT_ROUTES = {
+    'random': Route(max_tokens=40, history_depth=8, include_summary=False, retrieved=0),
+    'trigger': Route(max_tokens=60, history_depth=10, include_summary=False),
+    'targeted': Route(history_depth=10),
+    'reply_to_bot': Route(history_depth=10),
+    'photo': Route(history_depth=10, include_summary=False, retrieved=0),
+    'summary': Route(max_tokens=60, temperature=0.7, history_depth=10, include_summary=False, retrieved=0),
+    'pool': Route(max_tokens=400, temperature=1.0, history_depth=0, include_summary=False, retrieved=0),
+}
+
+RECENT_HISTORY_WINDOW = 10  # Most messages fetched live from Telegram; older context comes from the archive
+HISTORY_FETCH_MARGIN = 3  # Extra messages fetched to make up for skipped bot messages
+
+def history_fetch_limit(router, message_class):
+    """Messages to fetch from Telegram for a class: what its prompt (and summary) uses, plus a margin"""
+    route = router.route(message_class)
+    depth = route.history_depth
+    if route.include_summary:
+        depth = max(depth, router.route('summary').history_depth)
+    return min(depth, RECENT_HISTORY_WINDOW) + HISTORY_FETCH_MARGIN
+
+# Message class of the generation running in the current task (for per-class stats)
+generation_class = contextvars.ContextVar('generation_class', default='other')
+
+def classify_message(has_photo, replied_to_bot, is_targeted, has_trigger):
+    """Message class used to pick a Route"""
+    if has_photo:
+        return 'photo'
+    if replied_to_bot:
+        return 'reply_to_bot'
+    if is_targeted:
+        return 'targeted'
+    if has_trigger:
+        return 'trigger'
+    return 'random'
+
+class Router:
+    """Routing table from message class to Route, with per-class latency and cost.
+
+    Overrides come from an optional JSON file ({"random": {"max_tokens": 30}, ...})
+    that is re-read when it changes, or from update() at runtime. An invalid file
+    is logged and the previous table kept.
+    """
+
+    def __init__(self, path=None, check_interval=ROUTES_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.routes = dict(DEFAULT_ROUTES)
+        self._mtime = None
+        self._next_check = 0.0
+        self.latencies = defaultdict(lambda: deque(maxlen=500))
+        self.usage = defaultdict(lambda: {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost_usd': 0.0})
+
+    def route(self, message_class):
+        now = time.monotonic()
+        if self.path and now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self._maybe_reload()
+        return self.routes.get(message_class) or self.routes['targeted']
+
+    def update(self, message_class, **fields):
+        """Change one class's route while running"""
+        base = self.routes.get(message_class, DEFAULT_ROUTES['targeted'])
+        self.routes = {**self.routes, message_class: dataclasses.replace(base, **fields)}
+
+    def _maybe_reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                overrides = json.load(f)
+            routes = dict(DEFAULT_ROUTES)
+            for message_class, fields in overrides.items():
+                routes[message_class] = dataclasses.replace(routes.get(message_class, DEFAULT_ROUTES['targeted']), **fields)
+        except Exception as e:
+            logger.warning("Rejected routes from %s: %s", self.path, e)
+            return
+        self.routes = routes
+        logger.info("🔄 Loaded routes for %s message class(es)", len(overrides))
+
+    def record(self, message_class, latency, model, usage=None):
+        self.latencies[message_class].append(latency)
+        entry = self.usage[message_class]
+        entry['requests'] += 1
+        if usage is not None:
+            prompt, completion = usage.prompt_tokens or 0, usage.completion_tokens or 0
+            entry['prompt_tokens'] += prompt
+            entry['completion_tokens'] += completion
+            prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+            entry['cost_usd'] += (prompt * prompt_price + completion * completion_price) / 1_000_000
+
+    def stats(self):
+        """Per-class request count, tokens, cost and latency percentiles (ms)"""
+        report = {}
+        for message_class, entry in self.usage.items():
+            p50 = percentile(self.latencies[message_class], 50)
+            p95 = percentile(self.latencies[message_class], 95)
+            report[message_class] = {
+                **entry,
+                'cost_usd': round(entry['cost_usd'], 6),
+                'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+                'p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+            }
+        return report
+
+# --- GENERATION BACKENDS ---
+class Completions(list):
+    """Completion texts plus the response's model and token usage"""
+
+    def __init__(self, texts, model=None, usage=None):
+        super().__init__(texts)
+        self.model = model
+        self.usage = usage
+
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 20  # Latency samples needed before the percentile is trusted
+HEDGE_DEFAULT_DELAY = 4.0  # Seconds to wait before hedging until then
+
+class OpenAICompatibleBackend:
+    """One OpenAI-compatible chat completions endpoint (OpenAI, a llama.cpp server, ...)"""
+
+    def __init__(self, name, model=OPENAI_MODEL, base_url=None, api_key=None, limiter=None, client_factory=None,
+                 models=None, uses_openai_quota=None):
+        self.name = name
+        self.model = model
+        self.models = dict(models or {})  # Routed model name -> this backend's equivalent
+        self.base_url = base_url
+        # Each request sent counts against OPENAI_HOURLY_QUOTA; by default only the OpenAI API itself
+        self.uses_openai_quota = base_url is None if uses_openai_quota is None else uses_openai_quota
+        self.api_key = api_key
+        self.limiter = limiter
+        self.client_factory = client_factory
+        self._client = None
+
+    @property
+    def client(self):
+        if self.client_factory is not None:
+            return self.client_factory()
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key or 'none')
+        return self._client
+
+    def has_capacity(self):
+        return self.limiter is None or self.limiter.has_capacity()
+
+    def model_for(self, routed_model):
+        """This backend's model for a routed model name; None means its own default"""
+        return self.models.get(routed_model) if routed_model else None
+
+    async def _create(self, client, messages, max_tokens, temperature, n, model):
+        response = await client.chat.completions.create(
+            model=model or self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            n=n
+        )
+        return Completions([choice.message.content for choice in response.choices],
+                           model=model or self.model, usage=getattr(response, 'usage', None))
+
+    async def complete(self, messages, max_tokens, temperature, n, model=None, admitted=None):
+        """Completions; admitted() is called once past the limiter, when the request is really sent"""
+        client = self.client
+        if client is None:
+            raise Exception(f"{self.name} client not initialized")
+        if self.limiter is None:
+            if admitted is not None:
+                admitted()
+            return await self._create(client, messages, max_tokens, temperature, n, model)
+        async with self.limiter:
+            if admitted is not None:
+                admitted()
+            return await self._create(client, messages, max_tokens, temperature, n, model)
+
+class BackendRegistry:
+    """Ordered generation backends with hedged requests.
+
+    The first backend is the primary. If it has not answered by its p90 latency,
+    the request also goes to the next backend with spare capacity; the first
+    successful answer wins and the other request is cancelled. A failing primary
+    fails over to that backend straight away.
+    """
+
+    def __init__(self, backends, hedge_percentile=HEDGE_PERCENTILE,
+                 min_samples=HEDGE_MIN_SAMPLES, default_delay=HEDGE_DEFAULT_DELAY):
+        self.backends = list(backends)
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.latencies = {backend.name: deque(maxlen=500) for backend in self.backends}
+        self.request_latencies = deque(maxlen=500)
+        self.hedged_latencies = deque(maxlen=500)
+        self.counters = defaultdict(int)
+
+    @property
+    def primary(self):
+        return self.backends[0]
+
+    def hedge_delay(self, backend):
+        samples = self.latencies[backend.name]
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        return percentile(samples, self.hedge_percentile)
+
+    def _secondary(self):
+        for backend in self.backends[1:]:
+            if backend.has_capacity() and (not backend.uses_openai_quota or openai_quota_available()):
+                return backend
+        return None
+
+    def _model_for(self, backend, model):
+        mapped = backend.model_for(model)
+        if model and mapped is None:
+            debug_log("Backend %s has no mapping for routed model %s, using %s",
+                      backend.name, model, backend.model, stage='generate')
+        return mapped
+
+    async def _timed(self, backend, args):
+        """backend.complete, sampling its service time only: waiting on its limiter is not latency to hedge on.
+
+        A request to an OpenAI-quota backend is charged when it is actually sent,
+        so a hedge that goes out costs a second unit and one that doesn't costs none.
+        """
+        started = None
+
+        def admitted():
+            nonlocal started
+            if backend.uses_openai_quota and not charge_openai_quota():
+                raise OpenAIQuotaExceeded(f"OpenAI quota limit reached before sending to {backend.name}")
+            started = time.perf_counter()
+
+        try:
+            result = await backend.complete(*args, admitted=admitted)
+        except asyncio.CancelledError:
+            # A cancelled call took at least this long; keeps the percentile honest
+            if started is not None:
+                self.latencies[backend.name].append(time.perf_counter() - started)
+            raise
+        if started is not None:
+            self.latencies[backend.name].append(time.perf_counter() - started)
+        return result
+
+    async def complete(self, messages, max_tokens, temperature, n, model=None):
+        """Completions from the primary, hedged to a secondary past the primary's p90"""
+        self.counters['requests'] += 1
+        started = time.perf_counter()
+        args = (messages, max_tokens, temperature, n, model)
+        secondary = self._secondary()
+        first = asyncio.ensure_future(self._timed(self.primary, args))
+        if secondary is None:
+            result = await first
+            self.request_latencies.append(time.perf_counter() - started)
+            return result
+        
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.hedge_delay(self.primary))
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        if done:
+            if first.exception() is None:
+                self.request_latencies.append(time.perf_counter() - started)
+                return first.result()
+            logger.warning("Backend %s failed, failing over to %s: %s",
+                           self.primary.name, secondary.name, first.exception())
+            self.counters['failovers'] += 1
+            result = await self._timed(secondary, (messages, max_tokens, temperature, n,
+                                                   self._model_for(secondary, model)))
+            self.request_latencies.append(time.perf_counter() - started)
+            return result
+        
+        self.counters['hedged'] += 1
+        # The secondary serves its own model unless the routed one is mapped for it
+        second = asyncio.ensure_future(self._timed(secondary, (messages, max_tokens, temperature, n,
+                                                               self._model_for(secondary, model))))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.counters['hedge_wins'] += 1
+                        elapsed = time.perf_counter() - started
+                        self.request_latencies.append(elapsed)
+                        self.hedged_latencies.append(elapsed)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        """Hedge/failover counts plus latency percentiles (ms) to tune hedging against"""
+        def ms(values, pct):
+            value = percentile(values, pct)
+            return round(value * 1000, 1) if value is not None else None
+        requests = self.counters['requests']
+        hedged = self.counters['hedged']
+        stats = {
+            **self.counters,
+            'hedge_rate': round(hedged / requests, 3) if requests else 0.0,
+            'hedge_win_rate': round(self.counters['hedge_wins'] / hedged, 3) if hedged else 0.0,
+            'request_p50_ms': ms(self.request_latencies, 50),
+            'request_p99_ms': ms(self.request_latencies, 99),
+            'hedged_p50_ms': ms(self.hedged_latencies, 50),
+        }
+        for backend in self.backends:
+            stats[f'{backend.name}_p50_ms'] = ms(self.latencies[backend.name], 50)
+            stats[f'{backend.name}_p90_ms'] = ms(self.latencies[backend.name], 90)
+        return stats
+
+def build_backends(runtime):
+    """Backends from GENERATION_BACKENDS (a JSON list), defaulting to OpenAI alone.
+
+    Entries: {"name", "model", "base_url", "api_key_env", "max_rate", "models", "openai_quota"},
+    where "models" maps routed model names to this backend's own. An entry without
+    base_url is the OpenAI API itself: it shares the OpenAI limiter and its requests
+    count against the hourly quota ("openai_quota": true does the same for others).
+    Keys come from the config (BotConfig.backend_api_keys), by api_key_env name.
+    """
+    specs = json.loads(runtime.config.generation_backends) if runtime.config.generation_backends else [{'name': 'openai'}]
+    backends = []
+    for spec in specs:
+        model = spec.get('model', OPENAI_MODEL)
+        if not spec.get('base_url'):
+            backends.append(OpenAICompatibleBackend(
+                spec.get('name', 'openai'), model, limiter=runtime.openai_limiter, client_factory=runtime.get_ai_client,
+                models=spec.get('models')
+            ))
+            continue
+        max_rate = spec.get('max_rate')
+        backends.append(OpenAICompatibleBackend(
+            spec['name'], model, base_url=spec['base_url'],
+            api_key=runtime.backend_api_key(spec['api_key_env']) if spec.get('api_key_env') else None,
+            limiter=AsyncLimiter(max_rate, 60) if max_rate else None, models=spec.get('models'),
+            uses_openai_quota=bool(spec.get('openai_quota', False))
+        ))
+    return BackendRegistry(backends)
+
+# --- LOCAL GENERATOR ---
+MARKOV_ORDER = 2
+MARKOV_MAX_STATES = 50000
+MARKOV_CORPUS_LIMIT = 5000  # Stored group messages replayed when the model is first used
+# Not training text: synonym tables, and mine_phrases.py's n-gram fragments awaiting curation
+MARKOV_SKIPPED_CATEGORIES = ('synonyms', 'mined')
+_BEGIN, _END = '\x02', '\x03'
+
+class MarkovGenerator:
+    """Word-level Markov chain trained on the group's messages and the phrase bank.
+
+    Transitions are kept per label (an emotion from the phrase bank or a message
+    sentiment) plus a shared chain; generate() walks the labelled chain where it
+    has data and the shared chain otherwise. No network, microseconds per reply.
+    """
+
+    def __init__(self, order=MARKOV_ORDER, max_states=MARKOV_MAX_STATES):
+        self.order = order
+        self.max_states = max_states
+        self.chains = defaultdict(dict)  # label -> {state tuple: {next word: count}}
+        self.by_last_word = defaultdict(lambda: defaultdict(list))  # label -> {word: states ending in it}
+        self.states = 0
+        self.trained = 0
+        self.loaded = False
+
+    def learn(self, text, label=None):
+        words = (text or '').lower().split()
+        if not words:
+            return
+        tokens = [_BEGIN] * self.order + words + [_END]
+        for chain_label in {None, label}:
+            chain = self.chains[chain_label]
+            for i in range(len(tokens) - self.order):
+                state = tuple(tokens[i:i + self.order])
+                nexts = chain.get(state)
+                if nexts is None:
+                    if self.states >= self.max_states:
+                        continue
+                    nexts = chain[state] = {}
+                    self.states += 1
+                    if state[-1] != _BEGIN:
+                        self.by_last_word[chain_label][state[-1]].append(state)
+                word = tokens[i + self.order]
+                nexts[word] = nexts.get(word, 0) + 1
+        self.trained += 1
+
+    def learn_phrases(self, snapshot):
+        """Train on every phrase; subcategories (emotions, reaction kinds) become labels"""
+        for (category, sub), phrases in snapshot.flat.items():
+            nested = isinstance(snapshot.data.get(category), dict)
+            if category in MARKOV_SKIPPED_CATEGORIES or (nested and sub is None):
+                continue  # (category, None) repeats the nested phrases
+            for phrase in phrases:
+                self.learn(phrase, sub)
+
+    def _pick(self, nexts, temperature):
+        words = list(nexts)
+        weights = [count ** (1.0 / max(temperature, 0.05)) for count in nexts.values()]
+        return random.choices(words, weights)[0]
+
+    def _start(self, label, seed_words):
+        """A start state, preferring one that continues a word from the prompt"""
+        index = self.by_last_word.get(label)
+        if seed_words and index:
+            seeds = [s for word in seed_words for s in index.get(word, ())]
+            if seeds:
+                return random.choice(seeds)
+        return (_BEGIN,) * self.order
+
+    def generate(self, condition=None, seed_text='', max_words=20, temperature=0.9):
+        """Sample one reply, or None when nothing has been learned yet"""
+        shared = self.chains.get(None)
+        if not shared:
+            return None
+        label = condition if self.chains.get(condition) else None
+        chain = self.chains[label]
+        state = self._start(label, set((seed_text or '').lower().split()))
+        words = [w for w in state if w != _BEGIN]
+        while len(words) < max_words:
+            nexts = chain.get(state) or shared.get(state)
+            if not nexts:
+                break
+            word = self._pick(nexts, temperature)
+            if word == _END:
+                break
+            words.append(word)
+            state = state[1:] + (word,)
+        return ' '.join(words) or None
+
+    async def ensure_loaded(self, runtime):
+        """Train on the phrase bank and recent stored messages once"""
+        if self.loaded:
+            return
+        self.loaded = True
+        import teoembot_db
+        self.learn_phrases(runtime.phrase_bank.current())
+        try:
+            rows = await runtime.db.read(teoembot_db.load_chat_messages, MARKOV_CORPUS_LIMIT)
+        except Exception as e:
+            logger.error("Failed to load message corpus: %s", e)
+            rows = []
+        for text, sentiment in rows:
+            self.learn(text, sentiment)
+        logger.info("🧩 Local generator trained on %s texts (%s states)", self.trained, self.states)
+
+    def stats(self):
+        return {'trained': self.trained, 'states': self.states, 'labels': len(self.chains)}
+
+def _last_user_text(messages):
+    for message in reversed(messages):
+        if message['role'] != 'user':
+            continue
+        content = message['content']
+        if isinstance(content, str):
+            return content
+        return ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return ''
+
+async def call_local_generator(messages, max_tokens=50, temperature=0.9, purpose='chat', key_messages=None, condition=None):
+    """Drop-in for call_openai_with_retry backed by the local Markov model"""
+    rt = get_runtime()
+    generator = rt.local_generator
+    await generator.ensure_loaded(rt)
+    reply = generator.generate(condition, _last_user_text(messages), max_words=max(3, max_tokens // 4), temperature=temperature)
+    if not reply:
+        raise Exception("Local generator has no data yet")
+    return reply
+
+def remember_message(chat_id, sender_id, text, sentiment, sender_name=None):
+    """Feed a group message to the local generator and archive it for training and retrieval"""
+    import teoembot_db
+    rt = get_runtime()
+    rt.local_generator.learn(text, sentiment)
+    rt.db.write_nowait(teoembot_db.add_chat_message, chat_id, sender_id, text, sentiment, time.time(), sender_name)
+
+async def local_fallback(msg_text, emotion):
+    """Reply without the API: reply pool, then local generator, then trending phrases"""
+    pooled = get_runtime().reply_pool.take(current_mood['state'], emotion)
+    if pooled:
+        return pooled
+    try:
+        return await call_local_generator([{"role": "user", "content": msg_text or ''}], condition=emotion)
+    except Exception as e:
+        debug_log("Local generator unavailable: %s", e, stage='generate')
+    emotional_fallback = get_random_trending_phrase('emotional_responses', emotion)
+    if emotional_fallback:
+        return emotional_fallback
+    trending_fallback = get_random_trending_phrase('reactions', 'casual')
+    return trending_fallback if trending_fallback else random.choice(["uh", "oke r", "vl"])
+
+# --- REPLY POOLS ---
+POOL_REPLY_TTL = 1800  # Seconds a pre-generated reply stays servable
+POOL_BATCH_SIZE = 20  # Replies requested per refill call
+POOL_MIN_SIZE = 5  # Buckets below this are refilled when idle
+POOL_IDLE_AFTER = 60  # Seconds without messages before refilling
+POOL_CHECK_INTERVAL = 30
+POOL_REFILLS_PER_CYCLE = 3
+POOL_MAX_BUCKETS = 200
+
+def parse_pool_replies(text):
+    """Replies from a {"replies": [...]} JSON answer; tolerant of surrounding text"""
+    start, end = (text or '').find('{'), (text or '').rfind('}')
+    if start < 0 or end <= start:
+        return []
+    try:
+        replies = json.loads(text[start:end + 1]).get('replies', [])
+    except (ValueError, AttributeError):
+        return []
+    cleaned = (clean_text(r).strip() for r in replies if isinstance(r, str))
+    return list(dict.fromkeys(r for r in cleaned if 1 < len(r) <= 80))
+
+class ReplyPool:
+    """Short pre-generated replies per (mood, emotion, topic) bucket, refilled while idle.
+
+    take() serves random-trigger and fallback replies instantly; a miss marks the
+    bucket as wanted. The background loop refills wanted buckets during idle
+    periods and sleep hours with one JSON batch request per bucket.
+    """
+
+    def __init__(self, ttl=POOL_REPLY_TTL, batch_size=POOL_BATCH_SIZE, min_size=POOL_MIN_SIZE,
+                 idle_after=POOL_IDLE_AFTER, check_interval=POOL_CHECK_INTERVAL):
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.min_size = min_size
+        self.idle_after = idle_after
+        self.check_interval = check_interval
+        self.buckets = OrderedDict()  # (mood, emotion, topic) -> list of (expires_at, reply)
+        self.wanted = OrderedDict()   # buckets that missed recently, oldest first
+        self.last_activity = time.monotonic()
+        self.counters = defaultdict(int)
+        self._task = None
+
+    def touch(self):
+        """Record chat activity; refills wait until the chat has been idle"""
+        self.last_activity = time.monotonic()
+
+    def _live(self, bucket):
+        now = time.time()
+        entries = self.buckets.get(bucket)
+        if not entries:
+            return []
+        live = [entry for entry in entries if entry[0] > now]
+        self.counters['expired'] += len(entries) - len(live)
+        self.buckets[bucket] = live
+        return live
+
+    def take(self, mood, emotion, topic=None):
+        """A pooled reply for the bucket (falling back to the topic-less bucket), or None"""
+        for bucket in ((mood, emotion, topic), (mood, emotion, None)):
+            live = self._live(bucket)
+            if live:
+                self.counters['hits'] += 1
+                return live.pop(random.randrange(len(live)))[1]
+        self.counters['misses'] += 1
+        self.wanted[(mood, emotion, topic)] = time.time()
+        self.wanted.move_to_end((mood, emotion, topic))
+        while len(self.wanted) > POOL_MAX_BUCKETS:
+            self.wanted.popitem(last=False)
+        return None
+
+    def add(self, bucket, replies):
+        expires_at = time.time() + self.ttl
+        entries = self._live(bucket) + [(expires_at, reply) for reply in replies]
+        self.buckets[bucket] = entries
+        self.buckets.move_to_end(bucket)
+        while len(self.buckets) > POOL_MAX_BUCKETS:
+            self.buckets.popitem(last=False)
+
+    def is_idle(self):
+        if SLEEP_START_HOUR <= datetime.datetime.now().hour < SLEEP_END_HOUR:
+            return True
+        return time.monotonic() - self.last_activity >= self.idle_after
+
+    def due_buckets(self, limit=POOL_REFILLS_PER_CYCLE):
+        """Wanted buckets that are below min_size, most recently wanted first"""
+        due = [b for b in reversed(self.wanted) if len(self._live(b)) < self.min_size]
+        return due[:limit]
+
+    async def refill(self, bucket):
+        """Fetch one batch of replies for a bucket; returns how many were added"""
+        mood, emotion, topic = bucket
+        if not openai_quota_available():
+            return 0
+        route = get_runtime().router.route('pool')
+        instruction = (
+            f"Viết {self.batch_size} câu rep ngắn (1-8 từ), mỗi câu khác nhau, kiểu chat nhóm. "
+            f"Tâm trạng: {mood}. Cảm xúc: {emotion}."
+        )
+        if topic:
+            instruction += f" Liên quan chủ đề '{topic}' nếu hợp."
+        instruction += ' Chỉ trả về JSON: {"replies": ["...", "..."]}'
+        messages = [
+            {"role": "system", "content": get_system_prompt(emotion)},
+            {"role": "user", "content": instruction},
+        ]
+        token = generation_class.set('pool')
+        try:
+            text = await call_openai_with_retry(messages, max_tokens=route.max_tokens, temperature=route.temperature,
+                                                purpose='pool', model=route.model)
+        finally:
+            generation_class.reset(token)
+        replies = parse_pool_replies(text)
+        self.add(bucket, replies)
+        self.counters['refills'] += 1
+        self.counters['generated'] += len(replies)
+        if len(self._live(bucket)) >= self.min_size:
+            self.wanted.pop(bucket, None)
+        debug_log("🪣 Refilled pool %s with %d replies", bucket, len(replies), stage='pool')
+        return len(replies)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if not self.is_idle():
+                continue
+            for bucket in self.due_buckets():
+                try:
+                    await self.refill(bucket)
+                except Exception as e:
+                    logger.error("Reply pool refill failed: %s", e)
+                    break
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        """Hit rate, pool sizes and refill cost (from the 'pool' routing class)"""
+        lookups = self.counters['hits'] + self.counters['misses']
+        return {
+            **self.counters,
+            'hit_rate': round(self.counters['hits'] / lookups, 3) if lookups else 0.0,
+            'pooled': sum(len(entries) for entries in self.buckets.values()),
+            'wanted': len(self.wanted),
+            'refill_cost_usd': get_runtime().router.stats().get('pool', {}).get('cost_usd', 0.0),
+        }
+
+# --- MESSAGE ARCHIVE RETRIEVAL ---
+RETRIEVAL_MIN_AGE = 600  # Only retrieve messages older than the recent window (seconds)
+ARCHIVE_PRUNE_INTERVAL = 6 * 3600
+RETRIEVAL_MAX_TERMS = 8
+RETRIEVAL_STOPWORDS = frozenset(['là', 'có', 'không', 'thì', 'mà', 'và', 'của', 'cho', 'này', 'đi', 'ơi', 'nhé', 'à', 'ạ'])
+
+def build_fts_query(text):
+    """FTS5 OR-query of the message's distinct words, each quoted so user text can't inject syntax"""
+    words = []
+    for word in re.findall(r'\w+', (text or '').lower()):
+        if len(word) > 1 and word not in RETRIEVAL_STOPWORDS and word not in words:
+            words.append(word)
+    return ' OR '.join(f'"{word}"' for word in words[:RETRIEVAL_MAX_TERMS])
 
-def clean_text(text):
-    if not text:
-        return ""
-    return re.sub(r'[^\w\sđĐ]', '', text.lower().strip())
+async def prune_message_archive(retention_days):
+    """Delete archived messages older than the retention window; returns how many"""
+    import teoembot_db
+    try:
+        pruned = await get_runtime().db.write(teoembot_db.prune_chat_messages, time.time() - retention_days * 86400)
+    except Exception as e:
+        logger.error("Message archive prune failed: %s", e)
+        return 0
+    if pruned:
+        logger.info("🗄️ Pruned %s archived message(s) older than %s days", pruned, retention_days)
+    return pruned
+
+async def archive_prune_loop(retention_days, interval=ARCHIVE_PRUNE_INTERVAL):
+    """Keep chat_messages (and its FTS index) bounded: prune now, then every interval"""
+    while True:
+        await prune_message_archive(retention_days)
+        await asyncio.sleep(interval)
+
+async def retrieve_related_messages(chat_id, text, limit=3, exclude_texts=()):
+    """Older archived messages of this chat most relevant (BM25) to text"""
+    match = build_fts_query(text)
+    if not match or limit <= 0:
+        return []
+    import teoembot_db
+    try:
+        rows = await get_runtime().db.read(
+            teoembot_db.search_chat_messages, chat_id, match, time.time() - RETRIEVAL_MIN_AGE, limit + len(exclude_texts)
+        )
+    except Exception as e:
+        logger.error("Message archive search failed: %s", e)
+        return []
+    excluded = set(exclude_texts)
+    return [row for row in rows if row['text'] not in excluded][:limit]
 
 # --- AI CALL WITH RETRY LOGIC ---
+class OpenAIQuotaExceeded(Exception):
+    """This hour's OpenAI calls are used up (not retried)"""
+
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10),
-    retry=retry_if_exception_type(Exception)
+    retry=retry_if_not_exception_type(OpenAIQuotaExceeded)
 )
-async def call_openai_with_retry(messages, max_tokens=50, temperature=0.9):
+async def call_openai_with_retry(messages, max_tokens=50, temperature=0.9, purpose='chat', key_messages=None, model=None):
     """Call OpenAI API with retry logic"""
-    async with openai_limiter:
-        try:
-            client = get_ai_client()
-            if client is None:
-                raise Exception("OpenAI client not initialized")
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            logger.error(f"OpenAI API error: {e}")
-            raise
+    return (await _chat_completion(messages, max_tokens, temperature, 1, purpose, key_messages, model))[0]
 
-async def check_openai_quota():
-    """Check if we should make OpenAI call (basic quota check)"""
-    # Simple check: limit calls per hour
-    current_hour = datetime.datetime.now().hour
-    quota_key = f"quota_{current_hour}"
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=10),
+    retry=retry_if_not_exception_type(OpenAIQuotaExceeded)
+)
+async def call_openai_candidates(messages, n, max_tokens=50, temperature=0.9, purpose='reply', key_messages=None, model=None):
+    """Request n completions in one API call (one round trip, one limiter slot)"""
+    return await _chat_completion(messages, max_tokens, temperature, n, purpose, key_messages, model)
+
+async def _chat_completion(messages, max_tokens, temperature, n, purpose, key_messages=None, model=None):
+    """Identical in-flight requests share one API call; key_messages overrides what is hashed"""
+    rt = get_runtime()
+    key = request_fingerprint(model or rt.backends.primary.model, key_messages or messages, purpose,
+                              max_tokens=max_tokens, temperature=temperature, n=n)
+    return list(await rt.openai_flights.do(key, _create_completion, messages, max_tokens, temperature, n, model))
+
+@traced('generation')
+async def _create_completion(messages, max_tokens, temperature, n, model=None):
+    """The single-flight leader's API call; quota is charged per backend request sent, not per caller"""
+    rt = get_runtime()
+    if rt.backends.primary.uses_openai_quota and not openai_quota_available():
+        raise OpenAIQuotaExceeded("OpenAI quota limit reached for this hour")
+    started = time.perf_counter()
+    try:
+        result = await rt.backends.complete(messages, max_tokens, temperature, n, model)
+    except Exception as e:
+        logger.error("OpenAI API error: %s", e)
+        raise
+    used_model = getattr(result, 'model', None) or model or rt.backends.primary.model
+    rt.router.record(generation_class.get(), time.perf_counter() - started, used_model,
+                     getattr(result, 'usage', None))
+    annotate(model=used_model, n=n, message_class=generation_class.get())
+    return result
+
+def _quota_key():
+    """This hour's key in check_openai_quota.hourly_calls, resetting the count when the hour changes"""
+    quota_key = f"quota_{datetime.datetime.now().hour}"
     
     if not hasattr(check_openai_quota, 'hourly_calls'):
         check_openai_quota.hourly_calls = {}
     
     if quota_key not in check_openai_quota.hourly_calls:
         check_openai_quota.hourly_calls = {quota_key: 0}
+    return quota_key
+
+def openai_quota_available():
+    """Whether this hour's quota has calls left, without using one"""
+    quota_key = _quota_key()  # May swap in a fresh dict for a new hour, so look it up first
+    return check_openai_quota.hourly_calls[quota_key] < OPENAI_HOURLY_QUOTA
+
+async def check_openai_quota():
+    """Use one unit of the hourly quota for an API call; False when none is left"""
+    return charge_openai_quota()
+
+def charge_openai_quota():
+    """check_openai_quota for synchronous callers (the backend registry, as a request is sent)"""
+    quota_key = _quota_key()
     
-    # Limit to 100 calls per hour
-    if check_openai_quota.hourly_calls[quota_key] >= 100:
+    # Limit to OPENAI_HOURLY_QUOTA calls per hour
+    if check_openai_quota.hourly_calls[quota_key] >= OPENAI_HOURLY_QUOTA:
         logger.warning("OpenAI quota limit reached for this hour")
         return False
     
     check_openai_quota.hourly_calls[quota_key] += 1
     return True
 
+@traced('summary')
 async def summarize_context(history):
     """Summarize conversation context using OpenAI with more detail"""
+    token = generation_class.set('summary')
     try:
         if len(history) < 3:
             return None
         
-        # Expand summary to include more history (last 10 messages instead of 5)
-        history_text = "\n".join([f"{h['name']}: {h['text']}" for h in history[-10:]])
+        route = get_runtime().router.route('summary')
+        history_text = "\n".join([f"{h['name']}: {h['text']}" for h in history[-route.history_depth:]])
         
         messages = [{
             "role": "system",
@@ -707,14 +3414,17 @@ async def summarize_context(history):
             "content": history_text
         }]
         
-        # Increase max_tokens from 30 to 60 for more detailed summary
-        summary = await call_openai_with_retry(messages, max_tokens=60, temperature=0.7)
-        logger.info(f"Context summary: {summary}")
+        summary = await call_openai_with_retry(messages, max_tokens=route.max_tokens, temperature=route.temperature,
+                                               purpose='summary', model=route.model)
+        logger.info("Context summary: %s", summary)
         return summary
     except Exception as e:
-        logger.error(f"Failed to summarize context: {e}")
+        logger.error("Failed to summarize context: %s", e)
         return None
+    finally:
+        generation_class.reset(token)
 
+@traced('relevance')
 async def check_relevance(msg_text, context, history):
     """Check if response would be relevant to current context with improved logic"""
     try:
@@ -751,25 +3461,34 @@ async def check_relevance(msg_text, context, history):
         
         return True  # Default to relevant to avoid over-filtering
     except Exception as e:
-        logger.error(f"Relevance check error: {e}")
+        logger.error("Relevance check error: %s", e)
         return True
 
+@traced('reply')
 async def get_ai_reply_multimodal(msg_text, history, image_path=None, my_previous_msg=None, context=None):
-    """Get AI reply with emotional intelligence, deeper thinking, and follow-up questions"""
+    """Get AI reply with emotional intelligence, deeper thinking, and follow-up questions.
+
+    image_path may be one path or a list of paths (an album), sent in one request.
+    """
+    image_paths = [image_path] if isinstance(image_path, str) else list(image_path or [])
+    message_class = context.get('message_class', 'targeted') if context else 'targeted'
+    token = generation_class.set(message_class)
     try:
-        # Check quota before making call
-        if not await check_openai_quota():
-            logger.warning("Quota exceeded, using fallback")
-            trending_fallback = get_random_trending_phrase('reactions', 'casual')
-            return trending_fallback if trending_fallback else random.choice(["uh", "oke r", "vl"])
+        # Check quota before making call (it is charged per API call, in _create_completion)
+        if not openai_quota_available():
+            logger.warning("Quota exceeded, using local generator")
+            return await local_fallback(msg_text, context.get('emotion', 'playful') if context else 'playful')
         
         # Determine emotional context
         emotion = get_emotional_context(msg_text or '', history)
         
+        rt = get_runtime()
+        route = rt.router.route(message_class)
+        
         messages = [{"role": "system", "content": get_system_prompt(emotion)}]
         
         # Add context summary if available (for conversations with 5+ messages)
-        if len(history) >= 5:
+        if route.include_summary and len(history) >= 5:
             context_summary = await summarize_context(history)
             if context_summary:
                 messages.append({
@@ -783,10 +3502,14 @@ async def get_ai_reply_multimodal(msg_text, history, image_path=None, my_previou
                 "content": f"Chủ đề đang hot: '{context['trending']}'. Liên quan đến chủ đề này nếu có thể."
             })
         
+        # Randomly picked style hints; left out of the single-flight key so that
+        # identical concurrent requests still share one call
+        hints = []
+        
         # Add emotional guidance
-        emotional_guidance = TRENDING_PHRASES.get('emotional_responses', {}).get(emotion, [])
+        emotional_guidance = get_runtime().phrase_bank.phrases('emotional_responses', emotion)
         if emotional_guidance:
-            messages.append({
+            hints.append({
                 "role": "system",
                 "content": f"Cảm xúc {emotion}: Có thể dùng '{random.choice(emotional_guidance)}' hoặc tương tự."
             })
@@ -794,14 +3517,29 @@ async def get_ai_reply_multimodal(msg_text, history, image_path=None, my_previou
         # Add some trending phrases as examples
         sample_phrase = get_random_trending_phrase()
         if sample_phrase:
-            messages.append({
+            hints.append({
                 "role": "system",
                 "content": f"Ví dụ câu hot trend: '{sample_phrase}' - dùng tự nhiên khi phù hợp."
             })
+        key_messages = list(messages)
+        messages.extend(hints)
+        
+        # Older messages from the local archive that match this one (long-range context)
+        recent = history[-route.history_depth:] if route.history_depth else []
+        if route.retrieved and msg_text and context and context.get('chat_id') is not None:
+            shown = [h.get('full_text', h['text']) for h in recent] + [msg_text]
+            related = await retrieve_related_messages(context['chat_id'], msg_text, route.retrieved, exclude_texts=shown)
+            if related:
+                lines = "\n".join(f"{r['name']}: {r['text'][:MAX_RELATED_TEXT_LENGTH]}" for r in related)
+                archived = {"role": "system", "content": f"Tin nhắn cũ liên quan:\n{lines}"}
+                messages.append(archived)
+                key_messages.append(archived)
         
-        # Expand history to 25 messages for better context (gets ~20-24 excluding bot)
-        for h in history[-25:]:
-            messages.append({"role": "user", "content": f"{h['name']}: {h['text']}"})
+        # A short recent window (depth from the route); older context comes from the archive
+        for h in recent:
+            turn = {"role": "user", "content": f"{h['name']}: {h['text']}"}
+            messages.append(turn)
+            key_messages.append(turn)
         
         user_content = []
         context_intro = ""
@@ -814,22 +3552,38 @@ async def get_ai_reply_multimodal(msg_text, history, image_path=None, my_previou
         else:
             user_content.append({"type": "text", "text": "User gửi ảnh."})
         
-        if image_path:
-            base64_image = encode_image(image_path)
-            user_content.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-            })
+        for path in image_paths:
+            image_url = {"url": f"data:image/jpeg;base64,{encode_image(path)}"}
+            if len(image_paths) > 1:
+                image_url["detail"] = "low"  # Fixed low token cost per album photo
+            user_content.append({"type": "image_url", "image_url": image_url})
+        if len(image_paths) > 1:
+            user_content.append({"type": "text", "text": f"Nhận xét chung {len(image_paths)} ảnh này (ngắn gọn, một câu)."})
+        elif image_paths:
             user_content.append({"type": "text", "text": "Nhận xét ảnh này (ngắn gọn)."})
         
         messages.append({"role": "user", "content": user_content})
+        key_messages.append(messages[-1])
         
-        debug_log(f"Calling OpenAI API with {len(history)} messages, emotion={emotion}...")
+        debug_log("Calling OpenAI API with %d messages, emotion=%s...", len(history), emotion, stage='generate')
         
-        # Increase max_tokens from 50 to 80 for deeper responses with reasoning
-        result = await call_openai_with_retry(messages, max_tokens=80, temperature=0.9)
+        n = rt.config.reply_candidates
+        if n > 1:
+            candidates = await call_openai_candidates(messages, n, max_tokens=route.max_tokens, temperature=route.temperature,
+                                                      key_messages=key_messages, model=route.model)
+            history_texts = [h['text'] for h in history[-10:]] + ([msg_text] if msg_text else [])
+            ranked = rank_candidates(candidates, history_texts, rt.recent_responses)
+            if not ranked:
+                raise Exception("No usable completions")
+            result = ranked[0]
+            if msg_text and not image_paths:
+                cache_alternatives(msg_text, ranked[1:])
+            debug_log("Reranked %d candidates", len(ranked), stage='generate')
+        else:
+            result = await call_openai_with_retry(messages, max_tokens=route.max_tokens, temperature=route.temperature,
+                                                  purpose='reply', key_messages=key_messages, model=route.model)
         
-        debug_log(f"AI Response: {result}")
+        debug_log("AI Response: %s", result, stage='generate')
         
         # Add thinking depth if appropriate
         result = add_thinking_depth(result, emotion, context)
@@ -840,8 +3594,8 @@ async def get_ai_reply_multimodal(msg_text, history, image_path=None, my_previou
             result = f"{result} {follow_up}"
             # Track that we asked a question
             chat_id = context.get('chat_id', 0)
-            topic_memory[chat_id]['questions_asked'] += 1
-            debug_log(f"Added follow-up question: {follow_up}")
+            get_runtime().chat_state[chat_id].questions_asked += 1
+            debug_log("Added follow-up question: %s", follow_up, stage='generate')
         
         # Check relevance with history
         if not await check_relevance(result, context, history):
@@ -857,90 +3611,196 @@ async def get_ai_reply_multimodal(msg_text, history, image_path=None, my_previou
         return result
     
     except Exception as e:
-        logger.error(f"❌ AI error: {e}", exc_info=True)
-        # Use emotional phrase for errors too
-        emotion = context.get('emotion', 'playful') if context else 'playful'
-        emotional_fallback = get_random_trending_phrase('emotional_responses', emotion)
-        if emotional_fallback:
-            return emotional_fallback
-        trending_fallback = get_random_trending_phrase('reactions', 'casual')
-        return trending_fallback if trending_fallback else random.choice(["uh", "oke r", "vl"])
+        logger.error("❌ AI error: %s", e, exc_info=True)
+        return await local_fallback(msg_text, context.get('emotion', 'playful') if context else 'playful')
+    finally:
+        generation_class.reset(token)
 
 # --- TYPING SIMULATION ---
-async def simulate_human_typing(chat_id, text, reply_to=None):
-    """Simulate human typing with rate limiting"""
+TYPING_REFRESH_SECONDS = 5  # Telegram shows a typing status for about this long
+
+async def _set_typing(tg_client, chat_id):
+    from telethon import functions, types
+    return await tg_client(functions.messages.SetTypingRequest(chat_id, types.SendMessageTypingAction()))
+
+async def show_typing(tg_client, chat_id, seconds):
+    """Show the typing indicator for `seconds`; refreshes are skipped when over budget"""
+    telegram = get_runtime().telegram
+    deadline = time.monotonic() + seconds
+    while True:
+        try:
+            await telegram.run('typing', chat_id, _set_typing, tg_client, chat_id, wait=False)
+        except Exception as e:
+            debug_log("Typing indicator failed: %s", e, stage='deliver')
+        remaining = deadline - time.monotonic()
+        if remaining <= TYPING_REFRESH_SECONDS:
+            await asyncio.sleep(max(remaining, 0))
+            return
+        await asyncio.sleep(TYPING_REFRESH_SECONDS)
+
+def typing_refreshes(seconds):
+    """Typing-indicator requests needed to cover `seconds`"""
+    return max(1, -(-int(seconds) // TYPING_REFRESH_SECONDS))
+
+class TypingPlanner:
+    """Picks how much typing realism a reply can afford under current Telegram load.
+
+    'full' shows typing and may send a typo then edit it, 'indicator' shows typing
+    and sends once, 'direct' just sends. Priority scales the headroom required:
+    replies aimed at the bot keep their realism longer than background chatter.
+    """
+
+    LEVELS = ('full', 'indicator', 'direct')
+    PRIORITY_FACTOR = {'high': 0.5, 'normal': 1.0, 'low': 1.5}
+
+    def __init__(self, scheduler, full_headroom=0.5, indicator_headroom=0.25, full_max_queue=1, indicator_max_queue=4):
+        self.scheduler = scheduler
+        self.full_headroom = full_headroom
+        self.indicator_headroom = indicator_headroom
+        self.full_max_queue = full_max_queue
+        self.indicator_max_queue = indicator_max_queue
+        self.plans = defaultdict(int)
+        self.calls_saved = 0
+
+    def choose(self, chat_id, priority='normal'):
+        factor = self.PRIORITY_FACTOR.get(priority, 1.0)
+        depth = self.scheduler.pending
+        send_room = self.scheduler.headroom('send', chat_id)
+        typing_room = self.scheduler.headroom('typing', chat_id)
+        if (depth <= self.full_max_queue
+                and min(send_room, typing_room, self.scheduler.headroom('edit', chat_id)) >= self.full_headroom * factor):
+            level = 'full'
+        elif depth <= self.indicator_max_queue and min(send_room, typing_room) >= self.indicator_headroom * factor:
+            level = 'indicator'
+        else:
+            level = 'direct'
+        self.plans[level] += 1
+        return level
+
+    def record_saved(self, calls):
+        self.calls_saved += calls
+
+    def stats(self):
+        return {'calls_saved': self.calls_saved, **{f'plan_{level}': self.plans[level] for level in self.LEVELS}}
+
+@traced('typing')
+async def simulate_human_typing(chat_id, text, reply_to=None, priority='normal'):
+    """Simulate human typing at the realism level the planner allows; send errors are re-raised"""
     try:
         tg_client = get_telegram_client()
         if tg_client is None:
             logger.warning("Telegram client not initialized")
             return
+        
+        rt = get_runtime()
+        telegram = rt.telegram
+        level = rt.typing_planner.choose(chat_id, priority)
+        if level == 'full' and random.random() < 0.05:
+            await show_typing(tg_client, chat_id, random.randint(2, 5))
+            return
+        
+        typing_time = len(text) * random.uniform(0.08, 0.15)
+        wants_typo = random.random() < 0.25 and len(text) > 8
+        # API calls full realism would have made that this plan skips
+        saved = (1 if wants_typo and level != 'full' else 0) + (typing_refreshes(typing_time) if level == 'direct' else 0)
+        if saved:
+            rt.typing_planner.record_saved(saved)
+        debug_log("Typing plan: %s (saved %d calls)", level, saved, stage='deliver')
+        
+        if wants_typo and level == 'full':
+            mistake_pos = random.randint(-3, -1)
+            fake_text = text[:mistake_pos]
             
-        async with telegram_limiter:
-            if random.random() < 0.05:
-                async with tg_client.action(chat_id, 'typing'):
-                    await asyncio.sleep(random.randint(2, 5))
-                return
+            await show_typing(tg_client, chat_id, typing_time * 0.6)
             
-            async with tg_client.action(chat_id, 'typing'):
-                typing_time = len(text) * random.uniform(0.08, 0.15)
-                
-                if random.random() < 0.25 and len(text) > 8:
-                    mistake_pos = random.randint(-3, -1)
-                    fake_text = text[:mistake_pos]
-                    
-                    await asyncio.sleep(typing_time * 0.6)
-                    
-                    try:
-                        if reply_to:
-                            m = await tg_client.send_message(chat_id, fake_text, reply_to=reply_to)
-                        else:
-                            m = await tg_client.send_message(chat_id, fake_text)
-                        
-                        await asyncio.sleep(random.uniform(1, 2))
-                        
-                        final_text = add_vietnamese_typos(text)
-                        await tg_client.edit_message(chat_id, m.id, final_text)
-                        
-                    except Exception as e:
-                        logger.error(f"Typing sim error: {e}")
-                else:
-                    await asyncio.sleep(typing_time)
-                    final_text = add_vietnamese_typos(text)
-                    
-                    try:
-                        if reply_to:
-                            await tg_client.send_message(chat_id, final_text, reply_to=reply_to)
-                        else:
-                            await tg_client.send_message(chat_id, final_text)
-                    except Exception as e:
-                        logger.error(f"Send error: {e}")
+            m = await telegram.run('send', chat_id, tg_client.send_message, chat_id, fake_text, reply_to=reply_to)
+            
+            await asyncio.sleep(random.uniform(1, 2))
+            
+            # The partial text is already out; a failed edit must not trigger a resend
+            try:
+                final_text = add_vietnamese_typos(text)
+                await telegram.run('edit', chat_id, tg_client.edit_message, chat_id, m.id, final_text)
+            except Exception as e:
+                logger.error("Typing sim error: %s", e)
+        else:
+            if level != 'direct':
+                await show_typing(tg_client, chat_id, typing_time)
+            final_text = add_vietnamese_typos(text)
+            
+            await telegram.run('send', chat_id, tg_client.send_message, chat_id, final_text, reply_to=reply_to)
     except Exception as e:
-        logger.error(f"Typing simulation failed: {e}", exc_info=True)
+        logger.error("Typing simulation failed: %s", e)
+        raise
 
 # --- SMART REACTION ---
+@traced('reaction')
 async def send_smart_reaction(chat_id, msg_id, sentiment):
-    """Send smart reaction with rate limiting"""
+    """Send a reaction from its own budget; skipped rather than queued when over budget"""
     try:
         tg_client = get_telegram_client()
         if tg_client is None:
             return
-            
-        async with telegram_limiter:
-            reaction_map = {
-                'positive': ['❤', '🔥', '👍', '💯'],
-                'negative': ['😢', '💀', '😭'],
-                'funny': ['😂', '🤣', '💀'],
-                'surprise': ['😮', '🤯', '👀'],
-                'neutral': ['👍', '👀', '🙂']
-            }
-            
-            emo = random.choice(reaction_map.get(sentiment, reaction_map['neutral']))
-            
-            await asyncio.sleep(random.uniform(0.5, 2))
-            await tg_client.send_reaction(chat_id, msg_id, emo)
-            debug_log(f"Sent reaction: {emo}")
+        
+        reaction_map = {
+            'positive': ['❤', '🔥', '👍', '💯'],
+            'negative': ['😢', '💀', '😭'],
+            'funny': ['😂', '🤣', '💀'],
+            'surprise': ['😮', '🤯', '👀'],
+            'neutral': ['👍', '👀', '🙂']
+        }
+        
+        telegram = get_runtime().telegram
+        if not telegram.has_capacity('reaction', chat_id):
+            debug_log("Reaction skipped: over budget", stage='reaction')
+            return
+        
+        emo = random.choice(reaction_map.get(sentiment, reaction_map['neutral']))
+        
+        await asyncio.sleep(random.uniform(0.5, 2))
+        await telegram.run('reaction', chat_id, tg_client.send_reaction, chat_id, msg_id, emo, wait=False)
+        debug_log("Sent reaction: %s", emo, stage='reaction')
     except Exception as e:
-        logger.error(f"Reaction error: {e}")
+        logger.error("Reaction error: %s", e)
+
+# --- DELIVERY ---
+@traced('sticker')
+async def send_dice_sticker(chat_id, emoji, reply_to=None):
+    from telethon import types
+    tg_client = get_telegram_client()
+    await get_runtime().telegram.run(
+        'media', chat_id, tg_client.send_message, chat_id,
+        file=types.InputMediaDice(emoji), reply_to=reply_to
+    )
+    debug_log("🎲 Sticker: %s", emoji, stage='deliver')
+
+async def deliver_outbox_item(item):
+    """Send one outbox item; raising makes the outbox retry it"""
+    chat_id, payload = item['chat_id'], item['payload']
+    kind = item['kind']
+    queued_ms = round((time.time() - item['created_at']) * 1000) if item.get('created_at') else None
+    with get_runtime().tracer.resume(payload.get('trace'), 'deliver', kind=kind,
+                                     attempt=item.get('attempts'), queued_ms=queued_ms):
+        await _deliver_payload(chat_id, kind, payload)
+
+async def _deliver_payload(chat_id, kind, payload):
+    if kind == 'reply':
+        await simulate_human_typing(chat_id, payload['text'], reply_to=payload.get('reply_to'),
+                                    priority=payload.get('priority', 'normal'))
+        debug_log("💬 Reply: %s", payload['text'], stage='deliver')
+    elif kind == 'sticker':
+        await send_dice_sticker(chat_id, payload['emoji'], reply_to=payload.get('reply_to'))
+    elif kind == 'reaction':
+        await send_smart_reaction(chat_id, payload['msg_id'], payload['sentiment'])
+    else:
+        logger.error("Unknown outbox item kind: %s", kind)
+
+async def enqueue_delivery(chat_id, kind, source_msg_id, **payload):
+    """Queue a reply/sticker/reaction for ordered, durable delivery to chat_id"""
+    trace = trace_context()
+    if trace:
+        payload['trace'] = trace
+    return await get_runtime().outbox.enqueue(chat_id, kind, payload, source_msg_id)
 
 # --- SENTIMENT ANALYSIS ---
 def analyze_sentiment(text):
@@ -957,250 +3817,607 @@ def analyze_sentiment(text):
     
     return 'neutral'
 
-# --- MAIN HANDLER ---
-async def handler(event):
-    try:
-        tg_client = get_telegram_client()
-        if tg_client is None:
-            return
-            
-        me = await tg_client.get_me()
-        
-        debug_log(f"📩 New message from chat_id={event.chat_id}")
-        
-        # --- WHITELIST CHECK ---
-        if event.chat_id not in ALLOWED_CHAT_IDS:
-            debug_log(f"⏭️ Skipped: Chat {event.chat_id} not in whitelist")
-            return
-        
-        if event.is_private:
-            debug_log("⏭️  Skipped: Private chat")
-            return
-        
-        if event.sender_id == me.id:
-            debug_log("⏭️  Skipped: Own message")
-            return
-        
-        current_hour = datetime.datetime.now().hour
-        if SLEEP_START_HOUR <= current_hour < SLEEP_END_HOUR:
-            debug_log(f"😴 Skipped: Sleep time ({current_hour}h)")
-            return
-        
+# --- ALBUMS ---
+ALBUM_WINDOW = 1.5  # Seconds to collect the photos of one media group
+ALBUM_MAX_PHOTOS = 4  # Photos sent to the vision model per album
+PHOTO_MAX_SIDE = 1024  # Largest stored photo size downloaded (pixels, longer side)
+
+def pick_photo_size(photo, max_side=PHOTO_MAX_SIDE):
+    """Largest stored size of a Telegram photo that fits max_side (the smallest if none does)"""
+    sizes = [size for size in getattr(photo, 'sizes', None) or []
+             if isinstance(getattr(size, 'w', None), int) and isinstance(getattr(size, 'h', None), int)]
+    if not sizes:
+        return None
+    fitting = [size for size in sizes if max(size.w, size.h) <= max_side]
+    if fitting:
+        return max(fitting, key=lambda size: size.w * size.h)
+    return min(sizes, key=lambda size: size.w * size.h)
+
+async def download_photo(tg_client, message, path, max_side=PHOTO_MAX_SIDE):
+    """Download a message's photo at a size Telegram already stores, no bigger than max_side"""
+    # thumb=None makes Telethon fetch the largest size
+    await tg_client.download_media(message.photo, file=path, thumb=pick_photo_size(message.photo, max_side))
+    return path
+
+class AlbumCollector:
+    """Merges the per-photo events of one Telegram album (same grouped_id).
+
+    The first event of a group waits `window` seconds and gets back every event
+    that arrived meanwhile; the others get None and stop, so an album costs one
+    download pass, one delay, one vision request and one reply.
+    """
+
+    def __init__(self, window=ALBUM_WINDOW, max_photos=ALBUM_MAX_PHOTOS):
+        self.window = window
+        self.max_photos = max_photos
+        self.groups = {}  # grouped_id -> events collected so far
+        self.closed = TTLCache(maxsize=1000, ttl=60)  # Recently answered groups, to drop stragglers
+        self.counters = defaultdict(int)
+
+    async def collect(self, event):
+        """All events of the album (oldest first) for its first event, None for the rest"""
+        grouped_id = event.message.grouped_id
+        events = self.groups.get(grouped_id)
+        if events is not None:
+            events.append(event)
+            self.counters['merged'] += 1
+            return None
+        if grouped_id in self.closed:
+            self.counters['late'] += 1
+            return None
+        events = self.groups[grouped_id] = [event]
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            self.groups.pop(grouped_id, None)
+            self.closed[grouped_id] = True
+        self.counters['albums'] += 1
+        self.counters['photos'] += len(events)
+        events.sort(key=lambda e: e.message.id)
+        return events[:self.max_photos]
+
+    def stats(self):
+        return dict(self.counters)
+
+# --- BACKLOG CATCH-UP ---
+BACKLOG_SETTLE_SECONDS = 3.0  # Quiet time after a chat's last stale message before answering it
+BACKLOG_REPLY_MAX_AGE = 600  # Targeted backlog messages older than this get no reply at all
+
+def message_age(event, now=None):
+    """Seconds since the event's message was sent (0 if the date is unknown)"""
+    date = getattr(event.message, 'date', None)
+    if not isinstance(date, datetime.datetime):
+        return 0.0
+    return max(0.0, (now or time.time()) - date.timestamp())
+
+class BacklogHandler:
+    """Absorbs messages that arrive late (after a restart or reconnect) in one cheap pass.
+
+    Stale messages only feed trending and the message archive. The latest
+    targeted one per chat is remembered and, once the chat's backlog has been
+    quiet for `settle` seconds, replayed through the normal handler, so a
+    catch-up burst costs at most one reply per chat.
+    """
+
+    def __init__(self, stale_after, replay, settle=BACKLOG_SETTLE_SECONDS, reply_max_age=BACKLOG_REPLY_MAX_AGE):
+        self.stale_after = stale_after
+        self.replay = replay
+        self.settle = settle
+        self.reply_max_age = reply_max_age
+        self.latest_targeted = {}  # chat_id -> newest targeted stale event
+        self._flushes = {}  # chat_id -> pending flush task
+        self.counters = defaultdict(int)
+
+    def is_stale(self, event):
+        return message_age(event) > self.stale_after
+
+    @staticmethod
+    def looks_targeted(event, msg_text):
+        """Targeting check without API calls: Telegram's mention flag covers replies to us"""
+        return bool(getattr(event.message, 'mentioned', False)) or any(n in msg_text for n in ['tèo', 'teo', 'bot', '@'])
+
+    def absorb(self, event, msg_text):
+        """Record a stale message; the caller has already updated trending/history"""
         chat_id = event.chat_id
-        topic_id = event.message.reply_to_msg_id if event.message.reply_to else None
-        msg_text = event.raw_text.lower() if event.raw_text else ""
-        unique_key = f"{chat_id}_{topic_id}"
-        
-        # --- INPUT VALIDATION ---
-        if msg_text and not validate_message_input(msg_text):
-            logger.warning(f"Invalid message input from chat {chat_id}")
-            return
-        
-        debug_log(f"📝 Message text: '{msg_text[:50]}...'")
-        
-        if msg_text:
-            update_trending(chat_id, msg_text)
-        
-        is_targeted = False
-        my_previous_content = None
-        
-        if event.is_reply:
-            try:
-                reply = await event.get_reply_message()
-                if reply and reply.sender_id == me.id:
-                    is_targeted = True
-                    my_previous_content = reply.message
-                    debug_log("🎯 Targeted: Reply to my message")
-            except:
-                pass
-        
-        if any(n in msg_text for n in ['tèo', 'teo', 'bot', '@']):
-            is_targeted = True
-            debug_log("🎯 Targeted: Mentioned in message")
-        
-        has_photo = event.message.photo is not None
-        if has_photo:
-            debug_log("📷 Photo detected")
-        
-        dangerous = ['scam', 'lừa đảo', 'sập', 'bùng', 'công an', 'bắt']
-        if any(w in msg_text for w in dangerous) and not is_targeted:
-            debug_log("⚠️  Skipped: Dangerous content")
+        self.counters['absorbed'] += 1
+        if self.looks_targeted(event, msg_text):
+            previous = self.latest_targeted.get(chat_id)
+            if previous is None or event.message.id > previous.message.id:
+                if previous is not None:
+                    self.counters['superseded'] += 1
+                self.latest_targeted[chat_id] = event
+        pending = self._flushes.get(chat_id)
+        if pending is not None:
+            pending.cancel()
+        self._flushes[chat_id] = asyncio.ensure_future(self._flush_later(chat_id))
+
+    async def _flush_later(self, chat_id):
+        await asyncio.sleep(self.settle)
+        self._flushes.pop(chat_id, None)
+        event = self.latest_targeted.pop(chat_id, None)
+        if event is None:
             return
-        
-        now = time.time()
-        trigger_words = ['kèo', 'bóng', 'húp', 'lãi', 'thua', 'gỡ', 'đá', 'trận']
-        
-        has_trigger = any(w in msg_text for w in trigger_words)
-        random_trigger = random.random() < TRIGGER_PROBABILITY
-        
-        should_reply = is_targeted or has_photo or has_trigger or random_trigger
-        
-        debug_log(f"Decision: targeted={is_targeted}, photo={has_photo}, trigger={has_trigger}, random={random_trigger}")
-        debug_log(f"Should reply: {should_reply}")
-        
-        if not is_targeted and not has_photo:
-            if unique_key in last_chat_time:
-                time_diff = now - last_chat_time[unique_key]
-                if time_diff < RATE_LIMIT_SECONDS:
-                    debug_log(f"⏱️  Rate limited: {time_diff:.1f}s < {RATE_LIMIT_SECONDS}s")
-                    return
-        
-        if not should_reply:
-            if random.random() < 0.2:
-                sentiment = analyze_sentiment(msg_text)
-                await send_smart_reaction(chat_id, event.message.id, sentiment)
-                debug_log("👍 Sent reaction only")
-            else:
-                debug_log("⏭️  Skipped: No reply needed")
+        if message_age(event) > self.reply_max_age:
+            self.counters['too_old'] += 1
             return
-        
-        # BẮT ĐẦU XỬ LÝ
-        debug_log("✅ Processing message...")
-        last_chat_time[unique_key] = now
-        
-        image_path = None
-        if has_photo:
+        self.counters['replayed'] += 1
+        await self.replay(event, catch_up=True)
+
+    async def close(self):
+        tasks = list(self._flushes.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._flushes.clear()
+
+    def stats(self):
+        return {**self.counters, 'pending_chats': len(self._flushes)}
+
+# --- MAIN HANDLER ---
+async def handler(event, catch_up=False):
+    """Entry point for NewMessage events; tags log records with chat/message ids and starts a trace"""
+    msg_id = getattr(event.message, 'id', None)
+    admission = get_runtime().admission
+    if not admission.enter():
+        debug_log("🚦 Shed: %d handlers in flight", admission.inflight, stage='admission')
+        return
+    token = log_context.set({'chat_id': event.chat_id, 'msg_id': msg_id})
+    chat_token = current_chat.set(event.chat_id)
+    try:
+        with get_runtime().tracer.start_trace('message', chat_id=event.chat_id, msg_id=msg_id, catch_up=catch_up):
+            await handle_message(event, catch_up)
+    finally:
+        current_chat.reset(chat_token)
+        log_context.reset(token)
+        admission.leave()
+
+async def handle_message(event, catch_up=False):
+    """Run one message through the pipeline; catch_up=True is a replayed backlog message whose state was already recorded"""
+    ctx = MessageContext(event=event, catch_up=catch_up)
+    try:
+        await get_runtime().pipeline.run(ctx)
+    except Exception as e:
+        logger.error("❌ Handler error: %s", e, exc_info=True)
+    finally:
+        remove_temp_images(ctx)
+    return ctx
+
+# --- MESSAGE PIPELINE ---
+@dataclasses.dataclass
+class MessageContext:
+    """Everything one message accumulates on its way through the pipeline stages"""
+    event: object
+    catch_up: bool = False
+    tg_client: object = None
+    me: object = None
+    chat_id: int = None
+    topic_id: int = None
+    msg_text: str = ''
+    sentiment: str = 'neutral'
+    album: list = None
+    has_photo: bool = False
+    is_targeted: bool = False
+    my_previous_content: str = None
+    has_trigger: bool = False
+    random_trigger: bool = False
+    downgraded: bool = False
+    now: float = 0.0
+    photo_paths: list = dataclasses.field(default_factory=list)  # Temp files created for this message
+    image_paths: list = dataclasses.field(default_factory=list)  # The ones that downloaded
+    history: list = dataclasses.field(default_factory=list)
+    context: dict = None
+    reply: str = None
+    reply_source: str = None  # 'rule', 'cache', 'pool', 'local' or 'ai'
+    deliveries: list = dataclasses.field(default_factory=list)  # (kind, payload) in send order
+    stop_reason: str = None
+
+    @property
+    def thread_key(self):
+        return (self.chat_id, self.topic_id)
+
+    def stop(self, reason):
+        """End the pipeline after the current stage"""
+        self.stop_reason = reason
+
+class Pipeline:
+    """Runs a MessageContext through named async stages, in order.
+
+    A stage ends the run early with ctx.stop(reason), so the cheapest
+    rejections go first. Each stage gets its own trace span and profiler
+    label; hooks are called as hook(stage, ctx, seconds) after every stage,
+    and per-stage timings and stop reasons are kept for stats().
+    """
+
+    def __init__(self, stages, hooks=None):
+        self.stages = list(stages)
+        self.hooks = list(hooks or [])
+        self.timings = defaultdict(lambda: [0, 0.0, 0.0])  # stage -> [runs, total, max]
+        self.stops = defaultdict(int)
+
+    def insert(self, before, name, stage):
+        """Plug a stage in ahead of an existing one"""
+        index = [existing for existing, _ in self.stages].index(before)
+        self.stages.insert(index, (name, stage))
+
+    async def run(self, ctx):
+        for name, stage in self.stages:
+            mark_stage(name)
+            started = time.perf_counter()
+            with span(name):
+                await stage(ctx)
+            elapsed = time.perf_counter() - started
+            timing = self.timings[name]
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+            for hook in self.hooks:
+                hook(name, ctx, elapsed)
+            if ctx.stop_reason is not None:
+                self.stops[f"{name}: {ctx.stop_reason}"] += 1
+                break
+        return ctx
+
+    def stats(self):
+        stages = {
+            name: {'runs': runs, 'avg_ms': round(total / runs * 1000, 2), 'max_ms': round(worst * 1000, 2)}
+            for name, (runs, total, worst) in self.timings.items()
+        }
+        return {'stages': stages, 'stops': dict(self.stops)}
+
+async def get_self(tg_client):
+    """The bot's own user, fetched once per runtime"""
+    rt = get_runtime()
+    if rt.me is None:
+        rt.me = await tg_client.get_me()
+    return rt.me
+
+def remove_temp_images(ctx):
+    """Delete the message's downloaded photos"""
+    temp_files = get_runtime().temp_files
+    for image_path in ctx.photo_paths:
+        try:
+            if os.path.exists(image_path):
+                os.remove(image_path)
+                debug_log("🗑️  Removed image: %s", image_path, stage='cleanup')
+            if image_path in temp_files:
+                temp_files.remove(image_path)
+        except Exception as e:
+            logger.error("Failed to remove image: %s", e)
+    ctx.photo_paths = []
+
+async def prefilter_stage(ctx):
+    """Whitelist, private chats, sleep hours, own messages and input validation"""
+    event = ctx.event
+    ctx.tg_client = get_telegram_client()
+    if ctx.tg_client is None:
+        return ctx.stop('no client')
+    
+    debug_log("📩 New message from chat_id=%s", event.chat_id, stage='received')
+    
+    # Telethon already filters on chats/incoming (see main); these also cover replays and tests
+    if event.chat_id not in ALLOWED_CHAT_IDS:
+        debug_log("⏭️ Skipped: Chat %s not in whitelist", event.chat_id, stage='filter')
+        return ctx.stop('not whitelisted')
+    
+    if event.is_private:
+        debug_log("⏭️  Skipped: Private chat", stage='filter')
+        return ctx.stop('private')
+    
+    current_hour = datetime.datetime.now().hour
+    if SLEEP_START_HOUR <= current_hour < SLEEP_END_HOUR:
+        debug_log("😴 Skipped: Sleep time (%dh)", current_hour, stage='filter')
+        return ctx.stop('sleeping')
+    
+    ctx.me = await get_self(ctx.tg_client)
+    if event.sender_id == ctx.me.id:
+        debug_log("⏭️  Skipped: Own message", stage='filter')
+        return ctx.stop('own message')
+    
+    ctx.chat_id = event.chat_id
+    ctx.topic_id = event.message.reply_to_msg_id if event.message.reply_to else None
+    ctx.msg_text = event.raw_text.lower() if event.raw_text else ""
+    
+    if ctx.msg_text and not validate_message_input(ctx.msg_text):
+        logger.warning("Invalid message input from chat %s", ctx.chat_id)
+        return ctx.stop('invalid input')
+    
+    debug_log("📝 Message text: '%.50s...'", ctx.msg_text, stage='filter')
+
+async def record_stage(ctx):
+    """Update trending, the message archive and user context; backlog messages stop here"""
+    rt = get_runtime()
+    event = ctx.event
+    ctx.sentiment = analyze_sentiment(ctx.msg_text)
+    if ctx.catch_up:
+        return  # Recorded when the backlog absorbed it
+    
+    if ctx.msg_text:
+        update_trending(ctx.chat_id, ctx.msg_text)
+        remember_message(ctx.chat_id, event.sender_id, ctx.msg_text, ctx.sentiment,
+                         getattr(event.sender, 'first_name', None))
+    
+    if rt.backlog.is_stale(event):
+        # Delivered late (restart/reconnect): keep the state, answer at most the latest targeted message
+        rt.backlog.absorb(event, ctx.msg_text)
+        debug_log("🕰️  Backlog: %.0fs old, not replying", message_age(event), stage='backlog')
+        return ctx.stop('backlog')
+    
+    rt.reply_pool.touch()
+    if event.sender_id:
+        await rt.user_contexts.record_interaction(ctx.chat_id, event.sender_id, ctx.sentiment)
+
+async def classify_stage(ctx):
+    """Merge albums, then find out if the message is targeted, a photo or a trigger"""
+    event = ctx.event
+    ctx.has_photo = event.message.photo is not None
+    grouped_id = getattr(event.message, 'grouped_id', None)
+    if ctx.has_photo and grouped_id:
+        ctx.album = await get_runtime().albums.collect(event)
+        if ctx.album is None:
+            debug_log("🖼️  Album %s: answered with its first photo", grouped_id, stage='album')
+            return ctx.stop('album member')
+        debug_log("🖼️  Album %s: %d photos", grouped_id, len(ctx.album), stage='album')
+        # The caption is on one of the album's messages
+        if not ctx.msg_text:
+            ctx.msg_text = next((e.raw_text.lower() for e in ctx.album if e.raw_text), '')
+    
+    if event.is_reply:
+        try:
+            reply = await event.get_reply_message()
+            if reply and reply.sender_id == ctx.me.id:
+                ctx.is_targeted = True
+                ctx.my_previous_content = reply.message
+                debug_log("🎯 Targeted: Reply to my message", stage='decision')
+        except Exception:
+            pass
+    
+    if any(n in ctx.msg_text for n in ['tèo', 'teo', 'bot', '@']):
+        ctx.is_targeted = True
+        debug_log("🎯 Targeted: Mentioned in message", stage='decision')
+    
+    if ctx.has_photo:
+        debug_log("📷 Photo detected", stage='decision')
+    
+    dangerous = ['scam', 'lừa đảo', 'sập', 'bùng', 'công an', 'bắt']
+    if any(w in ctx.msg_text for w in dangerous) and not ctx.is_targeted:
+        debug_log("⚠️  Skipped: Dangerous content", stage='decision')
+        return ctx.stop('dangerous')
+    
+    trigger_words = ['kèo', 'bóng', 'húp', 'lãi', 'thua', 'gỡ', 'đá', 'trận']
+    ctx.has_trigger = any(w in ctx.msg_text for w in trigger_words)
+
+async def admit_stage(ctx):
+    """Reply, react or skip, within the thread rate limit and the admission controller's budget"""
+    rt = get_runtime()
+    admission = rt.admission
+    ctx.now = time.time()
+    maybe_report_state(ctx.now)
+    
+    ctx.random_trigger = random.random() < admission.trigger_probability()
+    should_reply = ctx.is_targeted or ctx.has_photo or ctx.has_trigger or ctx.random_trigger
+    ctx.downgraded = should_reply and not ctx.is_targeted and admission.reaction_only
+    if ctx.downgraded:
+        debug_log("🚦 Reaction-only mode: reacting instead of replying", stage='admission')
+        should_reply = False
+    
+    debug_log("Decision: targeted=%s, photo=%s, trigger=%s, random=%s",
+              ctx.is_targeted, ctx.has_photo, ctx.has_trigger, ctx.random_trigger, stage='decision')
+    debug_log("Should reply: %s", should_reply, stage='decision')
+    
+    if not ctx.is_targeted and not ctx.has_photo:
+        thread = rt.thread_state.peek(ctx.thread_key)
+        if thread is not None:
+            time_diff = ctx.now - thread.last_reply_time
+            rate_limit = admission.rate_limit_seconds()
+            if time_diff < rate_limit:
+                debug_log("⏱️  Rate limited: %.1fs < %.0fs", time_diff, rate_limit, stage='decision')
+                return ctx.stop('rate limited')
+    
+    if not should_reply:
+        msg_id = ctx.event.message.id
+        if ctx.downgraded or random.random() < admission.reaction_probability():
+            await enqueue_delivery(ctx.chat_id, 'reaction', msg_id, msg_id=msg_id, sentiment=analyze_sentiment(ctx.msg_text))
+            debug_log("👍 Sent reaction only", stage='reaction')
+            return ctx.stop('reaction only')
+        debug_log("⏭️  Skipped: No reply needed", stage='decision')
+        return ctx.stop('no reply needed')
+    
+    # BẮT ĐẦU XỬ LÝ
+    debug_log("✅ Processing message...", stage='decision')
+    rt.thread_state[ctx.thread_key].last_reply_time = ctx.now
+
+async def prepare_stage(ctx):
+    """Download photos (an album at once) and wait like a human would"""
+    if ctx.has_photo:
+        photo_events = ctx.album or [ctx.event]
+        ctx.photo_paths = [f"temp_img_{ctx.chat_id}_{e.message.id}.jpg" for e in photo_events]
+        get_runtime().temp_files.extend(ctx.photo_paths)  # Track for cleanup
+        try:
+            with span('download', photos=len(ctx.photo_paths)):
+                await asyncio.gather(*(download_photo(ctx.tg_client, e.message, path)
+                                       for e, path in zip(photo_events, ctx.photo_paths)))
+            ctx.image_paths = list(ctx.photo_paths)
+            debug_log("📥 Downloaded %d image(s): %s", len(ctx.image_paths), ctx.image_paths, stage='download')
+            await asyncio.sleep(random.uniform(2, 4))
+        except Exception as e:
+            logger.error("Image download error: %s", e, exc_info=True)
+    
+    wait_time = random.uniform(2, 5) if ctx.is_targeted else random.uniform(4, 10)
+    debug_log("⏳ Waiting %.1fs...", wait_time, stage='delay')
+    with span('delay', seconds=round(wait_time, 2)):
+        await asyncio.sleep(wait_time)
+
+async def local_reply_stage(ctx):
+    """Answers that need no history or API call: rules, the reply cache, the reply pool, the local generator"""
+    if ctx.has_photo or ctx.is_targeted:
+        return
+    
+    simple = check_simple_response(ctx.msg_text)
+    if simple:
+        debug_log("✅ Rule-based: %s", simple, stage='generate')
+        ctx.reply, ctx.reply_source = simple, 'rule'
+        return
+    
+    cached = get_cached_response(ctx.msg_text)
+    if cached:
+        debug_log("💾 Cache hit: %s", cached, stage='generate')
+        ctx.reply, ctx.reply_source = cached, 'cache'
+        return
+    
+    # Plain random triggers are low priority: answer from the reply pool or locally, without the API
+    if ctx.random_trigger and not ctx.has_trigger:
+        rt = get_runtime()
+        emotion = get_emotional_context(ctx.msg_text, [])
+        local = rt.reply_pool.take(current_mood['state'], emotion, await get_trending_topic_async(ctx.chat_id))
+        if local:
+            debug_log("🪣 Pool reply: %s", local, stage='generate')
+            ctx.reply, ctx.reply_source = local, 'pool'
+        elif rt.config.local_random_replies:
             try:
-                image_path = f"temp_img_{chat_id}_{event.message.id}.jpg"
-                temp_files.append(image_path)  # Track for cleanup
-                await tg_client.download_media(event.message.photo, file=image_path)
-                debug_log(f"📥 Downloaded image: {image_path}")
-                await asyncio.sleep(random.uniform(2, 4))
+                local = await call_local_generator([{"role": "user", "content": ctx.msg_text}], condition=ctx.sentiment)
+                debug_log("🧩 Local reply: %s", local, stage='generate')
+                ctx.reply, ctx.reply_source = local or None, 'local'
             except Exception as e:
-                logger.error(f"Image download error: {e}", exc_info=True)
-                image_path = None
-        
-        if is_targeted:
-            wait_time = random.uniform(2, 5)
-        else:
-            wait_time = random.uniform(4, 10)
-        
-        debug_log(f"⏳ Waiting {wait_time:.1f}s...")
-        await asyncio.sleep(wait_time)
-        
-        if not has_photo and not is_targeted:
-            simple = check_simple_response(msg_text)
-            if simple:
-                debug_log(f"✅ Rule-based: {simple}")
-                await simulate_human_typing(chat_id, simple, reply_to=topic_id)
-                return
-        
-        if not has_photo and not is_targeted:
-            cached = get_cached_response(msg_text)
-            if cached:
-                debug_log(f"💾 Cache hit: {cached}")
-                await simulate_human_typing(chat_id, cached, reply_to=topic_id)
-                return
-        
-        history = []
-        try:
-            # Expand history from 21 to 31 messages (to get up to 25-30 excluding bot's own)
-            async for m in tg_client.iter_messages(chat_id, limit=31, reply_to=topic_id):
+                debug_log("Local generator unavailable: %s", e, stage='generate')
+
+async def enrich_stage(ctx):
+    """Recent chat history and the prompt context for an AI reply"""
+    if ctx.reply is not None:
+        return
+    message_class = classify_message(ctx.has_photo, ctx.my_previous_content is not None,
+                                     ctx.is_targeted, ctx.has_trigger)
+    limit = history_fetch_limit(get_runtime().router, message_class)
+    try:
+        # A short recent window sized by the route; retrieve_related_messages supplies older context
+        with span('history', limit=limit) as history_span:
+            async for m in ctx.tg_client.iter_messages(ctx.chat_id, limit=limit, reply_to=ctx.topic_id):
                 if m.text and not getattr(m.sender, 'bot', False):
-                    history.append({
+                    ctx.history.append({
                         'name': getattr(m.sender, 'first_name', 'U'),
-                        'text': m.text[:100]
+                        'text': m.text[:100],
+                        'full_text': m.text  # Matched against the archive, which stores whole messages
                     })
-            debug_log(f"📜 Got {len(history)} history messages")
-        except Exception as e:
-            logger.error(f"Failed to fetch history: {e}")
-        
-        history.reverse()
-        
-        # Get emotional context
-        emotion = get_emotional_context(msg_text, history)
-        
-        context = {
-            'trending': get_trending_topic(chat_id),
-            'mood': current_mood['state'],
-            'emotion': emotion,
-            'chat_id': chat_id
-        }
-        
-        debug_log(f"🧠 Context: mood={context['mood']}, emotion={emotion}, trending={context['trending']}")
-        
-        ai_reply = await get_ai_reply_multimodal(
-            msg_text, 
-            history, 
-            image_path, 
-            my_previous_content,
-            context
-        )
-        
-        # Cleanup image file immediately after use
-        if image_path and os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-                if image_path in temp_files:
-                    temp_files.remove(image_path)
-                debug_log(f"🗑️  Removed image: {image_path}")
-            except Exception as e:
-                logger.error(f"Failed to remove image: {e}")
+            history_span.set(messages=len(ctx.history))
+        debug_log("📜 Got %d history messages", len(ctx.history), stage='history')
+    except Exception as e:
+        logger.error("Failed to fetch history: %s", e)
+    
+    ctx.history.reverse()
+    
+    emotion = get_emotional_context(ctx.msg_text, ctx.history)
+    ctx.context = {
+        'trending': await get_trending_topic_async(ctx.chat_id),
+        'mood': current_mood['state'],
+        'emotion': emotion,
+        'chat_id': ctx.chat_id,
+        'message_class': message_class
+    }
+    
+    debug_log("🧠 Context: mood=%s, emotion=%s, trending=%s",
+              ctx.context['mood'], emotion, ctx.context['trending'], stage='context')
+
+async def generate_stage(ctx):
+    """AI reply (text and photos) when no cheaper answer was found"""
+    if ctx.reply is not None:
+        return
+    ctx.reply = await get_ai_reply_multimodal(
+        ctx.msg_text,
+        ctx.history,
+        ctx.image_paths or None,
+        ctx.my_previous_content,
+        ctx.context
+    )
+    ctx.reply_source = 'ai'
+
+async def postprocess_stage(ctx):
+    """Turn the reply into deliveries: tags, stickers, variation, fallbacks and reactions"""
+    remove_temp_images(ctx)  # Not needed after generation
+    if not ctx.reply:
+        return ctx.stop('no reply')
+    
+    msg_id = ctx.event.message.id
+    if ctx.reply_source in ('rule', 'cache'):
+        ctx.deliveries.append(('reply', {'text': ctx.reply, 'reply_to': ctx.topic_id}))
+        return
+    if ctx.reply_source in ('pool', 'local'):
+        ctx.deliveries.append(('reply', {'text': add_response_variation(ctx.reply), 'reply_to': ctx.topic_id,
+                                         'priority': 'low'}))
+        return
+    
+    ai_reply = ctx.reply
+    if not ctx.has_photo:
+        cache_response(ctx.msg_text, ai_reply)
+    
+    priority = 'high' if ctx.is_targeted else 'normal'
+    if '[sticker]' in ai_reply:
+        sticker_emo = random.choice(['😂', '👍', '🔥', '👀'])
+        ctx.deliveries.append(('sticker', {'emoji': sticker_emo, 'reply_to': ctx.topic_id}))
         
-        if ai_reply:
-            if not has_photo:
-                cache_response(msg_text, ai_reply)
-            
-            if '[sticker]' in ai_reply:
-                sticker_emo = random.choice(['😂', '👍', '🔥', '👀'])
-                try:
-                    async with telegram_limiter:
-                        if topic_id:
-                            await tg_client.send_message(chat_id, file=types.InputMediaDice(sticker_emo), reply_to=topic_id)
-                        else:
-                            await tg_client.send_message(chat_id, file=types.InputMediaDice(sticker_emo))
-                        debug_log(f"🎲 Sticker: {sticker_emo}")
-                except Exception as e:
-                    logger.error(f"Sticker send error: {e}")
-                
-                clean_reply = re.sub(r'\[.*?\]', '', ai_reply).strip()
-                if clean_reply and len(clean_reply) > 2:
-                    # Add variation to avoid repetition
-                    clean_reply = add_response_variation(clean_reply)
-                    await simulate_human_typing(chat_id, clean_reply, reply_to=topic_id)
-            else:
-                final = clean_text(re.sub(r'\[.*?\]', '', ai_reply))
-                
-                if not final or len(final) < 2:
-                    # Use trending phrases for fallback
-                    trending_fallback = get_random_trending_phrase('reactions', 'casual')
-                    final = trending_fallback if trending_fallback else random.choice(['uh', 'oke', 'vl'])
-                
-                # Add variation to avoid repetition
-                final = add_response_variation(final)
-                
-                target_msg_id = event.message.id if is_targeted else topic_id
-                
-                await simulate_human_typing(chat_id, final, reply_to=target_msg_id)
-                debug_log(f"💬 Reply: {final}")
-                
-                sentiment_map = {
-                    '[vui]': 'positive',
-                    '[hai]': 'funny', 
-                    '[like]': 'positive',
-                    '[buon]': 'negative',
-                    '[wow]': 'surprise'
-                }
-                
-                for tag, sent in sentiment_map.items():
-                    if tag in ai_reply and random.random() < 0.5:
-                        await send_smart_reaction(chat_id, event.message.id, sent)
-                        break
+        clean_reply = re.sub(r'\[.*?\]', '', ai_reply).strip()
+        if clean_reply and len(clean_reply) > 2:
+            # Add variation to avoid repetition
+            clean_reply = add_response_variation(clean_reply)
+            ctx.deliveries.append(('reply', {'text': clean_reply, 'reply_to': ctx.topic_id, 'priority': priority}))
+        return
     
-    except Exception as e:
-        logger.error(f"❌ Handler error: {e}", exc_info=True)
+    final = clean_text(re.sub(r'\[.*?\]', '', ai_reply))
+    
+    if not final or len(final) < 2:
+        # Use trending phrases for fallback
+        trending_fallback = get_random_trending_phrase('reactions', 'casual')
+        final = trending_fallback if trending_fallback else random.choice(['uh', 'oke', 'vl'])
+    
+    # Add variation to avoid repetition
+    final = add_response_variation(final)
+    
+    target_msg_id = msg_id if ctx.is_targeted else ctx.topic_id
+    ctx.deliveries.append(('reply', {'text': final, 'reply_to': target_msg_id, 'priority': priority}))
+    
+    sentiment_map = {
+        '[vui]': 'positive',
+        '[hai]': 'funny', 
+        '[like]': 'positive',
+        '[buon]': 'negative',
+        '[wow]': 'surprise'
+    }
+    
+    for tag, sent in sentiment_map.items():
+        if tag in ai_reply and random.random() < 0.5:
+            ctx.deliveries.append(('reaction', {'msg_id': msg_id, 'sentiment': sent}))
+            break
+
+async def deliver_stage(ctx):
+    """Queue the deliveries on the outbox, in order"""
+    for kind, payload in ctx.deliveries:
+        await enqueue_delivery(ctx.chat_id, kind, ctx.event.message.id, **payload)
+
+# Cheapest rejections first; generation stages skip themselves once ctx.reply is set
+MESSAGE_STAGES = [
+    ('prefilter', prefilter_stage),
+    ('record', record_stage),
+    ('classify', classify_stage),
+    ('admit', admit_stage),
+    ('prepare', prepare_stage),
+    ('local_reply', local_reply_stage),
+    ('enrich', enrich_stage),
+    ('generate', generate_stage),
+    ('postprocess', postprocess_stage),
+    ('deliver', deliver_stage),
+]
 
 # --- START BOT ---
 def main():
     """Main function to start the bot"""
+    runtime = create_runtime()
     logger.info("=" * 50)
     logger.info("🤖 Tèo Bot V9 - ENHANCED VERSION")
     logger.info("=" * 50)
     logger.info("⚙️  DEBUG MODE: ON")
-    logger.info(f"⏰ Sleep hours: {SLEEP_START_HOUR}h - {SLEEP_END_HOUR}h")
-    logger.info(f"🎲 Trigger probability: {TRIGGER_PROBABILITY*100}%")
-    logger.info(f"⏱️  Rate limit: {RATE_LIMIT_SECONDS}s")
-    logger.info(f"🔐 Allowed chats: {ALLOWED_CHAT_IDS}")
+    logger.info("⏰ Sleep hours: %sh - %sh", SLEEP_START_HOUR, SLEEP_END_HOUR)
+    logger.info("🎲 Trigger probability: %s%%", TRIGGER_PROBABILITY*100)
+    logger.info("⏱️  Rate limit: %ss", RATE_LIMIT_SECONDS)
+    logger.info("🔐 Allowed chats: %s", ALLOWED_CHAT_IDS)
+    logger.info("🚀 Import time: %.0fms (budget %.0fms)", IMPORT_SECONDS * 1000, IMPORT_TIME_BUDGET * 1000)
     logger.info("=" * 50)
     
     try:
@@ -1210,9 +4427,16 @@ def main():
             return
         
         # Register the event handler
-        tg_client.add_event_handler(handler, events.NewMessage())
+        import signal
+        from telethon import events
+        # Filter at the Telethon level so other chats and our own messages never reach the pipeline
+        tg_client.add_event_handler(handler, events.NewMessage(chats=list(ALLOWED_CHAT_IDS), incoming=True))
         
         tg_client.start()
+        tg_client.loop.run_until_complete(runtime.start())
+        if hasattr(signal, 'SIGUSR1'):
+            tg_client.loop.add_signal_handler(signal.SIGUSR1, start_profiling)
+            logger.info("🔬 kill -USR1 %s profiles the bot for %.0fs", os.getpid(), runtime.config.profile_seconds)
         logger.info("🟢 Bot is online!")
         logger.info("📊 Waiting for messages...")
         logger.info("💡 Tip: Send 'kèo gì' to test quickly")
@@ -1220,7 +4444,35 @@ def main():
     except KeyboardInterrupt:
         logger.info("\n⏹️  Bot stopped by user")
     except Exception as e:
-        logger.error(f"❌ Startup error: {e}", exc_info=True)
+        logger.error("❌ Startup error: %s", e, exc_info=True)
+    finally:
+        # Flush queued DB writes before exiting
+        tg_client = runtime.telegram_client
+        if tg_client is not None:
+            try:
+                tg_client.loop.run_until_complete(runtime.close())
+                logger.info("📊 DB stats: %s", runtime.db.stats())
+                logger.info("📊 Telegram stats: %s", runtime.telegram.stats())
+                logger.info("📊 Typing plans: %s", runtime.typing_planner.stats())
+                logger.info("📊 Outbox: %s", runtime.outbox.stats())
+                logger.info("📊 OpenAI single-flight: %s", runtime.openai_flights.stats())
+                logger.info("📊 Backends: %s", runtime.backends.stats())
+                logger.info("📊 Generation by message class: %s", runtime.router.stats())
+                logger.info("📊 Reply pool: %s", runtime.reply_pool.stats())
+                logger.info("📊 Local generator: %s", runtime.local_generator.stats())
+                logger.info("📊 State snapshots: %s", runtime.snapshots.stats())
+                logger.info("📊 Tracing: %s", runtime.tracer.stats())
+                logger.info("📊 Admission: %s", runtime.admission.stats())
+                logger.info("📊 Backlog catch-up: %s", runtime.backlog.stats())
+                logger.info("📊 Albums: %s", runtime.albums.stats())
+                logger.info("📊 Pipeline: %s", runtime.pipeline.stats())
+                logger.info("📊 Fair queue waits: openai=%s telegram=%s",
+                            runtime.openai_limiter.stats(), runtime.telegram.fair_stats())
+                logger.info("📊 Logging stats: %s", logging_stats())
+            except Exception as e:
+                logger.error("DB shutdown error: %s", e)
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
 
 if __name__ == "__main__":
     main()
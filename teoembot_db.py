@@ -0,0 +1,243 @@
+"""
+SQLite schema and database operations for teoembot.
+
+Kept out of teoembot.py so SQLAlchemy is only imported when the bot actually
+opens its database. Operations take a Session as their first argument so they
+can be run by AsyncDatabase (reads on the thread pool, writes on the writer).
+"""
+from sqlalchemy import create_engine, event, text, Column, Index, Integer, String, Float, JSON
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+Base = declarative_base()
+
+class TrendingTopic(Base):
+    __tablename__ = 'trending_topics'
+    __table_args__ = (Index('ix_trending_chat_time', 'chat_id', 'timestamp'),)
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer)
+    word = Column(String)
+    timestamp = Column(Float)
+
+class UserContext(Base):
+    __tablename__ = 'user_contexts'
+    __table_args__ = (Index('ux_user_contexts_chat_user', 'chat_id', 'user_id', unique=True),)
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer)
+    user_id = Column(Integer)
+    last_topic = Column(String)
+    sentiment = Column(String)
+    last_interaction = Column(Float)
+    interaction_count = Column(Integer)
+    context_data = Column(JSON)
+
+class OutboxItem(Base):
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        # One delivery of each kind per source message
+        Index('ux_outbox_source', 'chat_id', 'source_msg_id', 'kind', unique=True),
+        Index('ix_outbox_status', 'status', 'id'),
+    )
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer)
+    kind = Column(String)
+    source_msg_id = Column(Integer)
+    payload = Column(JSON)
+    created_at = Column(Float)
+    attempts = Column(Integer, default=0)
+    status = Column(String, default='pending')
+
+class ChatMessage(Base):
+    __tablename__ = 'chat_messages'
+    __table_args__ = (Index('ix_chat_messages_chat_time', 'chat_id', 'timestamp'),)
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer)
+    sender_id = Column(Integer)
+    sender_name = Column(String)
+    text = Column(String)
+    sentiment = Column(String)
+    timestamp = Column(Float)
+
+# Full-text index over chat_messages.text, kept in sync by triggers. remove_diacritics
+# lets 'keo' match 'kèo'.
+CHAT_MESSAGES_FTS = [
+    "CREATE VIRTUAL TABLE chat_messages_fts USING fts5("
+    "text, content='chat_messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_ai AFTER INSERT ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_ad AFTER DELETE ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_au AFTER UPDATE ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO chat_messages_fts(rowid, text) VALUES (new.id, new.text); END",
+]
+
+# SQLite tuning applied to every pooled connection
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',      # readers don't block the writer
+    'synchronous': 'NORMAL',    # durable enough with WAL, no fsync per commit
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+    'cache_size': -8000,        # ~8MB page cache
+}
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply SQLITE_PRAGMAS to a new DBAPI connection"""
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def migrate_database(bind):
+    """Create tables and bring indexes on pre-existing tables up to date"""
+    Base.metadata.create_all(bind)
+    with bind.begin() as conn:
+        # Older versions could insert the same user twice; keep the newest row
+        conn.execute(text(
+            "DELETE FROM user_contexts WHERE id NOT IN "
+            "(SELECT MAX(id) FROM user_contexts GROUP BY chat_id, user_id)"
+        ))
+    with bind.begin() as conn:
+        # Columns added after the table was first created
+        columns = {row[1] for row in conn.execute(text("PRAGMA table_info(chat_messages)"))}
+        if 'sender_name' not in columns:
+            conn.execute(text("ALTER TABLE chat_messages ADD COLUMN sender_name VARCHAR"))
+    # create_all skips indexes on tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+    _create_fts(bind)
+
+def _create_fts(bind):
+    with bind.begin() as conn:
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='chat_messages_fts'"
+        )).first()
+        if exists:
+            return
+        try:
+            for statement in CHAT_MESSAGES_FTS:
+                conn.execute(text(statement))
+        except Exception:
+            return  # SQLite built without FTS5: the archive is just not searchable
+        # Index messages stored before the FTS table existed
+        conn.execute(text("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')"))
+
+def open_database(url):
+    """Create a tuned, migrated engine and its session factory"""
+    engine = create_engine(url, echo=False)
+    event.listen(engine, 'connect', apply_sqlite_pragmas)
+    migrate_database(engine)
+    return engine, sessionmaker(bind=engine)
+
+# --- TRENDING TOPICS ---
+def add_trending_rows(db_session, chat_id, words, timestamp):
+    db_session.add_all([TrendingTopic(chat_id=chat_id, word=w, timestamp=timestamp) for w in words])
+
+def query_trending_words(db_session, chat_id, cutoff):
+    rows = db_session.query(TrendingTopic.word).filter(
+        TrendingTopic.chat_id == chat_id,
+        TrendingTopic.timestamp > cutoff
+    ).all()
+    return [row.word for row in rows]
+
+# --- USER CONTEXTS ---
+USER_CONTEXT_COLUMNS = ('last_topic', 'sentiment', 'last_interaction', 'interaction_count')
+
+def user_context_row(chat_id, user_id, context):
+    row = {col: context.get(col) for col in USER_CONTEXT_COLUMNS}
+    row.update(chat_id=chat_id, user_id=user_id, context_data=dict(context))
+    return row
+
+def upsert_user_contexts(db_session, rows, chunk_size=500):
+    """Batched INSERT ... ON CONFLICT(chat_id, user_id) DO UPDATE"""
+    for start in range(0, len(rows), chunk_size):
+        stmt = sqlite_insert(UserContext).values(rows[start:start + chunk_size])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['chat_id', 'user_id'],
+            set_={col: stmt.excluded[col] for col in USER_CONTEXT_COLUMNS + ('context_data',)}
+        )
+        db_session.execute(stmt)
+
+def store_user_context(db_session, chat_id, user_id, context):
+    upsert_user_contexts(db_session, [user_context_row(chat_id, user_id, context)])
+
+def load_user_context(db_session, chat_id, user_id):
+    user_ctx = db_session.query(UserContext).filter_by(chat_id=chat_id, user_id=user_id).first()
+    if user_ctx is None:
+        return None
+    context = dict(user_ctx.context_data or {})
+    context.update({col: getattr(user_ctx, col) for col in USER_CONTEXT_COLUMNS})
+    return context
+
+# --- CHAT MESSAGES ---
+def add_chat_message(db_session, chat_id, sender_id, text, sentiment, timestamp, sender_name=None):
+    db_session.add(ChatMessage(chat_id=chat_id, sender_id=sender_id, sender_name=sender_name,
+                               text=text, sentiment=sentiment, timestamp=timestamp))
+
+def search_chat_messages(db_session, chat_id, match, before, limit):
+    """BM25-ranked messages of a chat matching an FTS5 query, older than `before`"""
+    rows = db_session.execute(text(
+        "SELECT m.sender_name, m.text, m.timestamp FROM chat_messages_fts f "
+        "JOIN chat_messages m ON m.id = f.rowid "
+        "WHERE chat_messages_fts MATCH :match AND m.chat_id = :chat_id AND m.timestamp < :before "
+        "ORDER BY bm25(chat_messages_fts) LIMIT :limit"
+    ), {'match': match, 'chat_id': chat_id, 'before': before, 'limit': limit}).all()
+    return [{'name': row.sender_name or 'U', 'text': row.text, 'timestamp': row.timestamp} for row in rows]
+
+def prune_chat_messages(db_session, cutoff):
+    """Delete archived messages older than cutoff (the FTS delete trigger drops them from the index)"""
+    return db_session.query(ChatMessage).filter(ChatMessage.timestamp < cutoff).delete()
+
+def load_chat_messages(db_session, limit):
+    """(text, sentiment) of the newest `limit` messages, oldest first"""
+    rows = db_session.query(ChatMessage.text, ChatMessage.sentiment).order_by(ChatMessage.id.desc()).limit(limit).all()
+    return [(row.text, row.sentiment) for row in reversed(rows)]
+
+# --- OUTBOX ---
+OUTBOX_PENDING = 'pending'
+OUTBOX_SENDING = 'sending'  # Delivery started; never restarted, it may already be half shown
+OUTBOX_SENT = 'sent'
+OUTBOX_FAILED = 'failed'
+OUTBOX_EXPIRED = 'expired'
+OUTBOX_INTERRUPTED = 'interrupted'
+
+def add_outbox_item(db_session, chat_id, kind, payload, source_msg_id, created_at):
+    """Insert a pending item; returns its id, or None if this source message already has one"""
+    stmt = sqlite_insert(OutboxItem).values(
+        chat_id=chat_id, kind=kind, payload=payload, source_msg_id=source_msg_id,
+        created_at=created_at, attempts=0, status=OUTBOX_PENDING
+    ).on_conflict_do_nothing(index_elements=['chat_id', 'source_msg_id', 'kind'])
+    result = db_session.execute(stmt)
+    return result.inserted_primary_key[0] if result.rowcount else None
+
+def set_outbox_status(db_session, item_id, status, attempts):
+    db_session.query(OutboxItem).filter_by(id=item_id).update({'status': status, 'attempts': attempts})
+
+def expire_outbox_items(db_session, cutoff):
+    """Mark pending items created before cutoff as expired; returns how many"""
+    return db_session.query(OutboxItem).filter(
+        OutboxItem.status == OUTBOX_PENDING,
+        OutboxItem.created_at < cutoff
+    ).update({'status': OUTBOX_EXPIRED})
+
+def interrupt_outbox_items(db_session):
+    """Mark items whose delivery was cut off by a shutdown as interrupted; returns how many"""
+    return db_session.query(OutboxItem).filter(
+        OutboxItem.status == OUTBOX_SENDING
+    ).update({'status': OUTBOX_INTERRUPTED})
+
+def prune_outbox_items(db_session, cutoff):
+    """Delete finished items created before cutoff"""
+    return db_session.query(OutboxItem).filter(
+        OutboxItem.status != OUTBOX_PENDING,
+        OutboxItem.created_at < cutoff
+    ).delete()
+
+def load_pending_outbox_items(db_session):
+    rows = db_session.query(OutboxItem).filter_by(status=OUTBOX_PENDING).order_by(OutboxItem.id).all()
+    return [
+        {'id': row.id, 'chat_id': row.chat_id, 'kind': row.kind, 'payload': dict(row.payload or {}),
+         'source_msg_id': row.source_msg_id, 'created_at': row.created_at, 'attempts': row.attempts or 0}
+        for row in rows
+    ]
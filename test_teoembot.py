@@ -11,9 +11,36 @@ from collections import defaultdict, deque
 # Import functions to test
 import sys
 import os
+import subprocess
 sys.path.insert(0, os.path.dirname(__file__))
 
 
+@pytest.fixture
+def bot_config(tmp_path_factory):
+    """BotConfig whose database, encryption key, log and snapshot live in a temp directory"""
+    from teoembot import BotConfig
+    
+    base = tmp_path_factory.mktemp('bot')
+    return BotConfig(
+        db_url=f"sqlite:///{base / 'teoembot.db'}",
+        encryption_key_file=str(base / '.encryption_key'),
+        log_file=str(base / 'teoembot.log'),
+        snapshot_file=str(base / 'state.json.gz'),
+        profile_dir=str(base / 'profiles'),
+    )
+
+
+@pytest.fixture(autouse=True)
+def runtime(bot_config):
+    """Install a BotRuntime built from bot_config for one test, then put the previous one back"""
+    from teoembot import BotRuntime, set_runtime
+    
+    runtime = BotRuntime(bot_config)
+    previous = set_runtime(runtime)
+    yield runtime
+    set_runtime(previous)
+
+
 class TestSimpleResponse:
     """Test the check_simple_response function"""
     
@@ -301,13 +328,14 @@ class TestCleanup:
 class TestEncryption:
     """Test encryption utilities"""
     
-    def test_get_encryption_key(self):
+    def test_get_encryption_key(self, bot_config):
         """Test encryption key generation"""
         from teoembot import get_encryption_key
         
-        key = get_encryption_key()
+        key = get_encryption_key(bot_config.encryption_key_file)
         assert key is not None
         assert len(key) > 0
+        assert get_encryption_key(bot_config.encryption_key_file) == key
 
 
 class TestTrendingPhrases:
@@ -675,6 +703,1766 @@ class TestMoodSystemEnhanced:
         assert isinstance(emotion, str)
 
 
+def make_test_database(tmp_path):
+    """Build an AsyncDatabase on a throwaway SQLite file"""
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+    from teoembot import AsyncDatabase
+    from teoembot_db import Base, apply_sqlite_pragmas
+    
+    test_engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    event.listen(test_engine, 'connect', apply_sqlite_pragmas)
+    Base.metadata.create_all(test_engine)
+    return test_engine, AsyncDatabase(sessionmaker(bind=test_engine))
+
+
+class TestAsyncDatabase:
+    """Test the async persistence layer"""
+    
+    @pytest.mark.asyncio
+    async def test_write_then_read(self, tmp_path):
+        """Test queued writes are committed and readable off the loop"""
+        from teoembot_db import add_trending_rows, query_trending_words
+        
+        _, database = make_test_database(tmp_path)
+        await database.write(add_trending_rows, 1, ['kèo', 'bóng'], time.time())
+        words = await database.read(query_trending_words, 1, time.time() - 60)
+        await database.close()
+        
+        assert sorted(words) == ['bóng', 'kèo']
+    
+    @pytest.mark.asyncio
+    async def test_write_nowait_batches_and_instruments(self, tmp_path):
+        """Test fire-and-forget writes are drained on close and timed"""
+        from teoembot_db import add_trending_rows, query_trending_words
+        
+        _, database = make_test_database(tmp_path)
+        for i in range(20):
+            database.write_nowait(add_trending_rows, 2, [f'word{i}'], time.time())
+        await database.close()
+        
+        words = await database.read(query_trending_words, 2, 0)
+        stats = database.stats()
+        assert len(words) == 20
+        assert stats['writes_total'] == 20
+        assert stats['queue_latency_p95_ms'] is not None
+        assert stats['tx_p95_ms'] is not None
+    
+    def test_wal_mode_enabled(self, tmp_path):
+        """Test tuned pragmas are applied to pooled connections"""
+        from sqlalchemy import text
+        
+        test_engine, _ = make_test_database(tmp_path)
+        with test_engine.connect() as conn:
+            mode = conn.execute(text("PRAGMA journal_mode")).scalar()
+        assert mode.lower() == 'wal'
+    
+    def test_write_nowait_without_loop(self, tmp_path):
+        """Test writes run synchronously when no event loop is running"""
+        from teoembot_db import add_trending_rows, query_trending_words
+        
+        test_engine, database = make_test_database(tmp_path)
+        database.write_nowait(add_trending_rows, 3, ['sync'], time.time())
+        with database.session_factory() as db_session:
+            assert query_trending_words(db_session, 3, 0) == ['sync']
+
+
+@pytest.mark.asyncio
+class TestUserContextStore:
+    """Test the write-back user context cache"""
+    
+    async def test_lazy_load_and_batched_flush(self, tmp_path):
+        """Test records load from SQLite once and flush as one upsert"""
+        from teoembot import UserContextStore
+        from teoembot_db import store_user_context, load_user_context
+        
+        _, database = make_test_database(tmp_path)
+        await database.write(store_user_context, 1, 10, {'sentiment': 'positive', 'interaction_count': 4})
+        
+        store = UserContextStore(database, flush_interval=3600)
+        await store.record_interaction(1, 10, 'funny')
+        await store.record_interaction(1, 10, 'neutral')
+        await store.record_interaction(1, 11, 'negative')
+        assert store.loads == 2
+        
+        assert await store.flush() == 2
+        assert await store.flush() == 0
+        saved = await database.read(load_user_context, 1, 10)
+        await store.close()
+        await database.close()
+        
+        assert saved['interaction_count'] == 6
+        assert saved['sentiment'] == 'neutral'
+    
+    async def test_upsert_keeps_one_row_per_user(self, tmp_path):
+        """Test the unique index turns repeated saves into updates"""
+        from teoembot_db import UserContext, store_user_context
+        
+        _, database = make_test_database(tmp_path)
+        for count in range(3):
+            await database.write(store_user_context, 1, 10, {'interaction_count': count})
+        rows = await database.read(lambda db_session: db_session.query(UserContext).count())
+        await database.close()
+        
+        assert rows == 1
+    
+    async def test_evicted_dirty_records_are_flushed(self, tmp_path):
+        """Test records pushed out of the bounded map are still persisted"""
+        from teoembot import UserContextStore
+        from teoembot_db import load_user_context
+        
+        _, database = make_test_database(tmp_path)
+        store = UserContextStore(database, maxsize=2, flush_interval=3600)
+        for user_id in range(5):
+            await store.record_interaction(1, user_id, 'positive')
+        
+        assert store.stats()['cached'] == 2
+        assert await store.flush() == 5
+        saved = await database.read(load_user_context, 1, 0)
+        await store.close()
+        await database.close()
+        
+        assert saved['interaction_count'] == 1
+
+
+class TestStateStore:
+    """Test the bounded per-chat / per-thread state store"""
+    
+    def test_idle_entries_expire(self):
+        """Test entries idle for longer than the TTL are dropped"""
+        from teoembot import StateStore, ThreadState
+        
+        store = StateStore(ThreadState, ttl=60)
+        store[(1, 100)].last_reply_time = 123.0
+        assert store.peek((1, 100)).last_reply_time == 123.0
+        
+        store.peek((1, 100)).last_seen -= 120
+        assert store.peek((1, 100)) is None
+        store[(1, 200)]
+        assert len(store) == 1
+        assert store.stats()['expired'] == 1
+    
+    def test_lru_eviction_and_memory_limit(self):
+        """Test capacity follows max_entries and the byte budget"""
+        from teoembot import StateStore, ThreadState
+        
+        store = StateStore(ThreadState, ttl=3600, max_entries=3)
+        for topic_id in range(5):
+            store[(1, topic_id)]
+        store[(1, 2)]  # touch so it survives the next eviction
+        store[(1, 5)]
+        assert len(store) == 3
+        assert (1, 2) in store
+        assert (1, 3) not in store
+        
+        budgeted = StateStore(ThreadState, ttl=3600, max_bytes=ThreadState.MAX_BYTES * 10)
+        assert budgeted.max_entries == 10
+    
+    def test_records_are_compact_and_reported(self):
+        """Test records use __slots__ and sizes are estimated"""
+        from teoembot import StateStore, ChatState
+        
+        store = StateStore(ChatState, ttl=3600)
+        store[1].trending.append({'word': 'kèo', 'time': time.time()})
+        assert not hasattr(store[1], '__dict__')
+        stats = store.stats()
+        assert stats['entries'] == 1
+        assert stats['estimated_bytes'] > 0
+
+
+class TestPhraseBank:
+    """Test the hot-reloadable phrase bank"""
+    
+    def write_phrases(self, path, memes, mtime):
+        import json
+        path.write_text(json.dumps({
+            'memes': memes,
+            'synonyms': {'oke': ['được'], 'oke r': ['xong r']},
+            'reactions': {'casual': ['oke nha'], 'win': ['đỉnh']}
+        }), encoding='utf-8')
+        os.utime(path, (mtime, mtime))
+    
+    def test_reload_on_mtime_change(self, tmp_path):
+        """Test a changed file is swapped in without restarting"""
+        from teoembot import PhraseBank
+        
+        path = tmp_path / 'phrases.json'
+        self.write_phrases(path, ['một'], 1000)
+        bank = PhraseBank(str(path), check_interval=0)
+        assert bank.phrases('memes') == ('một',)
+        
+        self.write_phrases(path, ['hai', 'ba'], 2000)
+        assert bank.phrases('memes') == ('hai', 'ba')
+        assert bank.reloads == 2
+    
+    def test_invalid_update_keeps_previous_snapshot(self, tmp_path):
+        """Test broken content is rejected and the old phrases stay live"""
+        from teoembot import PhraseBank
+        
+        path = tmp_path / 'phrases.json'
+        self.write_phrases(path, ['một'], 1000)
+        bank = PhraseBank(str(path), check_interval=0)
+        bank.current()
+        
+        path.write_text('{"memes": [', encoding='utf-8')
+        os.utime(path, (3000, 3000))
+        assert bank.phrases('memes') == ('một',)
+        assert bank.rejected == 1
+    
+    def test_precomputed_lookups(self, tmp_path):
+        """Test flat category arrays and the compiled synonym regex"""
+        from teoembot import PhraseBank
+        
+        path = tmp_path / 'phrases.json'
+        self.write_phrases(path, ['một'], 1000)
+        bank = PhraseBank(str(path), check_interval=0)
+        
+        assert set(bank.phrases('reactions')) == {'oke nha', 'đỉnh'}
+        assert bank.phrases('reactions', 'missing') == ()
+        assert bank.vary('oke r anh') == 'xong r anh'
+        assert bank.vary('hello') is None
+
+
+class TestStructuredLogging:
+    """Test the queue-based structured logging setup"""
+    
+    def test_json_record_has_context_fields(self):
+        """Test chat/message ids from log_context and stage extras end up in JSON"""
+        import json
+        import logging
+        from teoembot import JsonFormatter, LogContextFilter, log_context
+        
+        record = logging.LogRecord('teoembot', logging.INFO, __file__, 1, 'reply %s', ('oke',), None)
+        record.stage = 'deliver'
+        token = log_context.set({'chat_id': -100, 'msg_id': 42})
+        try:
+            LogContextFilter().filter(record)
+        finally:
+            log_context.reset(token)
+        
+        entry = json.loads(JsonFormatter().format(record))
+        assert entry['msg'] == 'reply oke'
+        assert entry['chat_id'] == -100
+        assert entry['msg_id'] == 42
+        assert entry['stage'] == 'deliver'
+    
+    def test_debug_log_is_lazy(self):
+        """Test disabled debug logging never formats its arguments"""
+        import logging
+        from teoembot import debug_log, logger
+        
+        class Exploding:
+            def __str__(self):
+                raise AssertionError("formatted while disabled")
+        
+        previous = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            debug_log("value: %s", Exploding(), stage='test')
+        finally:
+            logger.setLevel(previous)
+    
+    def test_logger_calls_are_not_preformatted(self):
+        """Test no logger call builds its message with an f-string before the level check"""
+        import ast
+        import teoembot
+        
+        with open(teoembot.__file__, encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+        eager = [
+            node.lineno for node in ast.walk(tree)
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name) and node.func.value.id == 'logger'
+            and node.args and isinstance(node.args[0], ast.JoinedStr)
+        ]
+        assert eager == []
+    
+    def test_queue_handler_is_timed(self):
+        """Test emit time is measured and queued records don't share live arguments with the caller"""
+        import logging
+        import queue
+        from teoembot import TimedQueueHandler
+        
+        log_queue = queue.SimpleQueue()
+        handler = TimedQueueHandler(log_queue)
+        state = {'trending': ['kèo']}
+        handler.handle(logging.LogRecord('teoembot', logging.INFO, __file__, 1, 'state=%s', (state,), None))
+        handler.handle(logging.LogRecord('teoembot', logging.DEBUG, __file__, 1, 'state=%s', (state,), None))
+        state['trending'] = ['mu']  # The event loop moves on before the listener runs
+        
+        info, debug = log_queue.get_nowait(), log_queue.get_nowait()
+        assert info.getMessage() == "state={'trending': ['kèo']}" and info.args is None
+        assert debug.getMessage() == "state={'trending': ['kèo']}"
+        assert handler.records == 2
+        assert handler.emit_ns > 0
+
+
+class TestBotRuntime:
+    """Test the side-effect-free import and the runtime factory"""
+    
+    def test_import_is_cheap_and_side_effect_free(self, tmp_path):
+        """Test importing the module stays in budget without heavy imports or files"""
+        code = (
+            "import sys, teoembot; "
+            "heavy = [m for m in ('openai', 'telethon', 'sqlalchemy', 'cryptography', 'dotenv') if m in sys.modules]; "
+            "print(teoembot.IMPORT_SECONDS, teoembot.IMPORT_TIME_BUDGET, ','.join(heavy))"
+        )
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, env=env,
+                             capture_output=True, text=True, check=True).stdout.split()
+        
+        assert float(out[0]) < float(out[1])
+        assert len(out) == 2  # no heavy modules
+        assert list(tmp_path.iterdir()) == []
+    
+    def test_config_from_env(self):
+        """Test settings are read from the given environment"""
+        from teoembot import BotConfig
+        
+        config = BotConfig.from_env({'SESSION_NAME': 'test', 'LOG_LEVEL': 'debug', 'STATE_MAX_ENTRIES': '7'})
+        assert config.session_name == 'test'
+        assert config.log_level == 'DEBUG'
+        assert config.state_max_entries == 7
+        assert config.db_url == 'sqlite:///teoembot.db'
+        assert config.local_random_replies is False
+        assert BotConfig.from_env({'LOCAL_RANDOM_REPLIES': 'true'}).local_random_replies is True
+    
+    def test_set_runtime_swaps_state(self, runtime):
+        """Test module-level accessors follow the installed runtime"""
+        import teoembot
+        
+        teoembot.update_trending(5, "kèo bóng đá hôm nay")
+        assert teoembot.trending_topics is runtime.trending_topics
+        assert len(runtime.chat_state.peek(5).trending) > 0
+        assert sorted(teoembot.load_trending_from_db(5)) == sorted(t['word'] for t in runtime.trending_topics[5])
+
+
+@pytest.mark.asyncio
+class TestTelegramScheduler:
+    """Test the outbound Telegram action scheduler"""
+    
+    async def test_flood_wait_is_retried(self):
+        """Test a short flood wait pauses the scope and the call is retried"""
+        from telethon.errors import FloodWaitError
+        from teoembot import TelegramScheduler
+        
+        scheduler = TelegramScheduler()
+        send = AsyncMock(side_effect=[FloodWaitError(request=None, capture=0), 'sent'])
+        
+        assert await scheduler.run('send', 1, send, 1, 'hi') == 'sent'
+        assert send.await_count == 2
+        assert scheduler.stats()['send_flood_waits'] == 1
+    
+    async def test_long_flood_wait_pauses_only_its_scope(self):
+        """Test a flood wait blocks one (action, chat) pair and leaves the rest alone"""
+        from telethon.errors import FloodWaitError
+        from teoembot import TelegramScheduler
+        
+        scheduler = TelegramScheduler(max_flood_wait=10)
+        send = AsyncMock(side_effect=FloodWaitError(request=None, capture=60))
+        
+        with pytest.raises(FloodWaitError):
+            await scheduler.run('send', 1, send)
+        assert scheduler.pause_remaining('send', 1) > 50
+        assert not scheduler.has_capacity('send', 1)
+        assert scheduler.has_capacity('send', 2)
+        assert scheduler.has_capacity('reaction', 1)
+        assert scheduler.stats()['send_dropped'] == 1
+    
+    async def test_reactions_do_not_use_reply_budget(self):
+        """Test exhausting the reaction budget skips reactions but not replies"""
+        from teoembot import TelegramScheduler
+        
+        scheduler = TelegramScheduler(limits={'send': (5, 5), 'reaction': (2, 2)})
+        react = AsyncMock(return_value=True)
+        results = [await scheduler.run('reaction', 1, react, wait=False) for _ in range(4)]
+        
+        assert results == [True, True, None, None]
+        assert scheduler.headroom('reaction', 1) < 0.5
+        assert scheduler.headroom('send', 1) == 1.0
+        assert await scheduler.run('send', 1, AsyncMock(return_value='ok')) == 'ok'
+
+
+@pytest.mark.asyncio
+class TestTypingPlanner:
+    """Test the load-adaptive typing realism planner"""
+    
+    async def test_idle_scheduler_gets_full_realism(self):
+        """Test full realism is chosen when every budget has headroom"""
+        from teoembot import TelegramScheduler, TypingPlanner
+        
+        planner = TypingPlanner(TelegramScheduler())
+        assert planner.choose(1) == 'full'
+    
+    async def test_levels_degrade_with_load(self):
+        """Test realism drops as headroom shrinks and the queue grows"""
+        from teoembot import TelegramScheduler, TypingPlanner
+        
+        scheduler = TelegramScheduler(limits={'send': (10, 4), 'edit': (10, 4), 'typing': (10, 4)})
+        planner = TypingPlanner(scheduler)
+        for _ in range(3):
+            await scheduler.run('send', 1, AsyncMock())
+        assert planner.choose(1) == 'indicator'
+        assert planner.choose(1, priority='high') == 'full'  # targeted replies keep realism longer
+        
+        scheduler.pending = 10
+        assert planner.choose(1) == 'direct'
+        assert planner.choose(2) == 'direct'
+        assert planner.stats()['plan_direct'] == 2
+    
+    async def test_direct_plan_sends_once_and_counts_savings(self, runtime):
+        """Test a direct plan skips typing calls and records the calls it saved"""
+        import teoembot
+        from teoembot import simulate_human_typing
+        
+        runtime.telegram.pending = 10
+        tg_client = AsyncMock()
+        with patch.object(teoembot, 'get_telegram_client', return_value=tg_client):
+            await simulate_human_typing(1, 'hello bro kèo thơm', reply_to=5)
+        
+        tg_client.send_message.assert_awaited_once()
+        tg_client.assert_not_awaited()  # no SetTypingRequest
+        assert runtime.typing_planner.calls_saved >= 1
+
+
+@pytest.mark.asyncio
+class TestOutbox:
+    """Test the durable per-chat delivery outbox"""
+    
+    async def test_in_order_delivery_and_dedupe(self, tmp_path):
+        """Test items are sent in order per chat and duplicates are dropped"""
+        from teoembot import Outbox
+        
+        _, database = make_test_database(tmp_path)
+        delivered = []
+        
+        async def deliver(item):
+            await asyncio.sleep(0.01 if item['payload']['n'] == 0 else 0)
+            delivered.append((item['chat_id'], item['payload']['n']))
+        
+        outbox = Outbox(database, deliver)
+        assert await outbox.enqueue(1, 'reply', {'n': 0}, source_msg_id=100)
+        assert await outbox.enqueue(1, 'reply', {'n': 1}, source_msg_id=101)
+        assert await outbox.enqueue(1, 'reply', {'n': 9}, source_msg_id=100) is None
+        await outbox.enqueue(2, 'reply', {'n': 2}, source_msg_id=100)
+        await asyncio.gather(*outbox.workers.values())
+        await database.close()
+        
+        assert [n for chat, n in delivered if chat == 1] == [0, 1]
+        assert outbox.stats()['duplicates'] == 1
+        assert outbox.stats()['sent'] == 3
+    
+    async def test_failed_delivery_is_retried(self, tmp_path):
+        """Test a failing send is retried until it succeeds"""
+        from teoembot import Outbox
+        import teoembot_db
+        
+        _, database = make_test_database(tmp_path)
+        deliver = AsyncMock(side_effect=[ConnectionError('down'), None])
+        outbox = Outbox(database, deliver, retry_delay=0)
+        await outbox.enqueue(1, 'reply', {'text': 'hi'}, source_msg_id=1)
+        await asyncio.gather(*outbox.workers.values())
+        await database.close()  # drains the status update
+        pending = await database.read(teoembot_db.load_pending_outbox_items)
+        
+        assert deliver.await_count == 2
+        assert pending == []
+    
+    async def test_recover_requeues_fresh_and_expires_stale(self, tmp_path):
+        """Test startup recovery resends recent items and drops old ones"""
+        from teoembot import Outbox
+        import teoembot_db
+        
+        _, database = make_test_database(tmp_path)
+        await database.write(teoembot_db.add_outbox_item, 1, 'reply', {'text': 'old'}, 1, time.time() - 600)
+        await database.write(teoembot_db.add_outbox_item, 1, 'reply', {'text': 'new'}, 2, time.time())
+        
+        deliver = AsyncMock()
+        outbox = Outbox(database, deliver, max_age=120)
+        assert await outbox.recover() == 1
+        await asyncio.gather(*outbox.workers.values())
+        await database.close()
+        
+        deliver.assert_awaited_once()
+        assert deliver.await_args.args[0]['payload'] == {'text': 'new'}
+        assert outbox.stats()['expired'] == 1
+    
+    async def test_close_finishes_the_current_item(self, tmp_path):
+        """Test shutdown lets the item being sent finish and leaves the next one pending"""
+        from teoembot import Outbox
+        import teoembot_db
+        
+        _, database = make_test_database(tmp_path)
+        delivered = []
+        
+        async def deliver(item):
+            await asyncio.sleep(0.05)  # Typing, then the typo and its correction
+            delivered.append(item['payload']['n'])
+        
+        outbox = Outbox(database, deliver)
+        await outbox.enqueue(1, 'reply', {'n': 0}, source_msg_id=1)
+        await outbox.enqueue(1, 'reply', {'n': 1}, source_msg_id=2)
+        await asyncio.sleep(0.01)
+        await outbox.close()
+        await database.close()
+        
+        assert delivered == [0]
+        pending = await database.read(teoembot_db.load_pending_outbox_items)
+        assert [item['payload'] for item in pending] == [{'n': 1}]
+    
+    async def test_interrupted_item_is_not_resent(self, tmp_path):
+        """Test an item cut off mid-delivery is skipped at the next start rather than sent from the beginning"""
+        from teoembot import Outbox
+        
+        _, database = make_test_database(tmp_path)
+        
+        async def stuck(item):
+            await asyncio.sleep(5)
+        
+        outbox = Outbox(database, stuck, close_timeout=0.01)
+        await outbox.enqueue(1, 'reply', {'text': 'tao nghix'}, source_msg_id=1)
+        await asyncio.sleep(0.01)
+        await outbox.close()
+        
+        deliver = AsyncMock()
+        restarted = Outbox(database, deliver)
+        assert await restarted.recover() == 0
+        await database.close()
+        
+        deliver.assert_not_awaited()
+        assert restarted.stats()['interrupted'] == 1
+
+
+class TestCandidateReranking:
+    """Test local reranking of multiple AI reply candidates"""
+    
+    def test_prefers_relevant_candidate(self):
+        """Test the candidate closest to recent history ranks first"""
+        from teoembot import rank_candidates
+        
+        history = ['kèo MU vs Chelsea tối nay', 'MU chấp nửa trái']
+        ranked = rank_candidates(['trời mưa quá', 'MU chấp nửa trái ăn chắc', 'ăn cơm chưa'], history)
+        assert ranked[0] == 'MU chấp nửa trái ăn chắc'
+    
+    def test_penalizes_repetition_and_bad_length(self):
+        """Test recent replies, empty and overlong candidates rank last"""
+        from teoembot import rank_candidates
+        
+        ranked = rank_candidates(['ez game bro', 'x' * 500, 'chill đi', '', 'ez game bro'], [], ['ez game bro'])
+        assert ranked == ['chill đi', 'ez game bro', 'x' * 500]
+    
+    @pytest.mark.asyncio
+    async def test_runners_up_are_cached(self, runtime):
+        """Test one API call yields the best reply and caches the others"""
+        import teoembot
+        from teoembot import get_ai_reply_multimodal, get_cached_response
+        
+        runtime.config.reply_candidates = 3
+        candidates = AsyncMock(return_value=['kèo MU thơm đấy', 'uh', 'trời mưa'])
+        with patch.object(teoembot, 'call_openai_candidates', candidates), \
+             patch.object(teoembot, 'add_thinking_depth', side_effect=lambda r, *a: r), \
+             patch.object(teoembot, 'should_ask_follow_up_question', return_value=False):
+            reply = await get_ai_reply_multimodal('kèo MU thế nào', [], context={'chat_id': 1})
+        
+        assert candidates.await_count == 1
+        assert reply == 'kèo MU thơm đấy'
+        assert get_cached_response('kèo MU thế nào') in ('uh', 'trời mưa')
+
+
+@pytest.mark.asyncio
+class TestSingleFlight:
+    """Test deduplication of identical in-flight requests"""
+    
+    async def test_concurrent_calls_share_one_result(self):
+        """Test identical concurrent calls run once and fan out the result"""
+        from teoembot import SingleFlight
+        
+        flights = SingleFlight()
+        calls = []
+        
+        async def work(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+        
+        results = await asyncio.gather(*(flights.do('k', work, 21) for _ in range(5)), flights.do('other', work, 1))
+        assert results == [42] * 5 + [2]
+        assert calls == [21, 1]
+        assert flights.stats() == {'calls': 2, 'shared': 4, 'inflight': 0}
+    
+    async def test_errors_fan_out_and_key_is_released(self):
+        """Test a failed call raises for every waiter and the next call runs fresh"""
+        from teoembot import SingleFlight
+        
+        flights = SingleFlight()
+        failing = AsyncMock(side_effect=ValueError('boom'))
+        results = await asyncio.gather(flights.do('k', failing), flights.do('k', failing), return_exceptions=True)
+        
+        assert all(isinstance(r, ValueError) for r in results)
+        assert failing.await_count == 1
+        assert await flights.do('k', AsyncMock(return_value='ok')) == 'ok'
+    
+    async def test_identical_summaries_make_one_api_call(self):
+        """Test concurrent summarize_context calls on one history hit OpenAI once"""
+        import teoembot
+        from teoembot import summarize_context, request_fingerprint
+        
+        assert request_fingerprint('m', [{'role': 'user', 'content': 'kèo  gì '}], 'summary') == \
+            request_fingerprint('m', [{'role': 'user', 'content': 'kèo gì'}], 'summary')
+        
+        async def create(*args):
+            await asyncio.sleep(0.01)
+            return ['tóm tắt']
+        
+        history = [{'name': f'u{i}', 'text': f'msg {i}'} for i in range(5)]
+        with patch.object(teoembot, '_create_completion', side_effect=create) as create_mock:
+            summaries = await asyncio.gather(summarize_context(history), summarize_context(history))
+        assert summaries == ['tóm tắt', 'tóm tắt']
+        assert create_mock.call_count == 1
+    
+    async def test_quota_is_charged_once_per_shared_call(self, runtime):
+        """Test callers joining an in-flight call use no quota, and an empty quota is not retried"""
+        import teoembot
+        from teoembot import BackendRegistry, OpenAIQuotaExceeded, call_openai_with_retry
+        
+        backend = FakeBackend('primary', 0.01, reply='kèo thơm', uses_openai_quota=True)
+        runtime._backends = BackendRegistry([backend])
+        saved = getattr(teoembot.check_openai_quota, 'hourly_calls', None)
+        messages = [{'role': 'user', 'content': 'kèo gì'}]
+        try:
+            teoembot.check_openai_quota.hourly_calls = {}
+            replies = await asyncio.gather(*(call_openai_with_retry(messages) for _ in range(5)))
+            assert replies == ['kèo thơm'] * 5
+            assert backend.calls == 1
+            assert sum(teoembot.check_openai_quota.hourly_calls.values()) == 1
+            
+            teoembot.check_openai_quota.hourly_calls = {teoembot._quota_key(): teoembot.OPENAI_HOURLY_QUOTA}
+            assert not teoembot.openai_quota_available()
+            with pytest.raises(OpenAIQuotaExceeded):
+                await call_openai_with_retry(messages)
+            assert backend.calls == 1
+            
+            teoembot.check_openai_quota.hourly_calls = {'quota_last_hour': teoembot.OPENAI_HOURLY_QUOTA}
+            assert teoembot.openai_quota_available()  # A new hour starts with the whole quota
+        finally:
+            teoembot.check_openai_quota.hourly_calls = saved or {}
+
+
+class TestLocalGenerator:
+    """Test the offline Markov reply generator"""
+    
+    def test_generates_from_learned_text(self):
+        """Test replies are built only from learned transitions"""
+        from teoembot import MarkovGenerator
+        
+        generator = MarkovGenerator()
+        assert generator.generate() is None
+        for text in ['kèo này thơm quá', 'kèo này húp chắc', 'trận này khó ăn']:
+            generator.learn(text, 'positive')
+        
+        vocabulary = {'kèo', 'này', 'thơm', 'quá', 'húp', 'chắc', 'trận', 'khó', 'ăn'}
+        for _ in range(20):
+            reply = generator.generate('positive', max_words=10)
+            assert reply and set(reply.split()) <= vocabulary
+    
+    def test_condition_selects_labelled_chain(self):
+        """Test sampling follows the chain of the requested emotion"""
+        from teoembot import MarkovGenerator
+        
+        generator = MarkovGenerator()
+        generator.learn('phê quá anh em ơi', 'excited')
+        generator.learn('lo lo sao ấy', 'worried')
+        
+        assert all(generator.generate('worried') == 'lo lo sao ấy' for _ in range(10))
+        assert generator.generate('excited', seed_text='anh em ơi', temperature=0.1) in 'phê quá anh em ơi'
+    
+    def test_seed_lookup_uses_last_word_index(self):
+        """Test seeded starts come from the last-word index instead of scanning the chain"""
+        from teoembot import MarkovGenerator
+        
+        generator = MarkovGenerator()
+        generator.learn('kèo này thơm quá', 'positive')
+        generator.learn('trận này khó ăn')
+        
+        assert generator.by_last_word['positive']['thơm'] == [('này', 'thơm')]
+        assert len(generator.by_last_word[None]['này']) == 2
+        assert generator._start('positive', {'thơm', 'xyz'}) == ('này', 'thơm')
+        assert generator.generate('positive', seed_text='thơm') == 'này thơm quá'
+    
+    @pytest.mark.asyncio
+    async def test_same_interface_and_stored_corpus(self, runtime):
+        """Test the backend takes OpenAI-style messages and retrains from stored messages"""
+        from teoembot import BotRuntime, set_runtime, call_local_generator, remember_message
+        
+        remember_message(1, 10, 'kèo mu hôm nay thơm lắm', 'positive')
+        await runtime.db.close()
+        
+        restarted = BotRuntime(runtime.config)
+        set_runtime(restarted)
+        reply = await call_local_generator([{'role': 'user', 'content': 'kèo mu sao'}], max_tokens=40)
+        assert isinstance(reply, str) and reply
+        assert ('kèo', 'mu') in restarted.local_generator.chains['positive']
+
+
+class FakeBackend:
+    """Backend stand-in that answers after a fixed delay"""
+    
+    def __init__(self, name, delay, reply=None, error=None, queued=0, models=None, uses_openai_quota=False):
+        self.name = name
+        self.model = name
+        self.models = models or {}
+        self.uses_openai_quota = uses_openai_quota
+        self.models_used = []
+        self.delay = delay
+        self.queued = queued
+        self.reply = reply or name
+        self.error = error
+        self.calls = 0
+        self.cancelled = False
+    
+    def has_capacity(self):
+        return True
+    
+    def model_for(self, routed_model):
+        return self.models.get(routed_model) if routed_model else None
+    
+    async def complete(self, messages, max_tokens, temperature, n, model=None, admitted=None):
+        self.calls += 1
+        self.models_used.append(model)
+        try:
+            await asyncio.sleep(self.queued)  # Waiting on the backend's limiter
+            if admitted is not None:
+                admitted()
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+        return [self.reply]
+
+
+@pytest.mark.asyncio
+class TestBackendRegistry:
+    """Test hedged requests across generation backends"""
+    
+    async def test_fast_primary_is_not_hedged(self):
+        """Test a primary answering before the hedge delay is used alone"""
+        from teoembot import BackendRegistry
+        
+        primary, secondary = FakeBackend('primary', 0), FakeBackend('secondary', 0)
+        registry = BackendRegistry([primary, secondary], default_delay=0.2)
+        
+        assert await registry.complete([], 10, 0.9, 1) == ['primary']
+        assert secondary.calls == 0
+        assert registry.stats()['hedge_rate'] == 0.0
+    
+    async def test_slow_primary_is_hedged_and_cancelled(self):
+        """Test the secondary answers a slow request and the primary is cancelled"""
+        from teoembot import BackendRegistry
+        
+        primary, secondary = FakeBackend('primary', 5), FakeBackend('secondary', 0.01)
+        registry = BackendRegistry([primary, secondary], default_delay=0.02)
+        
+        started = time.perf_counter()
+        assert await registry.complete([], 10, 0.9, 1) == ['secondary']
+        await asyncio.sleep(0)
+        
+        assert time.perf_counter() - started < 1
+        assert primary.cancelled
+        stats = registry.stats()
+        assert stats['hedged'] == 1 and stats['hedge_wins'] == 1
+        assert stats['hedge_win_rate'] == 1.0
+    
+    async def test_failed_primary_fails_over(self):
+        """Test a primary error is answered by the secondary"""
+        from teoembot import BackendRegistry
+        
+        primary = FakeBackend('primary', 0, error=ConnectionError('down'))
+        registry = BackendRegistry([primary, FakeBackend('secondary', 0)], default_delay=1)
+        
+        assert await registry.complete([], 10, 0.9, 1) == ['secondary']
+        assert registry.stats()['failovers'] == 1
+    
+    async def test_limiter_wait_is_not_hedge_latency(self):
+        """Test only time after the limiter counts toward the hedge delay, and routed models are mapped"""
+        from teoembot import BackendRegistry
+        
+        primary = FakeBackend('primary', 0.01, queued=0.1)
+        secondary = FakeBackend('secondary', 5, models={'gpt-4o': 'llama-70b'})
+        registry = BackendRegistry([primary, secondary], min_samples=1, default_delay=1)
+        
+        assert await registry.complete([], 10, 0.9, 1, model='gpt-4o') == ['primary']
+        assert registry.latencies['primary'][0] < 0.08
+        assert registry.hedge_delay(primary) < 0.08
+        assert secondary.model_for('gpt-4o') == 'llama-70b' and secondary.model_for('gpt-4o-mini') is None
+        
+        primary.delay, primary.queued = 5, 0
+        secondary.delay = 0
+        assert await registry.complete([], 10, 0.9, 1, model='gpt-4o') == ['secondary']
+        assert secondary.models_used == ['llama-70b']
+    
+    async def test_each_sent_openai_request_uses_quota(self):
+        """Test a hedge sent to a second OpenAI backend is charged, one to a local server is not"""
+        import teoembot
+        from teoembot import BackendRegistry
+        
+        saved = getattr(teoembot.check_openai_quota, 'hourly_calls', None)
+        try:
+            teoembot.check_openai_quota.hourly_calls = {}
+            primary = FakeBackend('primary', 5, uses_openai_quota=True)
+            openai_secondary = FakeBackend('gpt', 0.01, uses_openai_quota=True)
+            registry = BackendRegistry([primary, openai_secondary], default_delay=0.02)
+            assert await registry.complete([], 10, 0.9, 1) == ['gpt']
+            assert sum(teoembot.check_openai_quota.hourly_calls.values()) == 2
+            
+            local = FakeBackend('local', 0.01)
+            registry = BackendRegistry([FakeBackend('primary', 5, uses_openai_quota=True), local], default_delay=0.02)
+            assert await registry.complete([], 10, 0.9, 1) == ['local']
+            assert sum(teoembot.check_openai_quota.hourly_calls.values()) == 3
+            
+            teoembot.check_openai_quota.hourly_calls = {teoembot._quota_key(): teoembot.OPENAI_HOURLY_QUOTA}
+            registry = BackendRegistry([FakeBackend('primary', 0.05), openai_secondary], default_delay=0.01)
+            assert await registry.complete([], 10, 0.9, 1) == ['primary']
+            assert openai_secondary.calls == 1  # No hedge to a backend without quota left
+        finally:
+            teoembot.check_openai_quota.hourly_calls = saved or {}
+    
+    async def test_backend_keys_come_from_the_config(self, runtime):
+        """Test api_key_env is resolved through BotConfig, not read from os.environ by build_backends"""
+        import json
+        from teoembot import BotConfig, build_backends
+        
+        specs = json.dumps([{'name': 'openai'},
+                            {'name': 'local', 'base_url': 'http://localhost:8080/v1', 'api_key_env': 'LOCAL_LLM_KEY'}])
+        config = BotConfig.from_env({'GENERATION_BACKENDS': specs, 'LOCAL_LLM_KEY': 'sk-local'})
+        assert config.backend_api_keys == {'LOCAL_LLM_KEY': 'sk-local'}
+        
+        runtime.config.generation_backends = specs
+        runtime.config.backend_api_keys = {'LOCAL_LLM_KEY': 'sk-config'}
+        with patch.dict(os.environ, {'LOCAL_LLM_KEY': 'sk-environ'}):
+            openai, local = build_backends(runtime).backends
+        assert local.api_key == 'sk-config'
+        assert openai.uses_openai_quota and not local.uses_openai_quota
+
+
+class TestRouter:
+    """Test per-message-class routing of generation requests"""
+    
+    def test_classify_message(self):
+        """Test messages map to the most specific class"""
+        from teoembot import classify_message
+        
+        assert classify_message(True, True, True, True) == 'photo'
+        assert classify_message(False, True, True, False) == 'reply_to_bot'
+        assert classify_message(False, False, True, True) == 'targeted'
+        assert classify_message(False, False, False, True) == 'trigger'
+        assert classify_message(False, False, False, False) == 'random'
+    
+    def test_routes_are_editable_at_runtime(self, tmp_path):
+        """Test update() and file overrides change routes; a bad file is ignored"""
+        import json
+        from teoembot import Router, DEFAULT_ROUTES
+        
+        routes_file = tmp_path / 'routes.json'
+        router = Router(str(routes_file), check_interval=0)
+        assert router.route('random') == DEFAULT_ROUTES['random']
+        
+        router.update('random', max_tokens=20)
+        assert router.route('random').max_tokens == 20
+        
+        routes_file.write_text(json.dumps({'photo': {'model': 'gpt-4o', 'history_depth': 3}}))
+        assert router.route('photo').model == 'gpt-4o'
+        assert router.route('photo').history_depth == 3
+        
+        routes_file.write_text('{"photo": {"no_such_field": 1}}')
+        os.utime(routes_file, ns=(time.time_ns(), time.time_ns() + 10**9))
+        assert router.route('photo').model == 'gpt-4o'
+    
+    @pytest.mark.asyncio
+    async def test_route_applied_and_cost_reported(self, runtime):
+        """Test the class's token limit reaches the backend and usage is costed per class"""
+        from types import SimpleNamespace
+        import teoembot
+        from teoembot import BackendRegistry, Completions, get_ai_reply_multimodal
+        
+        class UsageBackend(FakeBackend):
+            async def complete(self, messages, max_tokens, temperature, n, model=None, admitted=None):
+                self.max_tokens = max_tokens
+                return Completions(['kèo thơm'] * n, model='gpt-4o-mini',
+                                   usage=SimpleNamespace(prompt_tokens=1000, completion_tokens=100))
+        
+        backend = UsageBackend('primary', 0)
+        runtime._backends = BackendRegistry([backend])
+        with patch.object(teoembot, 'check_openai_quota', AsyncMock(return_value=True)), \
+             patch.object(teoembot, 'openai_quota_available', Mock(return_value=True)):
+            await get_ai_reply_multimodal('kèo', [], context={'chat_id': 1, 'message_class': 'random'})
+        
+        assert backend.max_tokens == 40
+        stats = runtime.router.stats()['random']
+        assert stats['requests'] == 1
+        assert stats['cost_usd'] == pytest.approx((1000 * 0.15 + 100 * 0.60) / 1_000_000)
+
+
+class TestReplyPool:
+    """Test the pre-generated reply pools"""
+    
+    def test_parse_batch_response(self):
+        """Test replies are extracted from a JSON batch, deduped and length-checked"""
+        from teoembot import parse_pool_replies
+        
+        text = 'đây: {"replies": ["kèo thơm", "kèo thơm", "x", "chill đi", 5]} hết'
+        assert parse_pool_replies(text) == ['kèo thơm', 'chill đi']
+        assert parse_pool_replies('không phải json') == []
+    
+    def test_take_hits_misses_and_expiry(self):
+        """Test pooled replies are served once, expire, and misses mark buckets wanted"""
+        from teoembot import ReplyPool
+        
+        pool = ReplyPool(ttl=60, min_size=2)
+        assert pool.take('chill', 'playful', 'mu') is None
+        assert pool.due_buckets() == [('chill', 'playful', 'mu')]
+        
+        pool.add(('chill', 'playful', None), ['uh', 'oke'])
+        assert pool.take('chill', 'playful', 'mu') in ('uh', 'oke')  # topic-less fallback
+        pool.buckets[('chill', 'playful', None)] = [(time.time() - 1, 'old')]
+        assert pool.take('chill', 'playful') is None
+        
+        stats = pool.stats()
+        assert stats['hits'] == 1 and stats['misses'] == 2
+        assert stats['expired'] == 1
+        assert stats['hit_rate'] == pytest.approx(1 / 3, abs=0.001)
+    
+    @pytest.mark.asyncio
+    async def test_refill_uses_one_batch_call(self, runtime):
+        """Test one API call fills a wanted bucket with many replies"""
+        import teoembot
+        
+        pool = runtime.reply_pool
+        batch = AsyncMock(return_value='{"replies": ["ez game", "vl thật", "húp mạnh", "chill", "gg"]}')
+        pool.take('hype', 'excited', 'mu')
+        with patch.object(teoembot, 'call_openai_with_retry', batch), \
+             patch.object(teoembot, 'openai_quota_available', Mock(return_value=True)):
+            assert await pool.refill(pool.due_buckets()[0]) == 5
+        
+        assert batch.await_count == 1
+        assert batch.await_args.kwargs['purpose'] == 'pool'
+        assert pool.take('hype', 'excited', 'mu') in ('ez game', 'vl thật', 'húp mạnh', 'chill', 'gg')
+        assert pool.due_buckets() == []
+
+
+class TestMessageArchive:
+    """Test the FTS5 message archive used for retrieval"""
+    
+    def test_fts_query_is_quoted(self):
+        """Test user text becomes a quoted OR query without FTS syntax"""
+        from teoembot import build_fts_query
+        
+        assert build_fts_query('kèo MU "NEAR" là gì gì') == '"kèo" OR "mu" OR "near" OR "gì"'
+        assert build_fts_query('à ạ !') == ''
+    
+    @pytest.mark.asyncio
+    async def test_bm25_search_finds_older_related_messages(self, runtime):
+        """Test archived messages are matched (diacritics-insensitive) and ranked"""
+        import teoembot_db
+        from teoembot import retrieve_related_messages
+        
+        old = time.time() - 7200
+        for text in ['trận mu chelsea tối qua hay vl', 'mu thua rồi', 'ăn cơm chưa', 'arsenal đá như hạch']:
+            await runtime.db.write(teoembot_db.add_chat_message, 1, 10, text, 'neutral', old, 'Tí')
+        await runtime.db.write(teoembot_db.add_chat_message, 2, 10, 'mu chelsea', 'neutral', old, 'Tèo')
+        await runtime.db.write(teoembot_db.add_chat_message, 1, 10, 'mu chelsea mới nói', 'neutral', time.time(), 'Tí')
+        
+        related = await retrieve_related_messages(1, 'hôm qua mu vs chelsea', limit=3)
+        
+        texts = [r['text'] for r in related]
+        assert texts[0] == 'trận mu chelsea tối qua hay vl'
+        assert set(texts) == {'trận mu chelsea tối qua hay vl', 'mu thua rồi'}
+        assert related[0]['name'] == 'Tí'
+    
+    @pytest.mark.asyncio
+    async def test_long_recent_message_is_not_retrieved(self, runtime):
+        """Test a message in the recent window is not repeated as older context even when cut for the prompt"""
+        import teoembot
+        import teoembot_db
+        from teoembot import get_ai_reply_multimodal
+        
+        long_text = 'trận mu chelsea tối qua ' + 'hay vl ' * 20
+        await runtime.db.write(teoembot_db.add_chat_message, 1, 10, long_text, 'neutral', time.time() - 7200, 'Tí')
+        runtime.config.reply_candidates = 1
+        call = AsyncMock(return_value='kèo thơm')
+        with patch.object(teoembot, 'openai_quota_available', Mock(return_value=True)), \
+             patch.object(teoembot, 'call_openai_with_retry', call):
+            for entry in ({'name': 'Tí', 'text': long_text[:100], 'full_text': long_text},
+                          {'name': 'Tí', 'text': 'ăn cơm chưa'}):
+                await get_ai_reply_multimodal('mu chelsea hôm qua', [entry],
+                                              context={'chat_id': 1, 'message_class': 'trigger'})
+        
+        prompts = [' '.join(m['content'] for m in c.args[0] if isinstance(m['content'], str))
+                   for c in call.await_args_list]
+        assert 'Tin nhắn cũ liên quan' not in prompts[0]
+        assert 'Tin nhắn cũ liên quan' in prompts[-1]  # Not in the recent window: retrieved
+    
+    @pytest.mark.asyncio
+    async def test_archive_is_pruned_past_retention(self, runtime):
+        """Test messages older than the retention window leave the table and the FTS index"""
+        import teoembot_db
+        from teoembot import prune_message_archive, retrieve_related_messages
+        
+        now = time.time()
+        await runtime.db.write(teoembot_db.add_chat_message, 1, 10, 'mu thua rồi', 'neutral', now - 40 * 86400, 'Tí')
+        await runtime.db.write(teoembot_db.add_chat_message, 1, 10, 'mu thắng rồi', 'neutral', now - 7200, 'Tí')
+        
+        assert await prune_message_archive(30) == 1
+        related = await retrieve_related_messages(1, 'mu', limit=5)
+        assert [r['text'] for r in related] == ['mu thắng rồi']
+        assert await prune_message_archive(30) == 0
+    
+    def test_migration_indexes_existing_messages(self, tmp_path):
+        """Test opening an older database adds the column and indexes stored rows"""
+        from sqlalchemy import create_engine, text
+        import teoembot_db
+        
+        url = f"sqlite:///{tmp_path / 'old.db'}"
+        with create_engine(url).begin() as conn:
+            conn.execute(text("CREATE TABLE chat_messages (id INTEGER PRIMARY KEY, chat_id INTEGER, "
+                              "sender_id INTEGER, text VARCHAR, sentiment VARCHAR, timestamp FLOAT)"))
+            conn.execute(text("INSERT INTO chat_messages (chat_id, text, timestamp) VALUES (1, 'kèo tài xỉu', 0)"))
+        
+        _, session_factory = teoembot_db.open_database(url)
+        with session_factory() as db_session:
+            rows = teoembot_db.search_chat_messages(db_session, 1, '"keo"', 1, 5)
+        assert [r['text'] for r in rows] == ['kèo tài xỉu']
+
+
+class TestStateSnapshot:
+    """Test warm-restart state snapshots"""
+    
+    def test_state_store_dump_and_load(self):
+        """Test records round-trip with tuple keys and idle ones are dropped"""
+        from teoembot import StateStore, ChatState, ThreadState
+        
+        chats = StateStore(ChatState, ttl=60)
+        chats[1].trending.append({'word': 'kèo', 'time': time.time()})
+        chats[1].questions_asked = 2
+        threads = StateStore(ThreadState, ttl=60)
+        threads[(1, None)].last_reply_time = 123.0
+        
+        rows = chats.dump()
+        rows.append([2, {'last_seen': time.time() - 120, 'questions_asked': 1}])
+        rows.append([3, {'last_seen': time.time(), 'last_topic': 'mu'}])  # Field dropped since the snapshot
+        restored = StateStore(ChatState, ttl=60)
+        assert restored.load(rows) == 2
+        assert restored.peek(1).questions_asked == 2
+        assert [t['word'] for t in restored.peek(1).trending] == ['kèo']
+        assert restored.peek(2) is None and restored.expired == 1
+        
+        restored_threads = StateStore(ThreadState, ttl=60)
+        restored_threads.load(threads.dump())
+        assert restored_threads.peek((1, None)).last_reply_time == 123.0
+    
+    def test_save_and_restore_round_trip(self, bot_config):
+        """Test a saved snapshot warms up a fresh runtime and expired entries stay out"""
+        import teoembot
+        from teoembot import BotRuntime
+        
+        old = BotRuntime(bot_config)
+        old.message_cache['kèo gì'] = 'tài 2.5'
+        old.reply_alternatives['kèo gì'] = ['xỉu 2.5']
+        old.recent_responses.append('chill đi')
+        old.chat_state[1].questions_asked = 2
+        old.telegram.pause('send', 1, 60)
+        old.reply_pool.add(('chill', 'playful', None), ['uh'])
+        old.reply_pool.buckets[('hype', 'excited', None)] = [(time.time() - 1, 'hết hạn')]
+        mood = dict(teoembot.current_mood)
+        quota = getattr(teoembot.check_openai_quota, 'hourly_calls', None)
+        try:
+            teoembot.check_openai_quota.hourly_calls = {f"quota_{teoembot.datetime.datetime.now().hour}": 42}
+            assert old.snapshots.save(old) > 0
+            
+            new = BotRuntime(bot_config)
+            teoembot.check_openai_quota.hourly_calls = {}
+            restored = new.snapshots.restore(new)
+            
+            assert new.message_cache['kèo gì'] == 'tài 2.5'
+            assert new.reply_alternatives['kèo gì'] == ['xỉu 2.5']
+            assert list(new.recent_responses) == ['chill đi']
+            assert new.chat_state.peek(1).questions_asked == 2
+            assert 0 < new.telegram.pause_remaining('send', 1) <= 60
+            assert new.reply_pool.take('chill', 'playful') == 'uh'
+            assert ('hype', 'excited', None) not in new.reply_pool.buckets
+            assert sum(teoembot.check_openai_quota.hourly_calls.values()) == 42
+            assert restored['pooled'] == 1 and restored['pauses'] == 1
+            assert 'restore_ms' in new.snapshots.stats()['last_restore']
+        finally:
+            teoembot.current_mood.update(mood)
+            teoembot.check_openai_quota.hourly_calls = quota or {}
+    
+    def test_old_or_unknown_snapshots_are_ignored(self, runtime):
+        """Test caches from a long-stopped bot and other versions are not restored"""
+        import gzip
+        import json
+        
+        path = runtime.config.snapshot_file
+        assert runtime.snapshots.restore(runtime) == {}  # No file yet
+        
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump({'version': 99, 'saved_at': time.time(), 'message_cache': [['a', 'b']]}, f)
+        assert runtime.snapshots.restore(runtime) == {}
+        
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump({'version': 1, 'saved_at': time.time() - 3600, 'message_cache': [['a', 'b']],
+                       'pauses': [['send', 1, 30]]}, f)
+        restored = runtime.snapshots.restore(runtime)
+        assert restored['cached'] == 0 and restored['pauses'] == 0
+        assert 'a' not in runtime.message_cache
+
+
+class TestProfiler:
+    """Test the on-demand sampling profiler"""
+    
+    def test_stage_marks_are_free_when_off(self):
+        """Test nothing is recorded while no profile is running"""
+        import teoembot
+        
+        assert teoembot._profiler is None
+        teoembot.debug_log("x", stage='generate')
+        teoembot.mark_stage('generate')
+        assert teoembot._task_stages == {}
+    
+    @pytest.mark.asyncio
+    async def test_profile_attributes_samples_to_stages(self, tmp_path):
+        """Test samples of a busy task are rooted at its coroutine and stage"""
+        import teoembot
+        from teoembot import start_profiling
+        
+        async def busy_handler():
+            teoembot.debug_log("working", stage='generate')
+            deadline = time.monotonic() + 0.3
+            while time.monotonic() < deadline:
+                sum(range(1000))
+        
+        path = tmp_path / 'out' / 'profile.collapsed'
+        profiler = start_profiling(seconds=0.25, path=str(path))
+        assert start_profiling(seconds=0.25) is None  # One profile at a time
+        await asyncio.create_task(busy_handler())
+        profiler.wait(5)
+        
+        lines = path.read_text(encoding='utf-8').splitlines()
+        assert lines and all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+        assert any(line.startswith('task:') and ';stage:generate;' in line and 'busy_handler' in line for line in lines)
+        assert profiler.stage_samples['generate'] > 0
+        await asyncio.sleep(0)  # Teardown is handed to the loop
+        assert teoembot._profiler is None and teoembot._task_stages == {}
+    
+    def test_teardown_runs_on_the_loop(self, tmp_path):
+        """Test the sampler thread hands clearing the shared stage state back to the event loop"""
+        import teoembot
+        from teoembot import SamplingProfiler
+        
+        loop = Mock()
+        profiler = SamplingProfiler(loop, 0, str(tmp_path / 'p.collapsed'))
+        teoembot._profiler = profiler
+        teoembot._task_stages['task'] = 'generate'
+        try:
+            profiler._run()
+            loop.call_soon_threadsafe.assert_called_once_with(profiler._finish)
+            assert teoembot._profiler is profiler and teoembot._task_stages == {'task': 'generate'}
+            profiler._finish()
+            assert teoembot._profiler is None and teoembot._task_stages == {}
+        finally:
+            teoembot._profiler = None
+            teoembot._task_stages.clear()
+    
+    def test_sample_includes_worker_threads(self):
+        """Test other threads are sampled under their thread name"""
+        import threading
+        from teoembot import SamplingProfiler
+        
+        stop = threading.Event()
+        worker = threading.Thread(target=stop.wait, name='db-writer')
+        worker.start()
+        try:
+            profiler = SamplingProfiler(None, 0, 'unused')
+            profiler.loop_thread_id = None
+            profiler.sample()
+        finally:
+            stop.set()
+            worker.join()
+        assert any(stack.startswith('thread:db-writer;') for stack in profiler.samples)
+
+
+class TestTracing:
+    """Test per-message tracing and the trace report"""
+    
+    @pytest.mark.asyncio
+    async def test_spans_are_exported_with_parents(self, tmp_path):
+        """Test nested, early-ended and resumed spans land in one trace"""
+        import json
+        from teoembot import Tracer, span, traced, trace_context
+        
+        tracer = Tracer(str(tmp_path / 'traces.jsonl'))
+        
+        @traced('generation')
+        async def generate():
+            await asyncio.sleep(0.01)
+        
+        async def deliver(trace):
+            with tracer.resume(trace, 'deliver', kind='reply'):
+                with span('typing'):
+                    pass
+        
+        with tracer.start_trace('message', chat_id=1) as root:
+            decision = span('decision')  # Left open, like an early return
+            with span('reply'):
+                await generate()
+            trace = trace_context()
+        await asyncio.create_task(deliver(trace))
+        tracer.close()
+        
+        spans = {s['name']: s for s in map(json.loads, (tmp_path / 'traces.jsonl').read_text(encoding='utf-8').splitlines())}
+        assert set(spans) == {'message', 'decision', 'reply', 'generation', 'deliver', 'typing'}
+        assert {s['trace_id'] for s in spans.values()} == {root.trace_id}
+        assert spans['generation']['parent_id'] == spans['reply']['span_id']
+        assert spans['decision']['parent_id'] == spans['message']['span_id']
+        assert spans['deliver']['parent_id'] == spans['message']['span_id']
+        assert spans['typing']['parent_id'] == spans['deliver']['span_id']
+        assert spans['generation']['duration_ms'] >= 10
+        assert spans['message']['attrs'] == {'chat_id': 1}
+    
+    @pytest.mark.asyncio
+    async def test_tracing_off_is_a_no_op(self, tmp_path):
+        """Test spans do nothing without a trace file or outside a trace"""
+        from teoembot import Tracer, span, current_span, trace_context
+        
+        tracer = Tracer(None)
+        with tracer.start_trace('message'):
+            with span('history') as s:
+                s.set(messages=3)
+            assert trace_context() is None
+        
+        live = Tracer(str(tmp_path / 'traces.jsonl'))
+        with live.start_trace('message'):
+            with live.resume(None, 'deliver'):
+                assert current_span.get() is None  # Stale parents are hidden
+        assert tracer.stats()['exported'] == 0
+        assert live.stats()['exported'] == 1
+        live.close()
+    
+    def test_report_orders_slowest_and_draws_waterfall(self, tmp_path, capsys):
+        """Test the CLI finds the slowest trace and nests spans under their parent"""
+        import json
+        import trace_report
+        
+        spans = [
+            {'trace_id': 'a', 'span_id': '1', 'parent_id': None, 'name': 'message', 'start': 100.0, 'duration_ms': 500, 'attrs': {}},
+            {'trace_id': 'b', 'span_id': '2', 'parent_id': None, 'name': 'message', 'start': 100.0, 'duration_ms': 9000, 'attrs': {'chat_id': 7}},
+            {'trace_id': 'b', 'span_id': '3', 'parent_id': '2', 'name': 'delay', 'start': 100.5, 'duration_ms': 6000, 'attrs': {}},
+            {'trace_id': 'b', 'span_id': '4', 'parent_id': '2', 'name': 'generation', 'start': 106.5, 'duration_ms': 2000, 'attrs': {'model': 'm'}},
+            {'trace_id': 'b', 'span_id': '5', 'parent_id': '2', 'name': 'deliver', 'start': 109.5, 'duration_ms': 500, 'attrs': {}},
+        ]
+        path = tmp_path / 'traces.jsonl'
+        path.write_text('\n'.join(json.dumps(s) for s in spans) + '\nnot json\n', encoding='utf-8')
+        
+        traces = trace_report.load_traces(str(path))
+        assert [trace_id for trace_id, _ in trace_report.slowest_traces(traces)] == ['b', 'a']
+        assert trace_report.trace_duration_ms(traces['b']) == pytest.approx(10000)
+        
+        lines = trace_report.render_waterfall(traces['b'], width=20)
+        assert [line.split()[0] for line in lines] == ['message', 'delay', 'generation', 'deliver']
+        assert lines[2].startswith('    generation') and 'model=m' in lines[2]
+        
+        assert trace_report.main([str(path), '--slowest', '1']) == 0
+        out = capsys.readouterr().out
+        assert 'trace b' in out and 'chat=7' in out and 'trace a' not in out
+
+
+class TestFairLimiter:
+    """Test weighted fair queueing of shared budgets across chats"""
+    
+    async def _grant_order(self, limiter, requests):
+        """Exhaust the bucket, queue (chat, count) requests in order and return who got tokens, in order"""
+        order = []
+        
+        async def one(chat_id):
+            await limiter.acquire(chat_id=chat_id)
+            order.append(chat_id)
+        
+        await limiter.acquire()
+        tasks = []
+        for chat_id, count in requests:
+            tasks += [asyncio.create_task(one(chat_id)) for _ in range(count)]
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order
+    
+    @pytest.mark.asyncio
+    async def test_busy_chat_does_not_starve_quiet_one(self):
+        """Test a late request from a quiet chat overtakes a busy chat's backlog"""
+        from aiolimiter import AsyncLimiter
+        from teoembot import FairLimiter
+        
+        limiter = FairLimiter(AsyncLimiter(1, 0.02))
+        order = await self._grant_order(limiter, [(1, 5), (2, 1)])
+        assert order.index(2) <= 1
+        
+        stats = limiter.stats()
+        assert stats[1]['grants'] == 5 and stats[2]['grants'] == 1
+        assert stats[1]['max_wait_ms'] > stats[2]['max_wait_ms'] > 0
+        assert limiter.waiting == 0
+    
+    @pytest.mark.asyncio
+    async def test_weights_and_min_share(self):
+        """Test tokens follow weights, and a guaranteed share overrides them"""
+        from aiolimiter import AsyncLimiter
+        from teoembot import FairLimiter, parse_chat_weights
+        
+        weights = parse_chat_weights('{"1": 3, "2": {"weight": 1}}')
+        order = await self._grant_order(FairLimiter(AsyncLimiter(1, 0.02), weights), [(1, 4), (2, 4)])
+        assert order[:4] == [1, 1, 1, 2]
+        
+        weights = parse_chat_weights('{"1": 10, "2": {"weight": 1, "min_share": 0.5}}')
+        order = await self._grant_order(FairLimiter(AsyncLimiter(1, 0.02), weights), [(1, 6), (2, 2)])
+        assert order[0] == 2 and 2 in order[1:4]
+        assert parse_chat_weights('not json') == {}
+    
+    @pytest.mark.asyncio
+    async def test_scheduler_reports_waits_per_chat(self):
+        """Test Telegram sends go through the fair global budget and report per-chat waits"""
+        from teoembot import TelegramScheduler
+        
+        scheduler = TelegramScheduler(limits={'send': (5, 5)})
+        send = AsyncMock(return_value='ok')
+        await scheduler.run('send', 1, send)
+        await scheduler.run('send', 2, send)
+        assert set(scheduler.fair_stats()['send']) == {1, 2}
+        assert scheduler.global_limiters['send'].has_capacity()
+    
+    @pytest.mark.asyncio
+    async def test_headroom_uses_public_capacity_check(self):
+        """Test headroom is measured through has_capacity(), without the limiter's private level"""
+        from aiolimiter import AsyncLimiter
+        from teoembot import FairLimiter, limiter_headroom
+        
+        limiter = AsyncLimiter(10, 3600)
+        assert limiter_headroom(limiter) == 1.0
+        for _ in range(4):
+            await limiter.acquire()
+        assert limiter_headroom(limiter) == pytest.approx(0.6, abs=1 / 128)
+        await limiter.acquire(6)
+        assert limiter_headroom(FairLimiter(limiter)) == pytest.approx(0.0, abs=1 / 128)
+
+
+class TestAdmissionController:
+    """Test feedback-controlled load shedding"""
+    
+    def test_decrease_and_gradual_recovery(self, caplog):
+        """Test pressure halves the factor down to reaction-only, and calm restores it step by step"""
+        import logging
+        import teoembot
+        from teoembot import AdmissionController
+        
+        admission = AdmissionController()
+        calm, busy = {'openai': 0.1}, {'openai': 0.9}
+        with caplog.at_level(logging.INFO, logger='teoembot'):
+            assert admission.adjust(busy) == 0.5
+            assert admission.trigger_probability() == teoembot.TRIGGER_PROBABILITY * 0.5
+            assert admission.rate_limit_seconds() == teoembot.RATE_LIMIT_SECONDS * 2
+            for _ in range(5):
+                admission.adjust(busy)
+        assert admission.factor == teoembot.ADMISSION_MIN_FACTOR and admission.reaction_only
+        record = [r for r in caplog.records if getattr(r, 'stage', None) == 'admission'][-1]
+        assert record.reaction_only and record.signals == busy
+        
+        admission.adjust({'openai': 0.6})  # Between the thresholds: hold
+        assert admission.factor == teoembot.ADMISSION_MIN_FACTOR
+        factors = [admission.adjust(calm) for _ in range(4)]
+        assert factors == pytest.approx([0.2, 0.3, 0.4, 0.5])
+        assert not admission.reaction_only
+        assert admission.stats()['decreases'] >= 4 and admission.stats()['increases'] == 4
+    
+    def test_inflight_cap_sheds_handlers(self):
+        """Test handlers beyond the cap are refused and counted"""
+        from teoembot import AdmissionController
+        
+        admission = AdmissionController(max_inflight=2)
+        assert admission.enter() and admission.enter()
+        assert not admission.enter()
+        admission.leave()
+        assert admission.enter()
+        assert admission.stats()['shed'] == 1 and admission.inflight == 2
+    
+    @pytest.mark.asyncio
+    async def test_signals_include_quota_burn(self, runtime):
+        """Test burning the hourly quota faster than an even spread shows as pressure"""
+        import teoembot
+        
+        saved = getattr(teoembot.check_openai_quota, 'hourly_calls', None)
+        try:
+            teoembot.check_openai_quota.hourly_calls = {}
+            idle = runtime.admission.signals()
+            teoembot.check_openai_quota.hourly_calls = {'quota_x': teoembot.OPENAI_HOURLY_QUOTA}
+            burning = runtime.admission.signals()
+        finally:
+            teoembot.check_openai_quota.hourly_calls = saved or {}
+        assert idle == {'openai': 0.0, 'telegram': 0.0, 'quota': 0.0, 'inflight': 0.0, 'loop_lag': 0.0}
+        assert burning['quota'] >= round(1 / teoembot.QUOTA_BURN_LIMIT, 3)  # Whole quota used, however late in the hour
+
+
+class TestBacklogCatchUp:
+    """Test handling of messages delivered late after a restart or reconnect"""
+    
+    def _event(self, chat_id, msg_id, age, text='', mentioned=False):
+        import datetime
+        event = Mock()
+        event.chat_id = chat_id
+        event.message.id = msg_id
+        event.message.date = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=age)
+        event.message.mentioned = mentioned
+        event.raw_text = text
+        return event
+    
+    def test_staleness_uses_message_date(self):
+        """Test events are stale by their send date, and undated ones never are"""
+        from teoembot import BacklogHandler, message_age
+        
+        backlog = BacklogHandler(stale_after=60, replay=AsyncMock())
+        assert message_age(self._event(1, 1, 300)) == pytest.approx(300, abs=2)
+        assert backlog.is_stale(self._event(1, 1, 300))
+        assert not backlog.is_stale(self._event(1, 2, 5))
+        undated = Mock()
+        undated.message.date = None
+        assert message_age(undated) == 0.0
+    
+    @pytest.mark.asyncio
+    async def test_only_latest_targeted_message_per_chat_is_replayed(self):
+        """Test a burst of stale messages costs at most one reply per chat, after it settles"""
+        from teoembot import BacklogHandler
+        
+        replay = AsyncMock()
+        backlog = BacklogHandler(stale_after=60, replay=replay, settle=0.02, reply_max_age=3600)
+        backlog.absorb(self._event(1, 10, 300, 'tèo ơi'), 'tèo ơi')
+        backlog.absorb(self._event(1, 12, 200, '', mentioned=True), '')
+        backlog.absorb(self._event(1, 13, 100, 'kèo gì'), 'kèo gì')
+        backlog.absorb(self._event(2, 5, 100, 'ăn cơm chưa'), 'ăn cơm chưa')
+        backlog.absorb(self._event(3, 7, 7200, '@teo'), '@teo')
+        await asyncio.sleep(0.1)
+        
+        assert replay.await_count == 1
+        event = replay.await_args.args[0]
+        assert (event.chat_id, event.message.id) == (1, 12)
+        assert replay.await_args.kwargs == {'catch_up': True}
+        assert backlog.stats() == {'absorbed': 5, 'superseded': 1, 'replayed': 1, 'too_old': 1, 'pending_chats': 0}
+    
+    @pytest.mark.asyncio
+    async def test_stale_message_only_updates_state(self, runtime):
+        """Test the handler records a stale message but does not reply or call the API"""
+        import teoembot
+        from teoembot import handle_message
+        
+        chat_id = next(iter(teoembot.ALLOWED_CHAT_IDS))
+        event = self._event(chat_id, 42, 600, 'tèo ơi trận mu tối nay sao')
+        event.is_private = False
+        event.sender_id = 7
+        event.message.reply_to = None
+        tg_client = Mock()
+        tg_client.get_me = AsyncMock(return_value=Mock(id=1))
+        with patch('teoembot.get_telegram_client', return_value=tg_client), \
+             patch('teoembot.enqueue_delivery', new=AsyncMock()) as enqueue, \
+             patch('teoembot.call_openai_with_retry', new=AsyncMock()) as openai_call:
+            await handle_message(event)
+            assert runtime.backlog.latest_targeted[chat_id] is event
+            assert [t['word'] for t in runtime.trending_topics[chat_id]][:1] == ['trận']
+            await runtime.backlog.close()
+        enqueue.assert_not_awaited()
+        openai_call.assert_not_awaited()
+
+
+class TestAlbums:
+    """Test album (media group) aggregation"""
+    
+    def test_pick_photo_size(self):
+        """Test the largest stored size within the limit is chosen"""
+        from types import SimpleNamespace
+        from teoembot import pick_photo_size
+        
+        sizes = [SimpleNamespace(type='i'), SimpleNamespace(w=320, h=240), SimpleNamespace(w=800, h=600),
+                 SimpleNamespace(w=1280, h=960)]
+        photo = SimpleNamespace(sizes=sizes)
+        assert pick_photo_size(photo, 1024) is sizes[2]
+        assert pick_photo_size(photo, 100) is sizes[1]  # Nothing fits: smallest
+        assert pick_photo_size(SimpleNamespace(sizes=[sizes[0]])) is None  # Largest via thumb=None
+    
+    @pytest.mark.asyncio
+    async def test_album_events_collapse_into_first(self):
+        """Test one event gets the whole album and the rest (and stragglers) stop"""
+        from teoembot import AlbumCollector
+        
+        def event(msg_id, grouped_id=77):
+            e = Mock()
+            e.message.id = msg_id
+            e.message.grouped_id = grouped_id
+            return e
+        
+        collector = AlbumCollector(window=0.05, max_photos=2)
+        results = await asyncio.gather(*(collector.collect(event(i)) for i in (3, 1, 2)))
+        assert results[1] is None and results[2] is None
+        assert [e.message.id for e in results[0]] == [1, 2]  # Oldest first, capped
+        assert await collector.collect(event(4)) is None
+        assert len(await collector.collect(event(5, grouped_id=78))) == 1
+        assert collector.stats() == {'merged': 2, 'late': 1, 'albums': 2, 'photos': 4}
+    
+    @pytest.mark.asyncio
+    async def test_album_is_one_vision_request(self, tmp_path, runtime):
+        """Test every album photo goes into a single low-detail request"""
+        import teoembot
+        from teoembot import get_ai_reply_multimodal
+        
+        paths = []
+        for i in range(3):
+            path = tmp_path / f'slip{i}.jpg'
+            path.write_bytes(b'jpeg' + bytes([i]))
+            paths.append(str(path))
+        runtime.config.reply_candidates = 1
+        call = AsyncMock(return_value='kèo thơm đấy')
+        with patch.object(teoembot, 'openai_quota_available', Mock(return_value=True)), \
+             patch.object(teoembot, 'call_openai_with_retry', call):
+            await get_ai_reply_multimodal('', [], paths, context={'chat_id': 1, 'message_class': 'photo'})
+        
+        assert call.await_count == 1
+        content = call.await_args.args[0][-1]['content']
+        images = [part['image_url'] for part in content if part['type'] == 'image_url']
+        assert len(images) == 3 and all(image['detail'] == 'low' for image in images)
+        assert '3 ảnh' in content[-1]['text']
+
+
+class TestMessagePipeline:
+    """Test the staged message pipeline"""
+    
+    def _event(self, chat_id, text, sender_id=7):
+        import datetime
+        event = Mock()
+        event.chat_id = chat_id
+        event.sender_id = sender_id
+        event.is_private = False
+        event.is_reply = False
+        event.raw_text = text
+        event.message.id = 42
+        event.message.reply_to = None
+        event.message.photo = None
+        event.message.grouped_id = None
+        event.message.date = datetime.datetime.now(datetime.timezone.utc)
+        return event
+    
+    @pytest.mark.asyncio
+    async def test_stages_run_in_order_until_stop(self):
+        """Test stages run in order, stop early, call hooks and can be plugged in"""
+        from teoembot import Pipeline, MessageContext
+        
+        ran = []
+        
+        def stage(name, stop=False):
+            async def run(ctx):
+                ran.append(name)
+                if stop:
+                    ctx.stop('enough')
+            return run
+        
+        seen = []
+        pipeline = Pipeline([('a', stage('a')), ('c', stage('c', stop=True)), ('d', stage('d'))],
+                            hooks=[lambda name, ctx, seconds: seen.append(name)])
+        pipeline.insert('c', 'b', stage('b'))
+        ctx = await pipeline.run(MessageContext(event=Mock()))
+        
+        assert ran == ['a', 'b', 'c'] and seen == ran
+        assert ctx.stop_reason == 'enough'
+        stats = pipeline.stats()
+        assert set(stats['stages']) == {'a', 'b', 'c'}
+        assert stats['stops'] == {'c: enough': 1}
+    
+    @pytest.mark.asyncio
+    async def test_prefilter_rejects_cheaply(self, runtime):
+        """Test other chats and own messages stop at the pre-filter and get_me is fetched once"""
+        import teoembot
+        from teoembot import handle_message
+        
+        chat_id = next(iter(teoembot.ALLOWED_CHAT_IDS))
+        tg_client = Mock()
+        tg_client.get_me = AsyncMock(return_value=Mock(id=7))
+        with patch('teoembot.get_telegram_client', return_value=tg_client), \
+             patch.object(teoembot, 'SLEEP_START_HOUR', 0), patch.object(teoembot, 'SLEEP_END_HOUR', 0):
+            other = await handle_message(self._event(-1, 'kèo gì'))
+            own = [await handle_message(self._event(chat_id, 'kèo gì')) for _ in range(2)]
+        
+        assert other.stop_reason == 'not whitelisted'
+        assert [ctx.stop_reason for ctx in own] == ['own message', 'own message']
+        assert tg_client.get_me.await_count == 1
+        assert runtime.pipeline.stats()['stops'] == {'prefilter: not whitelisted': 1, 'prefilter: own message': 2}
+    
+    @pytest.mark.asyncio
+    async def test_rule_reply_skips_history_and_generation(self, runtime):
+        """Test a rule-based answer is delivered without fetching history or calling the API"""
+        import teoembot
+        from teoembot import handle_message
+        
+        chat_id = next(iter(teoembot.ALLOWED_CHAT_IDS))
+        tg_client = Mock()
+        tg_client.get_me = AsyncMock(return_value=Mock(id=1))
+        tg_client.iter_messages = Mock()
+        with patch('teoembot.get_telegram_client', return_value=tg_client), \
+             patch.object(teoembot, 'SLEEP_START_HOUR', 0), patch.object(teoembot, 'SLEEP_END_HOUR', 0), \
+             patch('teoembot.random.uniform', return_value=0), \
+             patch('teoembot.enqueue_delivery', new=AsyncMock()) as enqueue, \
+             patch('teoembot.get_ai_reply_multimodal', new=AsyncMock()) as ai_reply:
+            ctx = await handle_message(self._event(chat_id, 'kèo gì hôm nay'))
+        
+        assert ctx.reply_source == 'rule' and ctx.stop_reason is None
+        assert enqueue.await_args.args[:3] == (chat_id, 'reply', 42)
+        assert enqueue.await_args.kwargs['text'] == ctx.reply
+        tg_client.iter_messages.assert_not_called()
+        ai_reply.assert_not_awaited()
+        assert list(runtime.pipeline.stats()['stages'])[-1] == 'deliver'
+    
+    @pytest.mark.asyncio
+    async def test_history_fetch_follows_route(self, runtime):
+        """Test the Telegram history fetch is sized by the message class's route"""
+        from teoembot import enrich_stage, MessageContext, HISTORY_FETCH_MARGIN
+        
+        async def no_messages(*args, **kwargs):
+            return
+            yield
+        
+        tg_client = Mock()
+        tg_client.iter_messages = Mock(side_effect=no_messages)
+        random_ctx = MessageContext(event=Mock(), tg_client=tg_client, chat_id=1)
+        await enrich_stage(random_ctx)
+        runtime.router.update('targeted', history_depth=4, include_summary=False)
+        targeted_ctx = MessageContext(event=Mock(), tg_client=tg_client, chat_id=1, is_targeted=True)
+        await enrich_stage(targeted_ctx)
+        
+        limits = [call.kwargs['limit'] for call in tg_client.iter_messages.call_args_list]
+        assert limits == [runtime.router.route('random').history_depth + HISTORY_FETCH_MARGIN, 4 + HISTORY_FETCH_MARGIN]
+        assert targeted_ctx.context['message_class'] == 'targeted'
+    
+    def test_history_fetch_is_a_short_window(self):
+        """Test deep routes still fetch only the recent window live; the archive supplies the rest"""
+        from teoembot import Router, history_fetch_limit, RECENT_HISTORY_WINDOW, HISTORY_FETCH_MARGIN
+        
+        router = Router()
+        router.update('targeted', history_depth=30)
+        assert history_fetch_limit(router, 'targeted') == RECENT_HISTORY_WINDOW + HISTORY_FETCH_MARGIN
+        assert all(history_fetch_limit(router, c) <= RECENT_HISTORY_WINDOW + HISTORY_FETCH_MARGIN
+                   for c in ('random', 'trigger', 'reply_to_bot', 'photo'))
+
+
+class TestPhraseMiner:
+    """Test the offline phrase and stopword miner"""
+    
+    def _rows(self, now):
+        rows = []
+        for i in range(60):
+            rows.append((1, now - 60 * i, f"kèo thơm quá anh em {i}"))
+            if i % 3 == 0:
+                rows.append((1, now - 86400 * 90, "trận hôm qua chán"))
+            rows.append((2, now - 60 * i, "ăn cơm chưa anh em"))
+        return rows
+    
+    def test_phrases_and_stopwords_per_chat(self):
+        """Test recent chat-specific phrases rank first and chunk size doesn't change counts"""
+        import time
+        from mine_phrases import PhraseMiner
+        
+        now = time.time()
+        rows = self._rows(now)
+        whole = PhraseMiner(now=now)
+        whole.add_chunk(rows)
+        chunked = PhraseMiner(now=now, max_keys=50)
+        for start in range(0, len(rows), 7):
+            chunked.add_chunk(rows[start:start + 7])
+        
+        phrases = whole.phrases(top=3)
+        assert phrases[1][0] == 'kèo thơm' and 'trận hôm' not in phrases[1]
+        assert 'ăn cơm chưa' in phrases[2] and 'anh em' in phrases['all']
+        stopwords = whole.chat_stopwords(min_df=0.4)
+        assert stopwords[1][:2] == ['kèo', 'thơm'] and 'trận' not in stopwords[1]
+        assert chunked.chat_stopwords(min_df=0.4) == stopwords
+        assert chunked.stats()['rows'] == len(rows)
+    
+    def test_mined_bank_loads(self, tmp_path):
+        """Test the miner streams the archive and writes a file load_trending_phrases accepts"""
+        import time
+        import teoembot_db
+        from mine_phrases import main
+        from teoembot import PhraseBank, load_trending_phrases, validate_trending_phrases
+        
+        db_path = tmp_path / 'bot.db'
+        engine, session_factory = teoembot_db.open_database(f"sqlite:///{db_path}")
+        now = time.time()
+        with session_factory() as session:
+            for chat_id, timestamp, text in self._rows(now):
+                teoembot_db.add_chat_message(session, chat_id, 7, text, 'neutral', timestamp)
+            session.commit()
+        engine.dispose()
+        output = tmp_path / 'mined.json'
+        
+        assert main([str(db_path), '-o', str(output), '--chunk-size', '10', '--stopword-df', '0.4']) == 0
+        data = load_trending_phrases(str(output))
+        validate_trending_phrases(data)
+        assert 'memes' in data and 'kèo thơm' in data['mined']['1']
+        assert 'kèo' in PhraseBank(str(output)).stopwords(1)
+        assert PhraseBank(str(output)).stopwords(3) == frozenset()
+    
+    def test_trending_words_are_rebuilt_in_write_order(self, tmp_path):
+        """Test each message's trending_topics rows are joined back in id order"""
+        import teoembot_db
+        from mine_phrases import stream_rows
+        
+        db_path = tmp_path / 'bot.db'
+        engine, session_factory = teoembot_db.open_database(f"sqlite:///{db_path}")
+        with session_factory() as session:
+            session.add_all([
+                teoembot_db.TrendingTopic(id=5, chat_id=1, word='chelsea', timestamp=100.0),
+                teoembot_db.TrendingTopic(id=2, chat_id=1, word='trận', timestamp=100.0),
+                teoembot_db.TrendingTopic(id=4, chat_id=2, word='cơm', timestamp=100.0),
+                teoembot_db.TrendingTopic(id=3, chat_id=1, word='mu', timestamp=100.0),
+            ])
+            session.commit()
+        engine.dispose()
+        
+        rows = [row for chunk in stream_rows(str(db_path), 'words') for row in chunk]
+        assert sorted(rows) == [(1, 100.0, 'trận mu chelsea'), (2, 100.0, 'cơm')]
+    
+    def test_trending_skips_chat_stopwords(self, tmp_path, runtime):
+        """Test words mined as stopwords for a chat never become its trending words"""
+        import json
+        from teoembot import PhraseBank, update_trending, DEFAULT_TRENDING_PHRASES
+        
+        phrases = tmp_path / 'phrases.json'
+        phrases.write_text(json.dumps(dict(DEFAULT_TRENDING_PHRASES, chat_stopwords={'5': ['hôm', 'trận']})),
+                           encoding='utf-8')
+        runtime.phrase_bank = PhraseBank(str(phrases))
+        update_trending(5, 'trận hôm nay arsenal thắng')
+        update_trending(6, 'trận hôm nay arsenal thắng')
+        
+        assert [t['word'] for t in runtime.trending_topics[5]] == ['arsenal', 'thắng']
+        assert [t['word'] for t in runtime.trending_topics[6]] == ['trận', 'arsenal', 'thắng']
+    
+    def test_mined_bank_is_not_training_text(self):
+        """Test stopword lists and raw mined n-grams stay out of the phrase lookups and the local generator"""
+        from teoembot import DEFAULT_TRENDING_PHRASES, MarkovGenerator, PhraseSnapshot
+        
+        data = dict(DEFAULT_TRENDING_PHRASES, mined={'all': ['quá anh']}, chat_stopwords={'5': ['và', 'là']})
+        snapshot = PhraseSnapshot(data)
+        assert not any(category == 'chat_stopwords' for category, _ in snapshot.flat)
+        assert snapshot.stopwords['5'] == frozenset(['và', 'là'])
+        
+        generator = MarkovGenerator()
+        generator.learn_phrases(snapshot)
+        assert '5' not in generator.chains and 'all' not in generator.chains
+        words = {w for chain in generator.chains.values() for nexts in chain.values() for w in nexts}
+        assert not words & {'và', 'là', 'quá'}
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
 
@@ -0,0 +1,119 @@
+"""
+Print span waterfalls from the bot's trace file (TRACE_FILE).
+
+    python trace_report.py traces.jsonl              # 10 slowest traces
+    python trace_report.py traces.jsonl --slowest 3  # 3 slowest traces
+    python trace_report.py traces.jsonl --trace ID   # one trace
+    python trace_report.py traces.jsonl --stages     # time per span name
+
+Only the standard library is used, so this runs anywhere the trace file is.
+"""
+import argparse
+import json
+import sys
+from collections import defaultdict
+
+def load_traces(path):
+    """trace_id -> list of span dicts; unreadable lines are skipped"""
+    traces = defaultdict(list)
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                traces[record['trace_id']].append(record)
+            except (ValueError, KeyError, TypeError):
+                continue
+    return dict(traces)
+
+def trace_bounds(spans):
+    """(start, end) in epoch seconds over every span, including deliveries after the handler"""
+    start = min(s['start'] for s in spans)
+    end = max(s['start'] + s['duration_ms'] / 1000 for s in spans)
+    return start, end
+
+def trace_duration_ms(spans):
+    start, end = trace_bounds(spans)
+    return (end - start) * 1000
+
+def slowest_traces(traces, count=10):
+    """[(trace_id, duration_ms)] of the slowest traces, slowest first"""
+    durations = [(trace_id, trace_duration_ms(spans)) for trace_id, spans in traces.items()]
+    return sorted(durations, key=lambda item: -item[1])[:count]
+
+def ordered_spans(spans):
+    """[(depth, span)] in tree order, siblings by start time"""
+    ids = {s['span_id'] for s in spans}
+    children = defaultdict(list)
+    for s in spans:
+        parent = s.get('parent_id') if s.get('parent_id') in ids else None
+        children[parent].append(s)
+    result = []
+
+    def walk(parent, depth):
+        for s in sorted(children[parent], key=lambda s: s['start']):
+            result.append((depth, s))
+            walk(s['span_id'], depth + 1)
+
+    walk(None, 0)
+    return result
+
+def render_waterfall(spans, width=40):
+    """Text waterfall of one trace: name, offset, duration and a bar on a shared time axis"""
+    start, end = trace_bounds(spans)
+    total = max(end - start, 1e-9)
+    lines = []
+    for depth, s in ordered_spans(spans):
+        offset = s['start'] - start
+        left = int(offset / total * width)
+        length = max(1, int(s['duration_ms'] / 1000 / total * width))
+        bar = ' ' * left + '█' * min(length, width - left)
+        label = ('  ' * depth + s['name'])[:28]
+        attrs = s.get('attrs') or {}
+        note = ' '.join(f"{k}={v}" for k, v in attrs.items() if k not in ('chat_id', 'msg_id'))
+        lines.append(f"  {label:<28} {offset * 1000:>8.0f}ms {s['duration_ms']:>8.0f}ms |{bar:<{width}}| {note}".rstrip())
+    return lines
+
+def stage_summary(traces):
+    """span name -> (count, mean ms, max ms), slowest mean first"""
+    durations = defaultdict(list)
+    for spans in traces.values():
+        for s in spans:
+            durations[s['name']].append(s['duration_ms'])
+    summary = {name: (len(values), sum(values) / len(values), max(values)) for name, values in durations.items()}
+    return dict(sorted(summary.items(), key=lambda item: -item[1][1]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('path', help='trace JSONL file')
+    parser.add_argument('--slowest', type=int, default=10, help='number of slowest traces to show')
+    parser.add_argument('--trace', help='show only this trace id')
+    parser.add_argument('--stages', action='store_true', help='print time per span name instead')
+    parser.add_argument('--width', type=int, default=40, help='waterfall width in characters')
+    args = parser.parse_args(argv)
+
+    traces = load_traces(args.path)
+    if not traces:
+        print(f"No traces in {args.path}")
+        return 1
+    if args.stages:
+        print(f"{'span':<16} {'count':>7} {'mean':>10} {'max':>10}")
+        for name, (count, mean, worst) in stage_summary(traces).items():
+            print(f"{name:<16} {count:>7} {mean:>8.0f}ms {worst:>8.0f}ms")
+        return 0
+    if args.trace:
+        if args.trace not in traces:
+            print(f"Trace {args.trace} not found")
+            return 1
+        selected = [(args.trace, trace_duration_ms(traces[args.trace]))]
+    else:
+        selected = slowest_traces(traces, args.slowest)
+    for trace_id, duration in selected:
+        root = min(traces[trace_id], key=lambda s: s['start'])
+        attrs = root.get('attrs') or {}
+        print(f"trace {trace_id}  {duration:.0f}ms  chat={attrs.get('chat_id')} msg={attrs.get('msg_id')}")
+        print('\n'.join(render_waterfall(traces[trace_id], args.width)))
+        print()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())